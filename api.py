@@ -1,37 +1,74 @@
 # FunnX.Ai/api.py
-from flask import Flask, request, jsonify
+import time
+IMPORT_STARTED = time.perf_counter()  # for the import-time budget (boot.py)
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
-import google.generativeai as genai
 import os
 from dotenv import load_dotenv
-import requests
 import json
+import queue
+import logging
+import threading
+from http_client import pool_stats
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Load environment variables
 load_dotenv()
+# JSON log lines written by a background thread (see structured_logging.py).
+# LOG_LEVEL=DEBUG turns on the (sampled) upstream payload dumps in providers.py
+import structured_logging
+structured_logging.setup()
+log = logging.getLogger("api")
 
 # Initialize Flask App
 app = Flask(__name__)
 CORS(app) # Enable CORS for all routes
 
-# --- API Key Configuration ---
-GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+# Imported after load_dotenv() so MODELS_CONFIG from .env is honoured.
+# Provider clients are created once per worker (see providers.py / gunicorn.conf.py).
+import providers
+from providers import ChatError, FallbackText
+import response_cache
+import semantic_cache
+import single_flight
+import research
+from history_store import store as history, HISTORY_PAGE_SIZE
+import context_builder
+import metrics
+import rate_limiter
+import router
+import batch_jobs
+import boot
+import usage
+import auth
 
-# Initial check for API keys
-if not GEMINI_API_KEY:
-    print("WARNING: GOOGLE_API_KEY not found in .env file. Gemini API calls may fail.")
-else:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        print("Gemini API configured.")
-    except Exception as e:
-        print(f"ERROR: Failed to configure Gemini API: {e}. Check GOOGLE_API_KEY.")
 
-if not OPENROUTER_API_KEY:
-    print("WARNING: OPENROUTER_API_KEY not found in .env file. OpenRouter API calls may fail.")
-else:
-    print("OpenRouter API Key loaded.")
+# --- Request metrics (see metrics.py) ---
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Every log line written while serving this request carries its ID
+    g.request_id = structured_logging.set_request_id(request.headers.get("X-Request-ID"))
+
+
+@app.after_request
+def record_request_metrics(response):
+    # The route pattern, not the raw path, keeps the label set bounded
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - g.request_started,
+        endpoint=endpoint, method=request.method, status=response.status_code,
+    )
+    response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus scrape endpoint for this worker process."""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+# --- END request metrics ---
 
 
 # --- API Endpoints ---
@@ -48,11 +85,24 @@ def ping():
     A simple endpoint to confirm the backend is alive.
     Used by the frontend to wake up the backend.
     """
-    print("Received ping request. Backend is active.")
+    log.info("ping")
     return jsonify({"status": "active", "message": "Backend is alive!"}), 200
 # --- END NEW /ping endpoint ---
 
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """200 once this worker has warmed up its providers (see boot.py), 503 while it is still warming up."""
+    body, status = boot.readiness()
+    return jsonify(body), status
+
+
+@app.route("/pool_stats", methods=["GET"])
+def get_pool_stats():
+    """Connection pool hit/miss counters for this worker process."""
+    return jsonify(pool_stats()), 200
+
+
 @app.route("/login", methods=["POST"])
 def login():
     data = request.json
@@ -62,11 +112,186 @@ def login():
         return jsonify({"error": "Email and password are required."}), 400
 
     # --- Simplified Login: Any email/password combination works ---
-    print(f"Simulating login for: {email}")
-    return jsonify({"success": True, "message": "Simulated login successful."}), 200
+    log.info("simulated login", extra={"user_email": email})
+    # The token lets this user read their stored conversations (see auth.py)
+    return jsonify({"success": True, "message": "Simulated login successful.", "token": auth.issue(email)}), 200
     # --- End Simplified Login ---
 
 
+# --- Admission control (see rate_limiter.py) ---
+# Provider limits are applied in providers.py on every upstream call; the per-user
+# limit is applied here, once per chat request (and once per prompt in a batch).
+
+def request_user(user_email):
+    """The key this request is limited and charged under (see usage.py); also sets it for the request."""
+    # Requests without a login are limited per client address (first X-Forwarded-For hop behind Render's proxy)
+    client = request.headers.get("X-Forwarded-For", request.remote_addr or "").split(",")[0].strip()
+    user_key = user_email or client
+    usage.set_user(user_key)
+    return user_key
+
+
+def check_quota(user_key):
+    """Raises ChatError(429) once the user has used up their quota."""
+    within_quota, quota_wait = usage.check_quota(user_key)
+    if not within_quota:
+        raise ChatError(
+            "You've used up your usage quota for now. Please try again later.",
+            status=429, retry_after=quota_wait,
+        )
+
+
+def take_user_token(user_key):
+    """Takes a token from the user's bucket, waiting if queued. Raises ChatError(429) if rejected."""
+    admitted, wait = rate_limiter.check_user(user_key)
+    if not admitted:
+        raise ChatError(
+            "You're sending messages too quickly. Please wait a moment and try again.",
+            status=429, retry_after=wait,
+        )
+    if wait:
+        time.sleep(wait)
+
+
+def admit_user(user_email):
+    """Checks the user's quota and takes a token from their bucket. Raises ChatError(429) if rejected."""
+    user_key = request_user(user_email)
+    check_quota(user_key)
+    take_user_token(user_key)
+
+
+def error_response(e):
+    """JSON error response for a ChatError, with Retry-After for rate limits."""
+    response = jsonify({"error": e.message})
+    response.status_code = e.status
+    if e.retry_after is not None:
+        response.headers["Retry-After"] = rate_limiter.retry_after_header(e.retry_after)
+    return response
+
+
+def error_line(e):
+    """In-band NDJSON error for a ChatError raised after streaming started."""
+    line = {"error": e.message}
+    if e.retry_after is not None:
+        line["retry_after"] = int(rate_limiter.retry_after_header(e.retry_after))
+    return line
+# --- END admission control ---
+
+
+# --- Conversation history (see history_store.py) ---
+
+
+def build_messages(user_email, conversation_id, model_name, user_message):
+    """Summary and recent turns within the model's token budget, then the new message (see context_builder.py)."""
+    return context_builder.build(user_email, conversation_id, model_name, user_message)
+
+
+def save_turn(user_email, conversation_id, messages, model_name=None):
+    """Queues messages for the history writer; a no-op for requests without a conversation."""
+    if user_email and conversation_id:
+        history.append(user_email, conversation_id, messages, model=model_name)
+# --- END conversation history ---
+
+
+# --- Response cache (opt-in, see response_cache.py and semantic_cache.py) ---
+# Only first turns are cached or coalesced: with earlier turns in `messages` the answer
+# depends on the conversation. A miss goes through single_flight.py, so concurrent
+# identical prompts share one upstream call; its leader stores the answer.
+
+def cache_lookup(model_name, message, research_mode):
+    """Exact match first, then a reworded prompt from the semantic index. Returns (key, answer or None)."""
+    key = response_cache.make_key(model_name, message, research_mode)
+    if response_cache.cache is not None:
+        cached = response_cache.cache.get(key)
+        if cached is not None:
+            return key, cached
+    if semantic_cache.cache is not None:
+        match = semantic_cache.cache.get(model_name, message, research_mode)
+        if match is not None:
+            return key, match[0]
+    return key, None
+
+
+def cache_store(key, model_name, message, research_mode, text):
+    ttl = providers.cache_ttl(model_name)
+    if response_cache.cache is not None:
+        response_cache.cache.put(key, text, ttl)
+    if semantic_cache.cache is not None:
+        semantic_cache.cache.put(model_name, message, research_mode, text, ttl)
+
+
+def ask_cached(model_name, messages, research_mode):
+    """
+    router.ask_model(), or research.ask_model() in Research Mode, behind the response cache.
+    Returns (answer, cache_hit, answered_by), where answered_by is the model that answered
+    (the chosen one when model_name is "Auto").
+    """
+    ask_model = research.ask_model if research_mode else router.ask_model
+    if len(messages) != 1:
+        ai_response_text, answered_by = ask_model(model_name, messages)
+        return ai_response_text, False, answered_by
+    message = messages[-1]["content"]
+    key, cached = cache_lookup(model_name, message, research_mode)
+    if cached is not None:
+        return cached, True, model_name
+
+    def ask_and_store():
+        ai_response_text, answered_by = ask_model(model_name, messages)
+        if not isinstance(ai_response_text, FallbackText):
+            cache_store(key, model_name, message, research_mode, ai_response_text)
+        return ai_response_text, answered_by
+
+    ai_response_text, answered_by = single_flight.ask(key, ask_and_store)
+    return ai_response_text, False, answered_by
+
+
+def stream_cached(model_name, messages, research_mode):
+    """
+    router.stream_model() behind the response cache. Returns (answered_by, chunks);
+    a hit is sent as a single chunk. In Research Mode, chunks also include the
+    pipeline's progress events (dicts, see research.py).
+    """
+    stream_model = research.stream_model if research_mode else router.stream_model
+    if len(messages) != 1:
+        return stream_model(model_name, messages)
+    message = messages[-1]["content"]
+    key, cached = cache_lookup(model_name, message, research_mode)
+    if cached is not None:
+        return model_name, iter([cached])
+
+    def stream_and_store():
+        answered_by, chunks = stream_model(model_name, messages)
+
+        def store_when_complete():
+            parts, truncated = [], False
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    parts.append(chunk)
+                elif chunk.get("budget_reached"):
+                    truncated = True
+                yield chunk
+            # Only reached if the stream finished without an error or client disconnect;
+            # an empty answer, or a Research Mode answer cut off at its budget, isn't kept
+            text = "".join(parts)
+            if text.strip() and not truncated:
+                cache_store(key, model_name, message, research_mode, text)
+
+        return answered_by, store_when_complete()
+
+    return single_flight.stream(key, stream_and_store)
+
+
+@app.route("/cache_stats", methods=["GET"])
+def get_cache_stats():
+    """Response cache hit/miss and request coalescing counters for this worker process."""
+    return jsonify({
+        **response_cache.stats(),
+        "semantic": semantic_cache.stats(),
+        "single_flight": single_flight.stats(),
+    }), 200
+# --- END response cache ---
+
+
 @app.route("/chat", methods=["POST"])
 def chat():
     data = request.json
@@ -74,108 +299,307 @@ def chat():
     model_name = data.get("model")
     research_mode = data.get("research_mode", False)
     user_email = data.get("user_email")
+    conversation_id = data.get("conversation_id")
 
-    print(f"Processing chat request: Message='{user_message}', Model='{model_name}'")
+    log.info("chat request", extra={"model": model_name, "message_chars": len(user_message or ""), "research_mode": research_mode})
 
     if not user_message:
         return jsonify({"error": "No message provided"}), 400
 
-    ai_response_text = "Sorry, I couldn't get a response."
+    try:
+        admit_user(user_email)
+        messages = build_messages(user_email, conversation_id, model_name, user_message)
+        ai_response_text, cache_hit, answered_by = ask_cached(model_name, messages, research_mode)
+    except ChatError as e:
+        return error_response(e)
 
-    if model_name == "Gemini":
-        if not GEMINI_API_KEY:
-            print("Gemini API Key is missing for this request. Returning 500.")
-            return jsonify({"error": "Gemini API Key is missing. Please set GOOGLE_API_KEY in your .env file."}), 500
-        try:
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            convo = model.start_chat(history=[])
-            gemini_raw_response = convo.send_message(user_message)
+    save_turn(user_email, conversation_id, [messages[-1], {"role": "assistant", "content": ai_response_text}], answered_by)
+    return jsonify({"response": ai_response_text, "cached": cache_hit, "model": answered_by})
 
-            if gemini_raw_response and gemini_raw_response.candidates and gemini_raw_response.candidates[0].content.parts:
-                ai_response_text = gemini_raw_response.candidates[0].content.parts[0].text
-            else:
-                ai_response_text = "Gemini returned an empty or unparseable response. Try again."
-                print(f"DEBUG: Gemini empty/malformed response for: '{user_message}'. Raw: {gemini_raw_response}")
 
-        except Exception as e:
-            error_msg = f"Gemini API error: {str(e)}"
-            print(f"ERROR during Gemini API call: {error_msg}")
-            if "404 models/" in str(e):
-                error_msg += ". Model not found or not available in your region. Check Google Cloud Console."
-            elif "authentication" in str(e).lower() or "api key" in str(e).lower() or "permission" in str(e).lower():
-                error_msg += ". Please check your GOOGLE_API_KEY for validity and permissions."
-            return jsonify({"error": error_msg}), 500
-
-    elif model_name == "DeepSeek (via OpenRouter)":
-        if not OPENROUTER_API_KEY:
-            print("OpenRouter API Key is missing for this request. Returning 500.")
-            return jsonify({"error": "OpenRouter API Key is missing. Please set OPENROUTER_API_KEY in your .env file."}), 500
+# --- Streaming chat: /chat/stream ---
+# Tokens are sent as newline-delimited JSON (NDJSON) so the frontend can render
+# them as soon as they arrive. Each line is one of:
+#   {"model": "<name>"}   the model answering, sent first when "Auto" was requested
+#   {"delta": "<text>"}   a chunk of the answer
+#   {"error": "<msg>"}    the upstream call failed (stream ends after this);
+#                         "retry_after" (seconds) is added when it was rate limited
+#   {"done": true}        the answer is complete
+# In Research Mode, the pipeline's progress lines ({"stage": ...}, see research.py)
+# come before and around the answer's deltas.
+
+def ndjson_line(obj):
+    return json.dumps(obj) + "\n"
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    data = request.json
+    user_message = data.get("message")
+    model_name = data.get("model")
+    research_mode = data.get("research_mode", False)
+    user_email = data.get("user_email")
+    conversation_id = data.get("conversation_id")
+
+    log.info("streaming chat request", extra={"model": model_name, "message_chars": len(user_message or ""), "research_mode": research_mode})
+
+    if not user_message:
+        return jsonify({"error": "No message provided"}), 400
+
+    try:
+        # Unknown model / missing API key / rate limits are reported as a normal JSON error before streaming starts
+        admit_user(user_email)
+        messages = build_messages(user_email, conversation_id, model_name, user_message)
+        answered_by, chunks = stream_cached(model_name, messages, research_mode)
+    except ChatError as e:
+        return error_response(e)
+
+    def generate():
+        # Headers are already sent once streaming starts, so errors are reported in-band.
+        nonlocal answered_by
+        parts = []
+        if answered_by != model_name:
+            yield ndjson_line({"model": answered_by})
         try:
-            headers = {
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "HTTP-Referer": "https://funnx.ai",
-                "X-Title": "FunnX.Ai"
-            }
-            deepseek_url = "https://openrouter.ai/api/v1/chat/completions"
-            payload = {
-                "model": "deepseek/deepseek-r1",
-                "messages": [{"role": "user", "content": user_message}]
-            }
-
-            print(f"DEBUG: Sending request to OpenRouter URL: {deepseek_url}")
-            print(f"DEBUG: OpenRouter Request Headers: {headers}")
-            print(f"DEBUG: OpenRouter Request Payload: {json.dumps(payload, indent=2)}")
-
-            response_from_router = requests.post(deepseek_url, headers=headers, json=payload, timeout=60)
-            response_from_router.raise_for_status()
-
-            deepseek_data = response_from_router.json()
-            print(f"DEBUG: Received raw DeepSeek response (full): {json.dumps(deepseek_data, indent=2)}")
-
-            if deepseek_data and 'choices' in deepseek_data and len(deepseek_data['choices']) > 0 and \
-               'message' in deepseek_data['choices'][0] and 'content' in deepseek_data['choices'][0]['message']:
-                ai_response_text = deepseek_data['choices'][0]['message']['content']
-            else:
-                ai_response_text = "DeepSeek returned an empty or unparseable response. Please try again or select a different model."
-                print(f"WARNING: DeepSeek response was malformed or empty for: '{user_message}'. Full response: {json.dumps(deepseek_data, indent=2)}")
-
-        except requests.exceptions.HTTPError as e:
-            error_body = ""
-            try:
-                error_body = e.response.json()
-                error_body_str = json.dumps(error_body, indent=2)
-            except json.JSONDecodeError:
-                error_body_str = e.response.text
-            error_msg = f"OpenRouter API HTTP error (Status: {e.response.status_code}): {error_body_str}"
-            print(f"ERROR during OpenRouter API call (HTTPError): {error_msg}")
-            if e.response.status_code == 401:
-                error_msg += ". This usually means your OPENROUTER_API_KEY is incorrect or invalid."
-            elif e.response.status_code == 404:
-                error_msg += ". Model not found or incorrect model ID ('deepseek/deepseek-r1'?) on OpenRouter. Check OpenRouter's model list."
-            elif e.response.status_code == 429:
-                error_msg += ". Rate limit exceeded on OpenRouter. Try again after some time."
-            return jsonify({"error": error_msg}), 500
-        except requests.exceptions.ConnectionError:
-            error_msg = "OpenRouter API Connection Error: Backend could not connect to OpenRouter. Check internet."
-            print(f"ERROR: {error_msg}")
-            return jsonify({"error": error_msg}), 500
-        except requests.exceptions.Timeout:
-            error_msg = "OpenRouter API request timed out after 60 seconds. Server might be slow."
-            print(f"ERROR: {error_msg}")
-            return jsonify({"error": error_msg}), 500
+            for chunk in chunks:
+                if isinstance(chunk, dict):
+                    # Research Mode progress, or {"model"} naming the model writing the answer
+                    if "stage" not in chunk:
+                        answered_by = chunk["model"]
+                    yield ndjson_line(chunk)
+                    continue
+                parts.append(chunk)
+                yield ndjson_line({"delta": chunk})
+        except ChatError as e:
+            yield ndjson_line(error_line(e))
+            return
         except Exception as e:
-            error_msg = f"Unexpected DeepSeek API error: {str(e)}"
-            print(f"ERROR during DeepSeek API call (General): {error_msg}")
-            return jsonify({"error": error_msg}), 500
-    else:
-        return jsonify({"error": "Invalid model selected"}), 400
+            log.exception("streaming call failed", extra={"model": model_name})
+            yield ndjson_line({"error": f"{model_name} API error: {str(e)}"})
+            return
+        save_turn(user_email, conversation_id, [messages[-1], {"role": "assistant", "content": "".join(parts)}], answered_by)
+        yield ndjson_line({"done": True})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        # Stop reverse proxies (Render/nginx) from buffering the whole stream
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+    )
+# --- END streaming chat ---
+
+
+# --- Multi-model chat: /chat/multi ---
+# Used by "Try Both": one request from the frontend, providers queried concurrently.
+# Results are streamed as NDJSON in completion order, one line per model:
+#   {"model": "<name>", "response": "<text>", "elapsed_ms": 1234}   (+ "answered_by" for "Auto")
+#   {"model": "<name>", "error": "<msg>", "elapsed_ms": 1234}
+# followed by {"done": true, "elapsed_ms": <total>}. One model failing does not affect the others.
+
+# Shared by all requests in this worker so a burst of "Try Both" calls can't spawn unbounded threads
+MULTI_MAX_WORKERS = int(os.getenv("MULTI_MAX_WORKERS", "8"))
+multi_executor = ThreadPoolExecutor(max_workers=MULTI_MAX_WORKERS, thread_name_prefix="chat-multi")
+
+
+def timed_ask(model_name, messages, research_mode, user_email=None, conversation_id=None):
+    started = time.perf_counter()
+    result = {"model": model_name}
+    try:
+        result["response"], result["cached"], answered_by = ask_cached(model_name, messages, research_mode)
+        if answered_by != model_name:
+            result["answered_by"] = answered_by
+        save_turn(user_email, conversation_id, [{"role": "assistant", "content": result["response"]}], answered_by)
+    except ChatError as e:
+        result.update(error_line(e))
+    except Exception as e:
+        result["error"] = f"Unexpected {model_name} error: {str(e)}"
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000)
+    return result
+
+
+@app.route("/chat/multi", methods=["POST"])
+def chat_multi():
+    data = request.json
+    user_message = data.get("message")
+    models = data.get("models") or []
+    research_mode = data.get("research_mode", False)
+    user_email = data.get("user_email")
+    conversation_id = data.get("conversation_id")
+
+    log.info("multi-model chat request", extra={"models": models, "message_chars": len(user_message or "")})
+
+    if not user_message:
+        return jsonify({"error": "No message provided"}), 400
+    if not isinstance(models, list) or not models:
+        return jsonify({"error": "A non-empty list of models is required"}), 400
+    try:
+        # One user token per "Try Both" turn; each model call is still limited per provider
+        admit_user(user_email)
+    except ChatError as e:
+        return error_response(e)
+
+    started = time.perf_counter()
+    # Deduplicate while keeping order. Each model's context is read before this turn's
+    # user message is queued for saving, so it never appears twice in the prompt.
+    model_messages = {
+        model_name: build_messages(user_email, conversation_id, model_name, user_message)
+        for model_name in dict.fromkeys(models)
+    }
+    save_turn(user_email, conversation_id, [{"role": "user", "content": user_message}])
+    # Submit everything before waiting on anything
+    futures = [
+        multi_executor.submit(structured_logging.in_context(timed_ask), model_name, messages, research_mode, user_email, conversation_id)
+        for model_name, messages in model_messages.items()
+    ]
+
+    def generate():
+        for future in as_completed(futures):
+            yield ndjson_line(future.result())
+        yield ndjson_line({"done": True, "elapsed_ms": round((time.perf_counter() - started) * 1000)})
+
+    return Response(
+        generate(),
+        mimetype="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+    )
+# --- END multi-model chat ---
+
+
+# --- Batch chat: /chat/batch (request/response format in batch_jobs.py) ---
+
+def wait_for_user_token(user_key, stop):
+    """
+    take_user_token() for batch prompts: a full queue paces the batch instead of failing
+    the prompt, so this retries after each Retry-After. False if `stop` was set meanwhile.
+    """
+    while True:
+        try:
+            take_user_token(user_key)
+            return True
+        except ChatError as e:
+            if stop.wait(e.retry_after):
+                return False
+
+
+def batch_worker(user_key, work, results, stop):
+    """Answers prompts from one provider's queue until it is empty or the client has gone."""
+    while not stop.is_set():
+        try:
+            item = work.popleft()
+        except IndexError:
+            return
+        try:
+            # Once the quota is used up, the rest of the batch fails fast with 429 error lines
+            check_quota(user_key)
+        except ChatError as e:
+            results.put({"id": item["id"], "model": item["model"], **error_line(e), "elapsed_ms": 0})
+            continue
+        if not wait_for_user_token(user_key, stop):
+            return
+        result = timed_ask(item["model"], [{"role": "user", "content": item["message"]}], item["research_mode"])
+        results.put({"id": item["id"], **result})
+
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    try:
+        user_key = request_user(request.args.get("user_email"))
+        check_quota(user_key)
+        items, invalid = batch_jobs.parse_items(request.get_data(as_text=True), request.args.get("model"))
+    except ChatError as e:
+        return error_response(e)
+
+    log.info("batch chat request", extra={"prompts": len(items), "invalid": len(invalid)})
+    started = time.perf_counter()
+    queues = batch_jobs.queues_by_provider(items)
+    results = queue.Queue()
+    stop = threading.Event()
+    workers = sum(min(batch_jobs.BATCH_CONCURRENCY, len(work)) for work in queues.values())
+    # Per-batch threads: BATCH_CONCURRENCY per provider, released when the batch ends
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="chat-batch")
+    for work in queues.values():
+        for _ in range(min(batch_jobs.BATCH_CONCURRENCY, len(work))):
+            executor.submit(structured_logging.in_context(batch_worker), user_key, work, results, stop)
+
+    def generate():
+        failed = len(invalid)
+        try:
+            for line in invalid:
+                yield ndjson_line(line)
+            for _ in items:
+                result = results.get()
+                failed += "error" in result
+                yield ndjson_line(result)
+            elapsed_ms = round((time.perf_counter() - started) * 1000)
+            yield ndjson_line(batch_jobs.done_line(len(items) + len(invalid), failed, elapsed_ms))
+        finally:
+            # Also reached when the client disconnects: don't start prompts nobody will read
+            stop.set()
+            executor.shutdown(wait=False)
+
+    return Response(
+        generate(),
+        mimetype="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+    )
+# --- END batch chat ---
+
+
+@app.route("/models", methods=["GET"])
+def list_models():
+    """Model names the frontend can offer, in configuration order. "Auto" (router.py) is always accepted too."""
+    return jsonify({"models": providers.model_names()}), 200
+
+
+# --- Usage report: /admin/usage (see usage.py) ---
+# GET /admin/usage?window=1h,24h&limit=10 with "Authorization: Bearer <ADMIN_TOKEN>".
+# Per window: totals, plus the top users and models by estimated cost, then tokens.
+
+@app.route("/admin/usage", methods=["GET"])
+def admin_usage():
+    if usage.ledger is None or not usage.ADMIN_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if not usage.is_admin(request.headers.get("Authorization")):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        windows = usage.parse_windows(request.args.get("window"))
+        limit = int(request.args.get("limit", "10"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"windows": usage.report(windows, limit)}), 200
+# --- END usage report ---
 
-    return jsonify({"response": ai_response_text})
 
 @app.route("/get_history", methods=["POST"])
 def get_history():
-    """Returns an empty history, as database is not used."""
-    return jsonify({"history": []})
+    """
+    With a conversation_id: one page of that conversation, oldest first. Pass the returned
+    next_cursor as "before" to get the page preceding it (null when there are no older messages).
+    Without one: the user's most recently updated conversations.
+    Needs "Authorization: Bearer <token>" with the token /login gave that user, or ADMIN_TOKEN.
+    """
+    data = request.json or {}
+    user_email = data.get("user_email")
+    conversation_id = data.get("conversation_id")
+    if not user_email:
+        return jsonify({"error": "user_email is required"}), 400
+    if not auth.can_read_history(request.headers.get("Authorization"), user_email):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if not conversation_id:
+        return jsonify({"history": [], "conversations": history.conversations(user_email)})
+
+    try:
+        before = int(data["before"]) if data.get("before") is not None else None
+        limit = int(data.get("limit", HISTORY_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({"error": "before and limit must be integers"}), 400
+
+    messages, next_cursor = history.page(user_email, conversation_id, before=before, limit=limit)
+    return jsonify({"history": messages, "next_cursor": next_cursor})
+
+boot.record_import("api", time.perf_counter() - IMPORT_STARTED)
 
 if __name__ == "__main__":
+    boot.start_warm_up()
     app.run(debug=True)
\ No newline at end of file
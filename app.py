@@ -3,30 +3,75 @@ import streamlit as st
 import requests
 import os
 from dotenv import load_dotenv
-import time # Added for sleep
+import time
+import json
+import zlib
+import uuid
+import logging
+import threading
+from http_client import get_session
+import structured_logging
 
 # Load environment variables
 load_dotenv()
+# JSON log lines written by a background thread; each backend call gets a request ID
+# (sent as X-Request-ID) that the backend's log lines for that call also carry.
+structured_logging.setup()
+log = logging.getLogger("app")
 # Ensure this URL is correct. It should be the same as your Flask app's default.
 
 FLASK_API_URL = "https://funnx-ai-backend.onrender.com" # Your backend URL
 
-# --- NEW: Function to ping backend and activate it ---
+# Keep-alive session shared by all Streamlit sessions in this process.
+# The backend returns 500 for provider errors, so only retry gateway/cold-start statuses,
+# which Render's proxy sends before the request reaches a worker; POSTs are retried on
+# those too. Not 429: that is the user's rate limit or quota, and a retry would be charged again.
+def backend_session():
+    return get_session("backend", retry_statuses=(502, 503, 504), retry_methods=("GET", "POST"))
+
+# --- Backend wake-up ---
+# A sleeping backend (Render free tier) takes a while to start. The wake-up runs on a
+# background thread, shared by all sessions through st.cache_resource, so no session
+# waits for it: it polls /ready until the backend has warmed up its providers.
+# Recreated after WAKE_UP_TTL seconds, so the first visit after a long idle wakes it again.
+WAKE_UP_TIMEOUT = 120   # seconds to keep polling a backend that doesn't answer
+WAKE_UP_TTL = 600
+
+
 def ping_backend():
-    ping_url = f"{FLASK_API_URL}/ping"
+    """True once the backend answers /ready with 200 (alive and warmed up)."""
     try:
-        # print(f"Pinging backend at: {ping_url}") # Uncomment for local debugging
-        response = requests.get(ping_url, timeout=5) # Short timeout
+        response = backend_session().get(f"{FLASK_API_URL}/ready", timeout=5) # Short timeout
         if response.status_code == 200:
-            print("Backend ping successful!")
-            st.session_state.backend_active = True
-        else:
-            print(f"Backend ping failed with status: {response.status_code}")
+            log.info("backend ready")
+            return True
+        log.info("backend not ready yet", extra={"status": response.status_code})
     except requests.exceptions.Timeout:
-        print("Backend ping timed out. It might be waking up.")
+        log.info("backend ping timed out, it might be waking up")
     except requests.exceptions.RequestException as e:
-        print(f"An error occurred during backend ping: {e}")
-# --- END NEW FUNCTION ---
+        log.warning("backend ping failed", extra={"error": str(e)})
+    return False
+
+
+class BackendWakeUp:
+    def __init__(self):
+        self.ready = False
+        self.done = False
+        threading.Thread(target=self.run, name="backend-wake-up", daemon=True).start()
+
+    def run(self):
+        deadline = time.monotonic() + WAKE_UP_TIMEOUT
+        while not self.ready and time.monotonic() < deadline:
+            self.ready = ping_backend()
+            if not self.ready:
+                time.sleep(2)
+        self.done = True
+
+
+@st.cache_resource(ttl=WAKE_UP_TTL, show_spinner=False)
+def wake_backend():
+    return BackendWakeUp()
+# --- END backend wake-up ---
 
 
 # Set Streamlit page configuration
@@ -37,35 +82,58 @@ if "authenticated" not in st.session_state:
     st.session_state["authenticated"] = False
 if "user_email" not in st.session_state:
     st.session_state["user_email"] = ""
+if "api_token" not in st.session_state: # From /login; lets the backend return this user's saved conversations
+    st.session_state["api_token"] = ""
 if "page" not in st.session_state:
     st.session_state["page"] = "home" # Default page if not authenticated
 if "messages" not in st.session_state: # Initialize chat messages for the session
     st.session_state["messages"] = []
-if 'backend_active' not in st.session_state: # NEW: Flag to track backend activation
-    st.session_state.backend_active = False
+if "conversation_id" not in st.session_state: # Key for this chat in the backend's history store
+    st.session_state["conversation_id"] = uuid.uuid4().hex
 
 
-# --- NEW: Backend Wake-up Logic on app load ---
-if not st.session_state.backend_active:
+# Starts the wake-up on the first visit and returns immediately; the banner shows until it's done
+if not wake_backend().done:
     st.info("Warming up the AI brain... This might take a moment if it's the first visit after inactivity.")
-    ping_backend()
-    time.sleep(1) # Give the ping a moment to be sent
-    # st.rerun() # You could uncomment this if you want an immediate re-run to update UI, but might cause flickering.
-# --- END NEW WAKE-UP LOGIC ---
+
+
+# Used when the backend's /models list can't be fetched
+DEFAULT_MODELS = ("Gemini", "DeepSeek (via OpenRouter)")
+
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_models():
+    """Model names configured on the backend (providers.py), cached for all sessions."""
+    try:
+        response = backend_session().get(f"{FLASK_API_URL}/models", timeout=5)
+        response.raise_for_status()
+        return tuple(response.json()["models"]) or DEFAULT_MODELS
+    except (requests.exceptions.RequestException, KeyError, ValueError):
+        return DEFAULT_MODELS
 
 
 # --- Helper Function: Call Flask API ---
+def backend_headers(request_id):
+    headers = {"X-Request-ID": request_id}
+    if st.session_state.get("api_token"):
+        headers["Authorization"] = f"Bearer {st.session_state['api_token']}"
+    return headers
+
+
 def call_flask_api(endpoint, data):
+    # Quoted in error messages so a failure can be found in the backend's logs
+    request_id = structured_logging.set_request_id()
     try:
-        # Added a timeout to prevent infinite waiting
-        response = requests.post(f"{FLASK_API_URL}/{endpoint}", json=data, timeout=30)
+        # Session default (connect, read) timeout prevents infinite waiting
+        response = backend_session().post(f"{FLASK_API_URL}/{endpoint}", json=data, headers=backend_headers(request_id))
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
         return response.json()
     except requests.exceptions.ConnectionError:
+        log.warning("backend not reachable", extra={"endpoint": endpoint})
         st.error(f"Backend at {FLASK_API_URL} not running or reachable. Please start your Flask backend (`python api.py`).")
         return {"error": "Backend not reachable."}
     except requests.exceptions.Timeout:
-        st.error(f"Backend request timed out. The server might be slow or unresponsive. (URL: {FLASK_API_URL}/{endpoint})")
+        log.warning("backend request timed out", extra={"endpoint": endpoint})
+        st.error(f"Backend request timed out. The server might be slow or unresponsive. (URL: {FLASK_API_URL}/{endpoint}, request ID {request_id})")
         return {"error": "Request timed out."}
     except requests.exceptions.HTTPError as e:
         error_details = {}
@@ -76,12 +144,195 @@ def call_flask_api(endpoint, data):
             # If not JSON, use raw text
             error_details = {"message": e.response.text}
 
-        st.error(f"Backend returned an error: {e.response.status_code} - {error_details.get('error', error_details.get('message', 'Unknown backend error'))}")
+        message = error_details.get('error', error_details.get('message', 'Unknown backend error'))
+        log.warning("backend returned an error", extra={"endpoint": endpoint, "status": e.response.status_code, "error": message})
+        st.error(f"Backend returned an error: {e.response.status_code} - {message} (request ID {request_id})")
         return {"error": str(e)}
     except Exception as e:
-        st.error(f"An unexpected error occurred while calling the backend: {e}")
+        log.exception("backend call failed", extra={"endpoint": endpoint})
+        st.error(f"An unexpected error occurred while calling the backend: {e} (request ID {request_id})")
         return {"error": str(e)}
 
+# --- Helper Functions: Streaming (NDJSON) Flask API calls ---
+def iter_flask_ndjson(endpoint, data, errors):
+    """
+    Yields parsed events from an NDJSON streaming endpoint (chat/stream, chat/multi).
+    Transport errors are appended to `errors` instead of raised, so the caller
+    can tell a failed stream apart from an empty answer.
+    """
+    request_id = structured_logging.set_request_id()
+    try:
+        # The session's read timeout applies between lines, not to the whole answer
+        with backend_session().post(f"{FLASK_API_URL}/{endpoint}", json=data, stream=True,
+                                    headers=backend_headers(request_id)) as response:
+            if response.status_code != 200:
+                try:
+                    errors.append(response.json().get("error", response.text))
+                except requests.exceptions.JSONDecodeError:
+                    errors.append(response.text)
+                log.warning("backend returned an error", extra={"endpoint": endpoint, "status": response.status_code, "error": errors[-1]})
+                return
+            for line in response.iter_lines(decode_unicode=True):
+                if line:
+                    yield json.loads(line)
+    except requests.exceptions.ConnectionError:
+        log.warning("backend not reachable", extra={"endpoint": endpoint})
+        errors.append(f"Backend at {FLASK_API_URL} not running or reachable.")
+    except requests.exceptions.Timeout:
+        log.warning("backend stream timed out", extra={"endpoint": endpoint})
+        errors.append(f"Backend stream timed out. (URL: {FLASK_API_URL}/{endpoint}, request ID {request_id})")
+    except Exception as e:
+        log.exception("backend stream failed", extra={"endpoint": endpoint})
+        errors.append(f"An unexpected error occurred while streaming from the backend: {e} (request ID {request_id})")
+
+def show_research_stage(status, event):
+    """Shows a Research Mode progress event in an st.status box."""
+    stage = event["stage"]
+    if stage == "plan":
+        status.update(label="Researching...")
+        if event.get("error"):
+            status.caption(f"Couldn't split the question ({event['error']}); answering it directly.")
+        elif len(event["sub_questions"]) > 1:
+            status.markdown("\n".join(f"- {q}" for q in event["sub_questions"]))
+    elif stage == "research":
+        if "answer" in event:
+            status.caption(f"✓ {event['sub_question']} ({event['model']}, {event['elapsed_ms'] / 1000:.1f}s)")
+        else:
+            status.caption(f"✗ {event['sub_question']} ({event['model']}: {event['error']})")
+    elif stage == "synthesize":
+        status.update(label="Writing the answer...")
+    elif stage == "done":
+        label = f"Researched in {event['elapsed_ms'] / 1000:.1f}s, {event['tokens']:,} tokens"
+        if event["budget_reached"]:
+            label += " (budget reached, answer cut short)"
+        status.update(label=label, state="complete")
+
+def stream_flask_api(endpoint, data, errors, route=None, status=None):
+    """
+    Yields the text chunks of a chat/stream answer. For "Auto", route["model"] is set to the answering model.
+    Research Mode progress is shown in `status` (an st.status box) when given.
+    """
+    for event in iter_flask_ndjson(endpoint, data, errors):
+        if "delta" in event:
+            yield event["delta"]
+        elif "stage" in event:
+            if status is not None:
+                show_research_stage(status, event)
+            if route is not None and event["stage"] == "done":
+                route["research"] = event
+        elif "model" in event:
+            if route is not None:
+                route["model"] = event["model"]
+        elif "error" in event:
+            errors.append(event["error"])
+            return
+        elif event.get("done"):
+            return
+
+def history_to_messages(history):
+    """Converts /get_history messages to the chat view's format."""
+    # Label answers with their model when the page has answers from more than one ("Try Both")
+    models = {m["model"] for m in history if m["role"] == "assistant"}
+    labelled = len(models) > 1
+    messages = []
+    for m in history:
+        content = m["content"]
+        if labelled and m["role"] == "assistant" and m["model"]:
+            content = f"**{m['model']}:** {content}"
+        messages.append({"role": m["role"], "content": content})
+    return messages
+
+# --- Chat view ---
+# Only the newest CHAT_PAGE_SIZE messages are rendered; "Load earlier messages" shows another
+# page, fetching older pages of a saved conversation from /get_history when the session has
+# none left. st.session_state["messages"] holds the newest messages; older ones are moved
+# into zlib-compressed blocks (st.session_state["message_blocks"], oldest first), so a long
+# session's state stays small and each rerun renders the same number of messages however
+# long the conversation is. Decompressed blocks are cached for all sessions.
+CHAT_PAGE_SIZE = 20      # messages shown at first, and added by each "Load earlier messages"
+CHAT_LIVE_MESSAGES = 40  # newest messages kept uncompressed
+CHAT_BLOCK_SIZE = 20     # messages per compressed block
+
+
+def compress_messages(messages):
+    return zlib.compress(json.dumps(messages, separators=(",", ":")).encode("utf-8"))
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def decompress_block(block):
+    return json.loads(zlib.decompress(block))
+
+
+def reset_messages(messages=(), history_cursor=None):
+    """Starts the chat view over with `messages`; history_cursor is /get_history's next_cursor for older ones."""
+    st.session_state["messages"] = list(messages)
+    st.session_state["message_blocks"] = []
+    st.session_state["history_cursor"] = history_cursor
+    st.session_state["visible_messages"] = CHAT_PAGE_SIZE
+    archive_messages()
+
+
+def add_message(role, content):
+    st.session_state["messages"].append({"role": role, "content": content})
+    archive_messages()
+
+
+def archive_messages():
+    """Compresses all but the newest CHAT_LIVE_MESSAGES, a block at a time."""
+    messages = st.session_state["messages"]
+    while len(messages) >= CHAT_LIVE_MESSAGES + CHAT_BLOCK_SIZE:
+        st.session_state["message_blocks"].append((CHAT_BLOCK_SIZE, compress_messages(messages[:CHAT_BLOCK_SIZE])))
+        del messages[:CHAT_BLOCK_SIZE]
+
+
+def stored_message_count():
+    return sum(count for count, _ in st.session_state["message_blocks"]) + len(st.session_state["messages"])
+
+
+def newest_messages(count):
+    """The newest `count` messages, decompressing only the blocks they reach into."""
+    messages = list(st.session_state["messages"])
+    blocks = st.session_state["message_blocks"]
+    index = len(blocks)
+    while len(messages) < count and index > 0:
+        index -= 1
+        messages = decompress_block(blocks[index][1]) + messages
+    return messages[-count:]
+
+
+def load_earlier_messages():
+    """Shows another page, first fetching an older page of the saved conversation if needed."""
+    wanted = st.session_state["visible_messages"] + CHAT_PAGE_SIZE
+    if wanted > stored_message_count() and st.session_state["history_cursor"] is not None:
+        page = call_flask_api("get_history", {
+            "user_email": st.session_state["user_email"],
+            "conversation_id": st.session_state["conversation_id"],
+            "before": st.session_state["history_cursor"],
+            "limit": CHAT_PAGE_SIZE,
+        })
+        if page and "history" in page:
+            older = history_to_messages(page["history"])
+            if older:
+                st.session_state["message_blocks"].insert(0, (len(older), compress_messages(older)))
+            st.session_state["history_cursor"] = page.get("next_cursor")
+    st.session_state["visible_messages"] = wanted
+
+
+@st.fragment
+def show_messages():
+    """The chat history. A fragment: "Load earlier messages" reruns only this part of the page."""
+    if stored_message_count() > st.session_state["visible_messages"] or st.session_state["history_cursor"] is not None:
+        # A callback, so the messages below already include the new page
+        st.button("Load earlier messages", key="load_earlier_messages", on_click=load_earlier_messages)
+    for message in newest_messages(min(st.session_state["visible_messages"], stored_message_count())):
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+
+if "message_blocks" not in st.session_state:
+    reset_messages(st.session_state["messages"])
+# --- END chat view ---
+
 # --- Inject Custom CSS (Permanent Dark Mode & Chat Bubbles) ---
 # st.markdown(
 #     """
@@ -170,6 +421,7 @@ def show_login(): # Renamed the function
         if response and "success" in response:
             st.session_state["authenticated"] = True
             st.session_state["user_email"] = login_email
+            st.session_state["api_token"] = response.get("token", "")
             st.session_state["page"] = "chat"
             st.success("Logged in successfully!")
             st.rerun()
@@ -179,11 +431,18 @@ def show_login(): # Renamed the function
     st.markdown("---")
     st.subheader("Or Login with Google")
     if st.button("Sign In with Google", use_container_width=True, help="Note: This is a simulated Google Sign-in."):
-        st.session_state["authenticated"] = True
-        st.session_state["user_email"] = "google_user@example.com" # Default email for simulated Google login
-        st.session_state["page"] = "chat"
-        st.success("Simulated Google Sign-In successful!")
-        st.rerun()
+        google_email = "google_user@example.com" # Default email for simulated Google login
+        # Through /login too, for the token that unlocks the saved conversations
+        response = call_flask_api("login", {"email": google_email, "password": "simulated-google-sign-in"})
+        if response and "success" in response:
+            st.session_state["authenticated"] = True
+            st.session_state["user_email"] = google_email
+            st.session_state["api_token"] = response.get("token", "")
+            st.session_state["page"] = "chat"
+            st.success("Simulated Google Sign-In successful!")
+            st.rerun()
+        else:
+            st.error(f"Google Sign-In failed: {response.get('error', 'Unknown error')}")
 
 # --- Main App Logic (After Authentication) ---
 if not st.session_state["authenticated"]:
@@ -204,8 +463,10 @@ else:
     if st.sidebar.button("Logout"):
         st.session_state["authenticated"] = False
         st.session_state["user_email"] = ""
+        st.session_state["api_token"] = ""
         st.session_state["page"] = "home"
-        st.session_state["messages"] = []
+        reset_messages()
+        st.session_state["conversation_id"] = uuid.uuid4().hex
         st.info("You have been logged out.")
         st.rerun()
 
@@ -217,6 +478,11 @@ else:
     if st.sidebar.button("Chat", key="nav_chat"):
         st.session_state["page"] = "chat"
         st.rerun()
+    if st.sidebar.button("New Chat", key="nav_new_chat"):
+        reset_messages()
+        st.session_state["conversation_id"] = uuid.uuid4().hex
+        st.session_state["page"] = "chat"
+        st.rerun()
 
     # --- Page Content Based on Navigation ---
     if st.session_state["page"] == "home":
@@ -224,7 +490,22 @@ else:
         st.write("This is your FunnX.Ai dashboard.")
 
         st.subheader("Your Recent Conversations")
-        st.info("No persistent chat history available. Start a new chat!")
+        recent = call_flask_api("get_history", {"user_email": st.session_state["user_email"]})
+        conversations = recent.get("conversations", []) if recent else []
+        if not conversations:
+            st.info("No chat history yet. Start a new chat!")
+        for conversation in conversations:
+            if st.button(conversation["title"], key=f"open_{conversation['conversation_id']}", use_container_width=True):
+                # Load the latest page of the conversation and continue it
+                page = call_flask_api("get_history", {
+                    "user_email": st.session_state["user_email"],
+                    "conversation_id": conversation["conversation_id"],
+                })
+                if page and "history" in page:
+                    st.session_state["conversation_id"] = conversation["conversation_id"]
+                    reset_messages(history_to_messages(page["history"]), page.get("next_cursor"))
+                    st.session_state["page"] = "chat"
+                    st.rerun()
 
         st.image("https://images.unsplash.com/photo-1510519159390-e4b77f924747?q=80&w=2940&auto=format&fit=crop&ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D", caption="AI Powered Conversations", use_container_width=True)
 
@@ -232,27 +513,28 @@ else:
         st.title("AI Chat Platform")
         st.write("Choose your model and start chatting!")
 
-        for message in st.session_state["messages"]:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+        show_messages()
 
         col_res, col_model = st.columns([1, 1])
 
         with col_res:
             research_mode = st.toggle("Enable Research Mode (Deep Answers)", key="research_mode_toggle")
             st.markdown(
-                '<small style="color: gray;">Research mode provides more detailed AI responses.</small>',
+                '<small style="color: gray;">Research mode splits your question into parts, researches them '
+                'across the available models, then writes one detailed answer.</small>',
                 unsafe_allow_html=True
             )
 
         with col_model:
             selected_model_option = st.selectbox(
                 "Select AI Model:",
-                ("Gemini", "DeepSeek (via OpenRouter)", "Try Both"),
+                (*fetch_models(), "Auto", "Try Both"),
                 key="model_selector_dropdown"
             )
             if selected_model_option == "Try Both":
                 st.info("Try Both mode displays responses from Gemini and DeepSeek simultaneously.")
+            elif selected_model_option == "Auto":
+                st.info("Auto mode sends each message to whichever model is answering fastest right now.")
 
         # --- OLD: user_input = st.chat_input("Type your message here...")
         # --- NEW: Replaced st.chat_input with st.text_input and a button for mobile compatibility ---
@@ -269,65 +551,84 @@ else:
         # --- Now, modify the condition that triggers the AI response: ---
         # It should be 'if user_input and send_button:'
         if user_input and send_button: # Only process if user typed and clicked send
-            st.session_state["messages"].append({"role": "user", "content": user_input})
+            add_message("user", user_input)
             with st.chat_message("user"):
                 st.markdown(user_input)
 
             with st.spinner("Getting response..."):
                 if selected_model_option == "Try Both":
-                    ai_response_col1, ai_response_col2 = st.columns(2)
-
-                    with ai_response_col1:
-                        st.subheader("Gemini's Response:")
-                        chat_data_gemini = {
-                            "message": user_input,
-                            "model": "Gemini",
-                            "research_mode": research_mode,
-                            "user_email": st.session_state["user_email"]
-                        }
-                        response_gemini = call_flask_api("chat", chat_data_gemini)
-                        if response_gemini and "response" in response_gemini:
-                            gemini_response_content = response_gemini["response"]
-                            st.markdown(gemini_response_content)
-                            st.session_state["messages"].append({"role": "assistant", "content": f"**Gemini:** {gemini_response_content}"})
-                        else:
-                            st.error("Failed to get Gemini response.")
-                            st.session_state["messages"].append({"role": "assistant", "content": "Error: Gemini response failed."})
-
-                    with ai_response_col2:
-                        st.subheader("DeepSeek's Response:")
-                        chat_data_deepseek = {
-                            "message": user_input,
-                            "model": "DeepSeek (via OpenRouter)",
-                            "research_mode": research_mode,
-                            "user_email": st.session_state["user_email"]
-                        }
-                        response_deepseek = call_flask_api("chat", chat_data_deepseek)
-                        if response_deepseek and "response" in response_deepseek:
-                            deepseek_response_content = response_deepseek["response"]
-                            st.markdown(deepseek_response_content)
-                            st.session_state["messages"].append({"role": "assistant", "content": f"**DeepSeek:** {deepseek_response_content}"})
+                    # One backend round trip; the backend queries both models concurrently
+                    # and sends each result as soon as that model finishes.
+                    both_models = {
+                        "Gemini": "Gemini",
+                        "DeepSeek (via OpenRouter)": "DeepSeek",
+                    }
+                    placeholders = {}
+                    for column, (model_name, label) in zip(st.columns(2), both_models.items()):
+                        with column:
+                            st.subheader(f"{label}'s Response:")
+                            placeholders[model_name] = st.empty()
+                            placeholders[model_name].caption(f"Waiting for {label}...")
+
+                    chat_data_multi = {
+                        "message": user_input,
+                        "models": list(both_models),
+                        "research_mode": research_mode,
+                        "user_email": st.session_state["user_email"],
+                        "conversation_id": st.session_state["conversation_id"]
+                    }
+                    stream_errors = []
+                    results = {}
+                    for event in iter_flask_ndjson("chat/multi", chat_data_multi, stream_errors):
+                        model_name = event.get("model")
+                        if model_name not in placeholders:
+                            continue
+                        results[model_name] = event
+                        with placeholders[model_name].container():
+                            if "response" in event:
+                                st.markdown(event["response"])
+                                st.caption(f"{event['elapsed_ms'] / 1000:.1f}s")
+                            else:
+                                st.error(f"Failed to get {both_models[model_name]} response: {event.get('error')}")
+
+                    if stream_errors:
+                        st.error(f"Backend returned an error: {stream_errors[0]}")
+
+                    # Keep the history order stable regardless of which model finished first
+                    for model_name, label in both_models.items():
+                        result = results.get(model_name, {})
+                        if "response" in result:
+                            add_message("assistant", f"**{label}:** {result['response']}")
                         else:
-                            st.error("Failed to get DeepSeek response.")
-                            st.session_state["messages"].append({"role": "assistant", "content": "Error: DeepSeek response failed."})
+                            add_message("assistant", f"Error: {label} response failed.")
 
                 else:
                     chat_data = {
                         "message": user_input,
                         "model": selected_model_option,
                         "research_mode": research_mode,
-                        "user_email": st.session_state["user_email"]
+                        "user_email": st.session_state["user_email"],
+                        "conversation_id": st.session_state["conversation_id"]
                     }
-                    flask_response = call_flask_api("chat", chat_data)
-
-                    if flask_response and "response" in flask_response:
-                        ai_response_content = flask_response["response"]
-                        st.session_state["messages"].append({"role": "assistant", "content": ai_response_content})
-                        with st.chat_message("assistant"):
-                            st.markdown(ai_response_content)
+                    # Render tokens as they arrive instead of waiting for the full answer
+                    stream_errors = []
+                    route = {}
+                    with st.chat_message("assistant"):
+                        status = st.status("Planning the research...") if research_mode else None
+                        ai_response_content = st.write_stream(stream_flask_api("chat/stream", chat_data, stream_errors, route, status))
+                        if status is not None and stream_errors:
+                            status.update(label="Research failed", state="error")
+                        elif status is not None and "research" not in route:
+                            # Cached answers come back without research progress
+                            status.update(label="Answered from an earlier research result", state="complete")
+                        if "model" in route:
+                            st.caption(f"Answered by {route['model']}")
+
+                    if stream_errors:
+                        st.error(f"Failed to get AI response from backend: {stream_errors[0]}")
+                        add_message("assistant", "Error: Could not get response.")
                     else:
-                        st.error("Failed to get AI response from backend.")
-                        st.session_state["messages"].append({"role": "assistant", "content": "Error: Could not get response."})
+                        add_message("assistant", ai_response_content)
             st.rerun() # This will clear the input box and re-render the chat
         # --- END NEW TRIGGER CONDITION ---
 
@@ -0,0 +1,553 @@
+# FunnX.Ai/asgi.py
+# Async (ASGI) serving mode for the chat backend.
+#
+# Serves the same endpoints and JSON/NDJSON formats as api.py, but provider calls
+# are awaited (httpx for OpenAI-compatible providers, generate_content_async for
+# Gemini) instead of blocking a worker thread. One process can then hold hundreds
+# of chats that are mostly waiting on the provider.
+#
+# Enable with SERVER_MODE=async (gunicorn.conf.py switches to uvicorn workers),
+# or run directly: uvicorn asgi:app --port 5000
+import time
+IMPORT_STARTED = time.perf_counter()  # for the import-time budget (boot.py)
+import os
+import json
+import logging
+import asyncio
+import contextlib
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Load environment variables before providers.py reads MODELS_CONFIG
+load_dotenv()
+# JSON log lines written by a background thread (see structured_logging.py)
+import structured_logging
+structured_logging.setup()
+log = logging.getLogger("asgi")
+
+import providers
+from providers import ChatError, FallbackText
+import response_cache
+import semantic_cache
+import single_flight
+import research
+from history_store import store as history, HISTORY_PAGE_SIZE
+import context_builder
+from http_client import pool_stats
+import metrics
+import rate_limiter
+import router
+import batch_jobs
+import boot
+import usage
+import auth
+
+NDJSON_HEADERS = {"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+
+
+def ndjson_line(obj):
+    return json.dumps(obj) + "\n"
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except json.JSONDecodeError:
+        return None
+
+
+# --- Admission control ---
+
+def request_user(request, user_email):
+    """Like api.request_user()."""
+    client = request.headers.get("x-forwarded-for", request.client.host if request.client else "").split(",")[0].strip()
+    user_key = user_email or client
+    usage.set_user(user_key)
+    return user_key
+
+
+def check_quota(user_key):
+    # In-memory counters only, so it stays on the event loop
+    within_quota, quota_wait = usage.check_quota(user_key)
+    if not within_quota:
+        raise ChatError(
+            "You've used up your usage quota for now. Please try again later.",
+            status=429, retry_after=quota_wait,
+        )
+
+
+async def take_user_token(user_key):
+    """Like api.take_user_token(); the SQLite bucket update runs off the event loop."""
+    admitted, wait = await asyncio.to_thread(rate_limiter.check_user, user_key)
+    if not admitted:
+        raise ChatError(
+            "You're sending messages too quickly. Please wait a moment and try again.",
+            status=429, retry_after=wait,
+        )
+    if wait:
+        await asyncio.sleep(wait)
+
+
+async def wait_for_user_token(user_key):
+    """Like api.wait_for_user_token(); cancelled with the batch when the client goes away."""
+    while True:
+        try:
+            await take_user_token(user_key)
+            return
+        except ChatError as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def admit_user(request, user_email):
+    """Like api.admit_user()."""
+    user_key = request_user(request, user_email)
+    check_quota(user_key)
+    await take_user_token(user_key)
+
+
+def error_response(e):
+    headers = {"Retry-After": rate_limiter.retry_after_header(e.retry_after)} if e.retry_after is not None else None
+    return JSONResponse({"error": e.message}, status_code=e.status, headers=headers)
+
+
+def error_line(e):
+    line = {"error": e.message}
+    if e.retry_after is not None:
+        line["retry_after"] = int(rate_limiter.retry_after_header(e.retry_after))
+    return line
+
+
+# --- Conversation history ---
+# SQLite reads run off the event loop; appends are already queued to a writer thread.
+
+async def build_messages(user_email, conversation_id, model_name, user_message):
+    """Like api.build_messages()."""
+    if not (user_email and conversation_id):
+        return [{"role": "user", "content": user_message}]
+    return await asyncio.to_thread(context_builder.build, user_email, conversation_id, model_name, user_message)
+
+
+def save_turn(user_email, conversation_id, messages, model_name=None):
+    if user_email and conversation_id:
+        history.append(user_email, conversation_id, messages, model=model_name)
+
+
+# --- Response cache ---
+# The memory tier is a dict lookup; the SQLite tier touches disk and a semantic lookup
+# is a NumPy product over the index, so those run off the event loop.
+# Only first turns are cached or coalesced (single_flight.py), as in api.py.
+
+async def cache_lookup(model_name, message, research_mode):
+    """Returns (key, answer or None), like api.cache_lookup()."""
+    key = response_cache.make_key(model_name, message, research_mode)
+    if response_cache.cache is not None:
+        if response_cache.cache.shared is None:
+            cached = response_cache.cache.get(key)
+        else:
+            cached = await asyncio.to_thread(response_cache.cache.get, key)
+        if cached is not None:
+            return key, cached
+    if semantic_cache.cache is not None:
+        match = await asyncio.to_thread(semantic_cache.cache.get, model_name, message, research_mode)
+        if match is not None:
+            return key, match[0]
+    return key, None
+
+
+async def cache_store(key, model_name, message, research_mode, text):
+    ttl = providers.cache_ttl(model_name)
+    if response_cache.cache is not None:
+        if response_cache.cache.shared is None:
+            response_cache.cache.put(key, text, ttl)
+        else:
+            await asyncio.to_thread(response_cache.cache.put, key, text, ttl)
+    if semantic_cache.cache is not None:
+        await asyncio.to_thread(semantic_cache.cache.put, model_name, message, research_mode, text, ttl)
+
+
+async def ask_cached(model_name, messages, research_mode):
+    """Returns (answer, cache_hit, answered_by), like api.ask_cached()."""
+    aask_model = research.aask_model if research_mode else router.aask_model
+    if len(messages) != 1:
+        ai_response_text, answered_by = await aask_model(model_name, messages)
+        return ai_response_text, False, answered_by
+    message = messages[-1]["content"]
+    key, cached = await cache_lookup(model_name, message, research_mode)
+    if cached is not None:
+        return cached, True, model_name
+
+    async def ask_and_store():
+        ai_response_text, answered_by = await aask_model(model_name, messages)
+        if not isinstance(ai_response_text, FallbackText):
+            await cache_store(key, model_name, message, research_mode, ai_response_text)
+        return ai_response_text, answered_by
+
+    ai_response_text, answered_by = await single_flight.aask(key, ask_and_store)
+    return ai_response_text, False, answered_by
+
+
+async def stream_cached(model_name, messages, research_mode):
+    """Returns (answered_by, async iterator of answer chunks), like api.stream_cached()."""
+    astream_model = research.astream_model if research_mode else router.astream_model
+    if len(messages) != 1:
+        return await astream_model(model_name, messages)
+    message = messages[-1]["content"]
+    key, cached = await cache_lookup(model_name, message, research_mode)
+    if cached is not None:
+        async def single_chunk():
+            yield cached
+        return model_name, single_chunk()
+
+    async def stream_and_store():
+        answered_by, chunks = await astream_model(model_name, messages)
+
+        async def store_when_complete():
+            parts, truncated = [], False
+            async for chunk in chunks:
+                if isinstance(chunk, str):
+                    parts.append(chunk)
+                elif chunk.get("budget_reached"):
+                    truncated = True
+                yield chunk
+            text = "".join(parts)
+            if text.strip() and not truncated:
+                await cache_store(key, model_name, message, research_mode, text)
+
+        return answered_by, store_when_complete()
+
+    return await single_flight.astream(key, stream_and_store)
+
+
+# --- Endpoints ---
+
+async def home(request):
+    return PlainTextResponse("FunnX.Ai Backend is running!")
+
+
+async def ping(request):
+    log.info("ping")
+    return JSONResponse({"status": "active", "message": "Backend is alive!"})
+
+
+async def ready(request):
+    body, status = boot.readiness()
+    return JSONResponse(body, status_code=status)
+
+
+async def get_pool_stats(request):
+    return JSONResponse(pool_stats())
+
+
+async def get_cache_stats(request):
+    return JSONResponse({
+        **response_cache.stats(),
+        "semantic": semantic_cache.stats(),
+        "single_flight": single_flight.stats(),
+    })
+
+
+async def get_metrics(request):
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def login(request):
+    data = await read_json(request) or {}
+    email = data.get("email")
+    password = data.get("password")
+    if not email or not password:
+        return JSONResponse({"error": "Email and password are required."}, status_code=400)
+
+    # --- Simplified Login: Any email/password combination works ---
+    log.info("simulated login", extra={"user_email": email})
+    return JSONResponse({"success": True, "message": "Simulated login successful.", "token": auth.issue(email)})
+
+
+async def chat(request):
+    data = await read_json(request) or {}
+    user_message = data.get("message")
+    model_name = data.get("model")
+    research_mode = data.get("research_mode", False)
+    user_email = data.get("user_email")
+    conversation_id = data.get("conversation_id")
+
+    log.info("chat request", extra={"model": model_name, "message_chars": len(user_message or ""), "research_mode": research_mode})
+
+    if not user_message:
+        return JSONResponse({"error": "No message provided"}, status_code=400)
+
+    try:
+        await admit_user(request, user_email)
+        messages = await build_messages(user_email, conversation_id, model_name, user_message)
+        ai_response_text, cache_hit, answered_by = await ask_cached(model_name, messages, research_mode)
+    except ChatError as e:
+        return error_response(e)
+
+    save_turn(user_email, conversation_id, [messages[-1], {"role": "assistant", "content": ai_response_text}], answered_by)
+    return JSONResponse({"response": ai_response_text, "cached": cache_hit, "model": answered_by})
+
+
+async def chat_stream(request):
+    data = await read_json(request) or {}
+    user_message = data.get("message")
+    model_name = data.get("model")
+    research_mode = data.get("research_mode", False)
+    user_email = data.get("user_email")
+    conversation_id = data.get("conversation_id")
+
+    log.info("streaming chat request", extra={"model": model_name, "message_chars": len(user_message or ""), "research_mode": research_mode})
+
+    if not user_message:
+        return JSONResponse({"error": "No message provided"}, status_code=400)
+
+    try:
+        await admit_user(request, user_email)
+        messages = await build_messages(user_email, conversation_id, model_name, user_message)
+        answered_by, chunks = await stream_cached(model_name, messages, research_mode)
+    except ChatError as e:
+        return error_response(e)
+
+    async def generate():
+        nonlocal answered_by
+        parts = []
+        if answered_by != model_name:
+            yield ndjson_line({"model": answered_by})
+        try:
+            async for chunk in chunks:
+                if isinstance(chunk, dict):
+                    if "stage" not in chunk:
+                        answered_by = chunk["model"]
+                    yield ndjson_line(chunk)
+                    continue
+                parts.append(chunk)
+                yield ndjson_line({"delta": chunk})
+        except ChatError as e:
+            yield ndjson_line(error_line(e))
+            return
+        except Exception as e:
+            log.exception("streaming call failed", extra={"model": model_name})
+            yield ndjson_line({"error": f"{model_name} API error: {str(e)}"})
+            return
+        save_turn(user_email, conversation_id, [messages[-1], {"role": "assistant", "content": "".join(parts)}], answered_by)
+        yield ndjson_line({"done": True})
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson", headers=NDJSON_HEADERS)
+
+
+async def timed_ask(model_name, messages, research_mode, user_email=None, conversation_id=None):
+    started = time.perf_counter()
+    result = {"model": model_name}
+    try:
+        result["response"], result["cached"], answered_by = await ask_cached(model_name, messages, research_mode)
+        if answered_by != model_name:
+            result["answered_by"] = answered_by
+        save_turn(user_email, conversation_id, [{"role": "assistant", "content": result["response"]}], answered_by)
+    except ChatError as e:
+        result.update(error_line(e))
+    except Exception as e:
+        result["error"] = f"Unexpected {model_name} error: {str(e)}"
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000)
+    return result
+
+
+async def chat_multi(request):
+    data = await read_json(request) or {}
+    user_message = data.get("message")
+    models = data.get("models") or []
+    research_mode = data.get("research_mode", False)
+    user_email = data.get("user_email")
+    conversation_id = data.get("conversation_id")
+
+    log.info("multi-model chat request", extra={"models": models, "message_chars": len(user_message or "")})
+
+    if not user_message:
+        return JSONResponse({"error": "No message provided"}, status_code=400)
+    if not isinstance(models, list) or not models:
+        return JSONResponse({"error": "A non-empty list of models is required"}, status_code=400)
+    try:
+        await admit_user(request, user_email)
+    except ChatError as e:
+        return error_response(e)
+
+    started = time.perf_counter()
+    # Each model's context is read before this turn's user message is queued for saving
+    model_messages = {
+        model_name: await build_messages(user_email, conversation_id, model_name, user_message)
+        for model_name in dict.fromkeys(models)
+    }
+    save_turn(user_email, conversation_id, [{"role": "user", "content": user_message}])
+    tasks = [asyncio.ensure_future(timed_ask(model_name, messages, research_mode, user_email, conversation_id))
+             for model_name, messages in model_messages.items()]
+
+    async def generate():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield ndjson_line(await next_done)
+            yield ndjson_line({"done": True, "elapsed_ms": round((time.perf_counter() - started) * 1000)})
+        finally:
+            # Client went away: don't keep paying for answers nobody will read
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson", headers=NDJSON_HEADERS)
+
+
+async def chat_batch(request):
+    """Same request/response as api.chat_batch(); see batch_jobs.py."""
+    try:
+        user_key = request_user(request, request.query_params.get("user_email"))
+        check_quota(user_key)
+        body = (await request.body()).decode("utf-8", errors="replace")
+        items, invalid = batch_jobs.parse_items(body, request.query_params.get("model"))
+    except ChatError as e:
+        return error_response(e)
+
+    log.info("batch chat request", extra={"prompts": len(items), "invalid": len(invalid)})
+    started = time.perf_counter()
+    results = asyncio.Queue()
+
+    async def worker(work):
+        while work:
+            item = work.popleft()
+            try:
+                check_quota(user_key)
+            except ChatError as e:
+                await results.put({"id": item["id"], "model": item["model"], **error_line(e), "elapsed_ms": 0})
+                continue
+            await wait_for_user_token(user_key)
+            result = await timed_ask(item["model"], [{"role": "user", "content": item["message"]}], item["research_mode"])
+            await results.put({"id": item["id"], **result})
+
+    tasks = [
+        asyncio.ensure_future(worker(work))
+        for work in batch_jobs.queues_by_provider(items).values()
+        for _ in range(min(batch_jobs.BATCH_CONCURRENCY, len(work)))
+    ]
+
+    async def generate():
+        failed = len(invalid)
+        try:
+            for line in invalid:
+                yield ndjson_line(line)
+            for _ in items:
+                result = await results.get()
+                failed += "error" in result
+                yield ndjson_line(result)
+            elapsed_ms = round((time.perf_counter() - started) * 1000)
+            yield ndjson_line(batch_jobs.done_line(len(items) + len(invalid), failed, elapsed_ms))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson", headers=NDJSON_HEADERS)
+
+
+async def list_models(request):
+    return JSONResponse({"models": providers.model_names()})
+
+
+async def admin_usage(request):
+    """Same request/response as api.admin_usage(); the report is read off the event loop."""
+    if usage.ledger is None or not usage.ADMIN_TOKEN:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    if not usage.is_admin(request.headers.get("authorization")):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    try:
+        windows = usage.parse_windows(request.query_params.get("window"))
+        limit = int(request.query_params.get("limit", "10"))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse({"windows": await asyncio.to_thread(usage.report, windows, limit)})
+
+
+async def get_history(request):
+    """Same request/response as api.get_history()."""
+    data = await read_json(request) or {}
+    user_email = data.get("user_email")
+    conversation_id = data.get("conversation_id")
+    if not user_email:
+        return JSONResponse({"error": "user_email is required"}, status_code=400)
+    if not auth.can_read_history(request.headers.get("authorization"), user_email):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    if not conversation_id:
+        conversations = await asyncio.to_thread(history.conversations, user_email)
+        return JSONResponse({"history": [], "conversations": conversations})
+
+    try:
+        before = int(data["before"]) if data.get("before") is not None else None
+        limit = int(data.get("limit", HISTORY_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return JSONResponse({"error": "before and limit must be integers"}, status_code=400)
+
+    messages, next_cursor = await asyncio.to_thread(history.page, user_email, conversation_id, before, limit)
+    return JSONResponse({"history": messages, "next_cursor": next_cursor})
+
+
+class RequestMetrics:
+    """ASGI middleware recording funnx_http_request_duration_seconds and setting
+    the request ID (X-Request-ID), like api.py's request hooks."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        # Only known paths become labels, so stray URLs can't grow the label set
+        endpoint = scope["path"] if scope["path"] in ROUTE_PATHS else "unmatched"
+        # Set in this task's context, so tasks and to_thread() calls made by the endpoint inherit it
+        header = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        request_id = structured_logging.set_request_id(header)
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start":
+                metrics.HTTP_REQUEST_SECONDS.observe(
+                    time.perf_counter() - started,
+                    endpoint=endpoint, method=scope["method"], status=message["status"],
+                )
+                message = {**message, "headers": [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]}
+            await send(message)
+
+        await self.app(scope, receive, send_and_record)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Warm-up runs on a thread; the worker serves requests meanwhile
+    boot.start_warm_up(connect=False)
+    yield
+
+
+routes = [
+    Route("/", home),
+    Route("/ping", ping, methods=["GET"]),
+    Route("/ready", ready, methods=["GET"]),
+    Route("/pool_stats", get_pool_stats, methods=["GET"]),
+    Route("/cache_stats", get_cache_stats, methods=["GET"]),
+    Route("/metrics", get_metrics, methods=["GET"]),
+    Route("/login", login, methods=["POST"]),
+    Route("/chat", chat, methods=["POST"]),
+    Route("/chat/stream", chat_stream, methods=["POST"]),
+    Route("/chat/multi", chat_multi, methods=["POST"]),
+    Route("/chat/batch", chat_batch, methods=["POST"]),
+    Route("/models", list_models, methods=["GET"]),
+    Route("/get_history", get_history, methods=["POST"]),
+    Route("/admin/usage", admin_usage, methods=["GET"]),
+]
+ROUTE_PATHS = {route.path for route in routes}
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        Middleware(RequestMetrics),
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+    ],
+    lifespan=lifespan,
+)
+
+boot.record_import("asgi", time.perf_counter() - IMPORT_STARTED)
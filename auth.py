@@ -0,0 +1,81 @@
+# FunnX.Ai/auth.py
+# Signed session tokens for reading stored conversations.
+#
+# /login answers with a token for the email it was given: "<expiry>.<signature>",
+# where the signature is an HMAC-SHA256 of the email and the expiry (unix seconds)
+# under SESSION_SECRET. No state is kept, so every worker can check a token another
+# one issued. app.py sends it as "Authorization: Bearer <token>", and /get_history
+# only returns a user's conversations for that user's token, or for ADMIN_TOKEN
+# (see usage.py).
+#
+# Without SESSION_SECRET, a random secret is created once per host in
+# SESSION_SECRET_PATH and shared by the workers; tokens then stop working when that
+# file is lost (e.g. on a redeploy), and users log in again.
+import os
+import hmac
+import time
+import hashlib
+import logging
+import usage
+
+log = logging.getLogger(__name__)
+
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+SESSION_SECRET_PATH = os.getenv("SESSION_SECRET_PATH", "session_secret.key")
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 86400)))  # seconds a login token stays valid
+
+
+def load_secret():
+    if SESSION_SECRET:
+        return SESSION_SECRET.encode("utf-8")
+    try:
+        # O_EXCL: the first worker to get here creates the secret, the others read it
+        fd = os.open(SESSION_SECRET_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        log.warning("cannot create the session secret file; login tokens only work on this worker",
+                    extra={"path": SESSION_SECRET_PATH, "error": str(e)})
+        return os.urandom(32)
+    else:
+        with os.fdopen(fd, "w") as f:
+            f.write(os.urandom(32).hex())
+    try:
+        # A worker that lost the race may read the file before its creator has written it
+        for _ in range(50):
+            with open(SESSION_SECRET_PATH) as f:
+                secret = f.read().strip()
+            if secret:
+                return secret.encode("utf-8")
+            time.sleep(0.01)
+    except OSError as e:
+        log.warning("cannot read the session secret file; login tokens only work on this worker",
+                    extra={"path": SESSION_SECRET_PATH, "error": str(e)})
+    return os.urandom(32)
+
+
+secret = load_secret()
+
+
+def sign(email, expires):
+    return hmac.new(secret, f"{email}\n{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def issue(email):
+    """A token for `email`, valid for SESSION_TTL seconds."""
+    expires = int(time.time() + SESSION_TTL)
+    return f"{expires}.{sign(email, expires)}"
+
+
+def is_user(authorization, email):
+    """True if the Authorization header carries an unexpired token for `email`."""
+    if not authorization or not authorization.startswith("Bearer "):
+        return False
+    expires, _, signature = authorization[len("Bearer "):].partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign(email, int(expires)))
+
+
+def can_read_history(authorization, email):
+    return is_user(authorization, email) or usage.is_admin(authorization)
@@ -0,0 +1,119 @@
+# FunnX.Ai/batch_cli.py
+# Sends a JSONL file of prompts through the backend's /chat/batch endpoint.
+#
+#   python batch_cli.py prompts.jsonl -o results.jsonl --model Gemini
+#
+# Each input line is a JSON object; the prompt is read from --message-field
+# (default "message") and the id from --id-field (default "id", else the line
+# number). For example, a backlog file with request_id/body fields:
+#
+#   python batch_cli.py requests.jsonl -o answers.jsonl --model Auto \
+#       --id-field request_id --message-field body
+#
+# Results are appended to the output file as they arrive, so it doubles as the
+# checkpoint: rerunning the same command skips prompts that already have a
+# response there and retries only the missing or failed ones. When a prompt
+# appears more than once in the output, its last line is the current result.
+import sys
+import json
+import time
+import argparse
+import requests
+from http_client import get_session
+
+DEFAULT_URL = "http://127.0.0.1:5000"
+
+
+def read_prompts(path, id_field, message_field, default_model):
+    prompts = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            prompt = {"id": entry.get(id_field, number), "message": entry.get(message_field)}
+            if entry.get("model") or default_model:
+                prompt["model"] = entry.get("model") or default_model
+            if "research_mode" in entry:
+                prompt["research_mode"] = entry["research_mode"]
+            prompts.append(prompt)
+    return prompts
+
+
+def answered_ids(path):
+    """Ids whose latest result in the output file is a response (the checkpoint)."""
+    latest = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line cut short by an interrupted run
+                if "id" in result:
+                    latest[str(result["id"])] = "response" in result
+    except FileNotFoundError:
+        pass
+    return {item_id for item_id, ok in latest.items() if ok}
+
+
+def send_chunk(session, url, prompts, model, out):
+    """Posts one chunk of prompts and appends each result to `out` as it arrives. Returns failures."""
+    body = "".join(json.dumps(prompt) + "\n" for prompt in prompts)
+    params = {"model": model} if model else {}
+    failed = 0
+    with session.post(f"{url}/chat/batch", params=params, data=body.encode("utf-8"),
+                      headers={"Content-Type": "application/x-ndjson"}, stream=True) as response:
+        if response.status_code != 200:
+            raise SystemExit(f"Backend returned {response.status_code}: {response.text}")
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            result = json.loads(line)
+            if result.get("done"):
+                continue
+            failed += "error" in result
+            out.write(json.dumps(result) + "\n")
+            # Flushed per line so an interrupted run keeps everything received so far
+            out.flush()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through /chat/batch.")
+    parser.add_argument("input", help="JSONL file, one prompt object per line")
+    parser.add_argument("-o", "--output", required=True, help="JSONL results file; also the resume checkpoint")
+    parser.add_argument("--model", help="model for prompts that don't name one (e.g. Gemini, Auto)")
+    parser.add_argument("--url", default=DEFAULT_URL, help=f"backend base URL (default {DEFAULT_URL})")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--message-field", default="message")
+    parser.add_argument("--chunk-size", type=int, default=200, help="prompts per /chat/batch request")
+    args = parser.parse_args(argv)
+
+    prompts = read_prompts(args.input, args.id_field, args.message_field, args.model)
+    done = answered_ids(args.output)
+    pending = [prompt for prompt in prompts if str(prompt["id"]) not in done]
+    print(f"{len(prompts)} prompts, {len(prompts) - len(pending)} already answered, {len(pending)} to send.", file=sys.stderr)
+
+    # Answers can take minutes; the read timeout applies between result lines
+    session = get_session("batch", timeout=(10, 600))
+    started = time.perf_counter()
+    failed = sent = 0
+    with open(args.output, "a", encoding="utf-8") as out:
+        try:
+            for start in range(0, len(pending), args.chunk_size):
+                chunk = pending[start:start + args.chunk_size]
+                failed += send_chunk(session, args.url.rstrip("/"), chunk, args.model, out)
+                sent += len(chunk)
+                print(f"{sent}/{len(pending)} sent, {failed} failed ({time.perf_counter() - started:.0f}s)", file=sys.stderr)
+        except KeyboardInterrupt:
+            print("Interrupted; rerun the same command to resume.", file=sys.stderr)
+            return 130
+        except requests.exceptions.RequestException as e:
+            print(f"Backend request failed ({e}); rerun the same command to resume.", file=sys.stderr)
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
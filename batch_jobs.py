@@ -0,0 +1,91 @@
+# FunnX.Ai/batch_jobs.py
+# Request parsing and scheduling shared by /chat/batch in api.py and asgi.py.
+#
+# Request body: JSONL, one prompt per line:
+#   {"id": "q1", "message": "...", "model": "Gemini", "research_mode": false}
+# "id" defaults to the line number and "model" to the ?model= query parameter.
+#
+# Response: NDJSON, one line per prompt in completion order:
+#   {"id": "q1", "model": "Gemini", "response": "...", "cached": false, "elapsed_ms": 1234}
+#   {"id": "q2", "model": "Gemini", "error": "...", "elapsed_ms": 56}
+# followed by {"done": true, "count": N, "failed": F, "elapsed_ms": T}.
+#
+# Prompts are answered as single turns and not saved to history; the response cache
+# and provider rate limits apply as for /chat. Each prompt takes a token from the
+# user's rate limit bucket, waiting its turn when the bucket is busy, and is checked
+# against their usage quota (once it is used up, the remaining prompts get error lines
+# with "retry_after"). Each provider gets its own queue and at most BATCH_CONCURRENCY
+# prompts in flight per batch, so a slow or rate-limited provider doesn't hold up
+# prompts for the others; "Auto" prompts are queued with the provider of the model Auto
+# currently ranks first. batch_cli.py sends a JSONL file through this endpoint and
+# checkpoints the results.
+import os
+import json
+from collections import deque
+import providers
+from providers import ChatError
+import router
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+
+
+def parse_items(body, default_model):
+    """
+    Returns (items, invalid): items are {"id", "message", "model", "research_mode"} dicts,
+    invalid are error result lines for lines that couldn't be used.
+    Raises ChatError(400/413) if the batch as a whole is unusable.
+    """
+    items, invalid = [], []
+    for number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError as e:
+            invalid.append({"id": number, "error": f"Line {number} is not valid JSON: {e}"})
+            continue
+        if not isinstance(entry, dict):
+            invalid.append({"id": number, "error": f"Line {number} must be a JSON object"})
+            continue
+        item_id = entry.get("id", number)
+        message = entry.get("message")
+        model_name = entry.get("model") or default_model
+        if not message or not isinstance(message, str):
+            invalid.append({"id": item_id, "error": "No message provided"})
+        elif not model_name:
+            invalid.append({"id": item_id, "error": "No model given (set \"model\" or ?model=)"})
+        else:
+            items.append({
+                "id": item_id,
+                "message": message,
+                "model": model_name,
+                "research_mode": bool(entry.get("research_mode", False)),
+            })
+    if not items and not invalid:
+        raise ChatError("The batch is empty. Send one JSON prompt per line.", status=400)
+    if len(items) + len(invalid) > BATCH_MAX_ITEMS:
+        raise ChatError(f"A batch can hold at most {BATCH_MAX_ITEMS} prompts; split the file.", status=413)
+    return items, invalid
+
+
+def queues_by_provider(items):
+    """
+    One work queue per provider. "Auto" prompts go to the provider Auto will ask first
+    (hedged backup calls aside); unknown models, and Auto with no model ready, get their own.
+    """
+    try:
+        auto_model = router.rank("complete")[0]
+    except ChatError:
+        auto_model = router.AUTO_MODEL
+    queues = {}
+    for item in items:
+        name = auto_model if item["model"] == router.AUTO_MODEL else item["model"]
+        model = providers.MODEL_CONFIG.get(name)
+        key = model["provider"] if model else name
+        queues.setdefault(key, deque()).append(item)
+    return queues
+
+
+def done_line(count, failed, elapsed_ms):
+    return {"done": True, "count": count, "failed": failed, "elapsed_ms": elapsed_ms}
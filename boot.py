@@ -0,0 +1,109 @@
+# FunnX.Ai/boot.py
+# Worker start-up: the import-time budget, background warm-up, and /ready.
+#
+# api.py and asgi.py time their own import and report it with record_import(); an
+# import slower than IMPORT_TIME_BUDGET seconds is logged, since it delays every
+# worker start and every cold start on Render. To see where the time goes:
+#
+#   python boot.py api      # or asgi
+#
+# imports the app in a fresh interpreter with `python -X importtime`, lists the
+# slowest modules, and exits 1 if the import is over budget (usable as a CI check).
+#
+# start_warm_up() runs providers.warm_up() (SDK imports, clients and model objects,
+# optionally the first TLS connections) and loads the tokenizer on a background
+# thread, so a new worker answers /ping and /ready straight away. A chat request
+# that arrives before warm-up is done imports what it needs itself. /ready answers
+# 503 until this worker's warm-up has finished and 200 after, with per-provider status.
+import os
+import logging
+import sys
+import time
+import threading
+import subprocess
+import providers
+import tokens
+
+log = logging.getLogger(__name__)
+
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", "0.5"))
+
+state = {"import_seconds": None, "warm_up_started": False, "warm_up_seconds": None}
+_warm_up_lock = threading.Lock()
+
+
+def record_import(module_name, seconds):
+    state["import_seconds"] = seconds
+    if seconds > IMPORT_TIME_BUDGET:
+        log.warning(f"import over IMPORT_TIME_BUDGET; run `python boot.py {module_name}` to see the slowest modules",
+                    extra={"import_module": module_name, "seconds": round(seconds, 3), "budget": IMPORT_TIME_BUDGET})
+
+
+def warm_up(connect):
+    started = time.perf_counter()
+    try:
+        providers.warm_up(connect=connect)
+        tokens.get_encoding()
+    finally:
+        state["warm_up_seconds"] = time.perf_counter() - started
+        log.info("warm-up finished", extra={"seconds": round(state["warm_up_seconds"], 3)})
+
+
+def start_warm_up(connect=False):
+    """Starts warm-up on a background thread, once per worker process. Returns at once."""
+    with _warm_up_lock:
+        if state["warm_up_started"]:
+            return
+        state["warm_up_started"] = True
+    threading.Thread(target=warm_up, args=(connect,), name="warm-up", daemon=True).start()
+
+
+def readiness():
+    """Returns (body, status) for /ready."""
+    # Servers started without the gunicorn hooks (e.g. `flask run`) warm up on the first /ready
+    start_warm_up()
+    ready = state["warm_up_seconds"] is not None
+    seconds = state["import_seconds"]
+    body = {
+        "ready": ready,
+        "pid": os.getpid(),
+        "import_seconds": round(seconds, 3) if seconds is not None else None,
+        "import_budget_seconds": IMPORT_TIME_BUDGET,
+        "warm_up_seconds": round(state["warm_up_seconds"], 3) if ready else None,
+        "providers": providers.provider_status(),
+    }
+    return body, 200 if ready else 503
+
+
+def measure(module_name):
+    """
+    Imports `module_name` in a fresh interpreter. Returns (seconds, slowest), where slowest
+    lists (seconds, module) for the modules it imports directly or one level down.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        sys.exit(f"Importing {module_name} failed:\n{result.stderr}")
+    total, nested = None, []
+    for line in result.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package", nesting shown by indentation
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if name.strip() == module_name and depth == 0:
+            total = int(cumulative) / 1e6
+        elif 1 <= depth <= 2:
+            nested.append((int(cumulative) / 1e6, name.strip()))
+    return total, sorted(nested, reverse=True)[:10]
+
+
+if __name__ == "__main__":
+    module_name = sys.argv[1] if len(sys.argv) > 1 else "api"
+    seconds, slowest = measure(module_name)
+    print(f"import {module_name}: {seconds:.3f}s (budget {IMPORT_TIME_BUDGET:.3f}s)")
+    for module_seconds, name in slowest:
+        print(f"  {module_seconds:7.3f}s  {name}")
+    sys.exit(1 if seconds > IMPORT_TIME_BUDGET else 0)
@@ -0,0 +1,147 @@
+# FunnX.Ai/context_builder.py
+# Builds the messages sent to a model for one chat turn, within a token budget.
+#
+#   context = [rolling summary of older turns] + newest history that fits + new message
+#
+# The budget is per model (MODELS[...]["context_tokens"] in providers.py, default
+# CONTEXT_TOKEN_BUDGET). Token counts of stored messages come from the history
+# store (counted once, when written), so each turn only counts the new message and
+# reads at most HISTORY_CONTEXT_MESSAGES rows, however long the conversation is.
+#
+# Messages that fall out of the window are folded into the conversation's summary
+# by a background thread using SUMMARY_MODEL, so the request never waits for it.
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import providers
+from providers import ChatError, FallbackText
+from history_store import store as history, HISTORY_CONTEXT_MESSAGES
+from tokens import count_tokens
+from structured_logging import in_context
+
+log = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "Gemini")
+# Dropped-but-unsummarized tokens needed before the summary is refreshed
+SUMMARY_MIN_TOKENS = int(os.getenv("SUMMARY_MIN_TOKENS", "800"))
+# Largest transcript sent to SUMMARY_MODEL in one refresh (newest part wins)
+SUMMARY_MAX_INPUT_TOKENS = int(os.getenv("SUMMARY_MAX_INPUT_TOKENS", "8000"))
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and an AI assistant.\n"
+    "Keep facts, names, decisions, open questions and the user's preferences. "
+    "Write at most 200 words, in plain prose.\n\n"
+    "Current summary:\n{previous}\n\n"
+    "New messages to fold in:\n{transcript}\n\n"
+    "Updated summary:"
+)
+
+summarizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+summarizing = set()
+summarizing_lock = threading.Lock()
+
+
+def model_budget(model_name):
+    if model_name not in providers.MODEL_CONFIG:
+        # "Auto" may pick any model, so it gets the tightest budget
+        return min(model_budget(name) for name in providers.MODEL_CONFIG)
+    return providers.MODEL_CONFIG[model_name].get("context_tokens", CONTEXT_TOKEN_BUDGET)
+
+
+def token_scale(model_name):
+    """Correction from our token counts to the model's own tokenizer (see tokens.py)."""
+    if model_name not in providers.MODEL_CONFIG:
+        return max(token_scale(name) for name in providers.MODEL_CONFIG)
+    return providers.MODEL_CONFIG[model_name].get("token_scale", 1.0)
+
+
+def build(user_email, conversation_id, model_name, user_message):
+    """Returns the list of {"role", "content"} messages to send for this turn."""
+    new_message = {"role": "user", "content": user_message}
+    if not (user_email and conversation_id):
+        return [new_message]
+
+    scale = token_scale(model_name)
+    budget = model_budget(model_name) - count_tokens(user_message) * scale
+    # "Auto" (router.py) isn't a configured model: it sees every model's earlier answers
+    own_model = model_name if model_name in providers.MODEL_CONFIG else None
+    recent = history.recent_messages(user_email, conversation_id, HISTORY_CONTEXT_MESSAGES, model=own_model)
+    if not recent:
+        return [new_message]
+
+    summary = history.get_summary(user_email, conversation_id)
+    if summary:
+        budget -= summary["tokens"] * scale
+
+    # Walk back from the newest message while it still fits
+    kept = []
+    for message in reversed(recent):
+        cost = message["tokens"] * scale
+        if cost > budget:
+            break
+        budget -= cost
+        kept.append(message)
+    kept.reverse()
+    # Start on a user turn: an answer without its question only confuses the model
+    while kept and kept[0]["role"] == "assistant":
+        kept.pop(0)
+
+    # Everything before the window is dropped; make sure the summary catches up with it.
+    # recent may itself be cut off by HISTORY_CONTEXT_MESSAGES, so check even if all of it fit.
+    window_start = kept[0]["id"] if kept else recent[-1]["id"] + 1
+    if len(kept) < len(recent) or len(recent) >= HISTORY_CONTEXT_MESSAGES:
+        if summary is None or summary["through_id"] < window_start - 1:
+            schedule_summary(user_email, conversation_id, window_start)
+
+    context = []
+    if summary:
+        context.append({"role": "user", "content": f"(Summary of the earlier part of this conversation: {summary['summary']})"})
+    context.extend({"role": m["role"], "content": m["content"]} for m in kept)
+    context.append(new_message)
+    return context
+
+
+def schedule_summary(user_email, conversation_id, window_start):
+    key = (user_email, conversation_id)
+    with summarizing_lock:
+        if key in summarizing:
+            return
+        summarizing.add(key)
+    summarizer.submit(in_context(refresh_summary), user_email, conversation_id, window_start)
+
+
+def refresh_summary(user_email, conversation_id, window_start):
+    """Folds messages between the current summary and window_start into the summary."""
+    try:
+        summary = history.get_summary(user_email, conversation_id)
+        after_id = summary["through_id"] if summary else 0
+        dropped = history.messages_between(user_email, conversation_id, after_id, window_start)
+        if sum(m["tokens"] for m in dropped) < SUMMARY_MIN_TOKENS:
+            return
+
+        # Keep the newest part of the transcript if it's too long for one call
+        transcript, used = [], 0
+        for message in reversed(dropped):
+            used += message["tokens"]
+            if used > SUMMARY_MAX_INPUT_TOKENS and transcript:
+                break
+            transcript.append(f"{message['role'].upper()}: {message['content']}")
+        transcript.reverse()
+
+        prompt = SUMMARY_PROMPT.format(
+            previous=summary["summary"] if summary else "(none yet)",
+            transcript="\n\n".join(transcript),
+        )
+        text = providers.ask_model(SUMMARY_MODEL, [{"role": "user", "content": prompt}])
+        if isinstance(text, FallbackText) or not text.strip():
+            return
+        history.set_summary(user_email, conversation_id, text.strip(), dropped[-1]["id"])
+    except ChatError as e:
+        log.warning("conversation summary failed", extra={"error": e.message})
+    except Exception:
+        log.exception("conversation summary failed")
+    finally:
+        with summarizing_lock:
+            summarizing.discard((user_email, conversation_id))
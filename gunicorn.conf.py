@@ -0,0 +1,28 @@
+# FunnX.Ai/gunicorn.conf.py
+# Loaded by the Procfile (gunicorn --config gunicorn.conf.py ...).
+#
+# SERVER_MODE picks how the backend is served (see "Serving modes" in README.md):
+#   sync  (default) - Flask app in api.py on gunicorn's sync workers
+#   async           - Starlette app in asgi.py on uvicorn workers
+# Worker count comes from WEB_CONCURRENCY (gunicorn reads it natively).
+import os
+
+SERVER_MODE = os.getenv("SERVER_MODE", "sync").lower()
+
+if SERVER_MODE == "async":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "api:app"
+    # Threads per sync worker; each in-flight chat holds one until the provider answers
+    threads = int(os.getenv("GUNICORN_THREADS", "1"))
+
+# Long provider calls (DeepSeek R1) must not be killed as "hung" workers
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+
+def post_worker_init(worker):
+    """Start building provider clients in each worker; it accepts requests meanwhile (see boot.py)."""
+    import boot
+    # WARM_UP_CONNECTIONS=1 also opens the pooled TLS connections to the providers
+    boot.start_warm_up(connect=os.getenv("WARM_UP_CONNECTIONS", "0") == "1")
@@ -0,0 +1,252 @@
+# FunnX.Ai/history_store.py
+# Persistent conversation history, keyed by user_email and conversation_id.
+#
+# Stored in SQLite (HISTORY_DB_PATH) in WAL mode so all gunicorn workers can read
+# while one writes. Reads use the (user_email, conversation_id, id) index, so
+# loading the last N messages costs O(N) regardless of conversation length, and
+# /get_history pages backwards with the message id as the cursor.
+#
+# Appends are queued and written by a background thread in batches, keeping the
+# SQLite write (and its fsync) off the request path. The writer also stores each
+# message's token count, so building a context never re-tokenizes old messages.
+import os
+import logging
+import time
+import queue
+import sqlite3
+import atexit
+import threading
+from tokens import count_tokens
+
+log = logging.getLogger(__name__)
+
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "history.sqlite3")
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+# Most recent messages read per turn; context_builder.py then trims them to the model's token budget
+HISTORY_CONTEXT_MESSAGES = int(os.getenv("HISTORY_CONTEXT_MESSAGES", "50"))
+HISTORY_MAX_PAGE_SIZE = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_email TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    model TEXT,
+    created_at REAL NOT NULL,
+    tokens INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (user_email, conversation_id, id);
+CREATE TABLE IF NOT EXISTS conversations (
+    user_email TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_email, conversation_id)
+);
+CREATE INDEX IF NOT EXISTS conversations_by_user ON conversations (user_email, updated_at);
+CREATE TABLE IF NOT EXISTS summaries (
+    user_email TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    through_id INTEGER NOT NULL,
+    PRIMARY KEY (user_email, conversation_id)
+);
+"""
+
+
+class HistoryStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.pending = queue.Queue()
+        self.writer = None
+        self.writer_pid = None
+        self.writer_lock = threading.Lock()
+        conn = self.connect()
+        conn.executescript(SCHEMA)
+        # Databases created before token counts were stored
+        if "tokens" not in {row["name"] for row in conn.execute("PRAGMA table_info(messages)")}:
+            conn.execute("ALTER TABLE messages ADD COLUMN tokens INTEGER")
+
+    def connect(self):
+        # One connection per thread, reopened after a fork (gunicorn workers)
+        conn = getattr(self.local, "conn", None)
+        if conn is None or getattr(self.local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    # --- Writes (asynchronous) ---
+
+    def append(self, user_email, conversation_id, messages, model=None):
+        """
+        Queues messages ({"role", "content"}, optionally "model") for the background writer.
+        `model` applies to assistant messages that don't name their own.
+        """
+        now = time.time()
+        rows = [
+            (user_email, conversation_id, m["role"], m["content"],
+             m.get("model", model if m["role"] == "assistant" else None), now)
+            for m in messages
+        ]
+        self.ensure_writer()
+        self.pending.put(rows)
+
+    def ensure_writer(self):
+        if self.writer_pid == os.getpid() and self.writer.is_alive():
+            return
+        with self.writer_lock:
+            if self.writer_pid != os.getpid() or not self.writer.is_alive():
+                # After a fork the parent's thread doesn't exist here, nor do its queued items
+                if self.writer_pid != os.getpid():
+                    self.pending = queue.Queue()
+                self.writer = threading.Thread(target=self.write_loop, name="history-writer", daemon=True)
+                self.writer_pid = os.getpid()
+                self.writer.start()
+
+    def write_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            # Drain whatever else is queued so a burst becomes one transaction
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except sqlite3.Error as e:
+                log.error("failed to write history batches", extra={"batches": len(batch), "error": str(e)})
+            finally:
+                for _ in batch:
+                    self.pending.task_done()
+
+    def write(self, batch):
+        rows = [row for rows in batch for row in rows]
+        conversations = {}
+        for user_email, conversation_id, role, content, model, created_at in rows:
+            key = (user_email, conversation_id)
+            title = conversations.get(key, (None, None))[0]
+            if title is None and role == "user":
+                title = " ".join(content.split())[:80]
+            conversations[key] = (title, created_at)
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT INTO messages (user_email, conversation_id, role, content, model, created_at, tokens)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [row + (count_tokens(row[3]),) for row in rows],
+            )
+            for (user_email, conversation_id), (title, updated_at) in conversations.items():
+                # The first user message becomes the conversation title; later ones only bump updated_at
+                conn.execute(
+                    "INSERT INTO conversations (user_email, conversation_id, title, updated_at)"
+                    " VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (user_email, conversation_id) DO UPDATE SET updated_at = excluded.updated_at",
+                    (user_email, conversation_id, title or "Untitled conversation", updated_at),
+                )
+
+    def flush(self):
+        """Blocks until every queued append has been written."""
+        if self.writer_pid == os.getpid():
+            self.pending.join()
+
+    # --- Reads ---
+
+    def recent_messages(self, user_email, conversation_id, limit, model=None):
+        """
+        The last `limit` messages in chronological order, as {"id", "role", "content", "tokens"}
+        dicts. With `model`, assistant messages from other models are skipped, so in "Try Both"
+        each model sees the conversation with only its own earlier answers.
+        """
+        if model is None:
+            rows = self.connect().execute(
+                "SELECT id, role, content, tokens FROM messages WHERE user_email = ? AND conversation_id = ?"
+                " ORDER BY id DESC LIMIT ?",
+                (user_email, conversation_id, limit),
+            ).fetchall()
+        else:
+            rows = self.connect().execute(
+                "SELECT id, role, content, tokens FROM messages WHERE user_email = ? AND conversation_id = ?"
+                " AND (role = 'user' OR model = ? OR model IS NULL)"
+                " ORDER BY id DESC LIMIT ?",
+                (user_email, conversation_id, model, limit),
+            ).fetchall()
+        return [self.with_tokens(row) for row in reversed(rows)]
+
+    @staticmethod
+    def with_tokens(row):
+        message = dict(row)
+        if message["tokens"] is None:
+            # Written before token counts were stored
+            message["tokens"] = count_tokens(message["content"])
+        return message
+
+    def messages_between(self, user_email, conversation_id, after_id, before_id):
+        """All messages with after_id < id < before_id, oldest first (input for summaries)."""
+        rows = self.connect().execute(
+            "SELECT id, role, content, tokens FROM messages WHERE user_email = ? AND conversation_id = ?"
+            " AND id > ? AND id < ? ORDER BY id",
+            (user_email, conversation_id, after_id, before_id),
+        ).fetchall()
+        return [self.with_tokens(row) for row in rows]
+
+    def get_summary(self, user_email, conversation_id):
+        """The rolling summary as {"summary", "tokens", "through_id"}, or None."""
+        row = self.connect().execute(
+            "SELECT summary, tokens, through_id FROM summaries WHERE user_email = ? AND conversation_id = ?",
+            (user_email, conversation_id),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def set_summary(self, user_email, conversation_id, summary, through_id):
+        """Stores the summary of every message up to and including `through_id`. Written synchronously."""
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO summaries (user_email, conversation_id, summary, tokens, through_id)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (user_email, conversation_id, summary, count_tokens(summary), through_id),
+            )
+
+    def page(self, user_email, conversation_id, before=None, limit=HISTORY_PAGE_SIZE):
+        """
+        One page of a conversation, oldest first, ending just before message id `before`
+        (or at the newest message). Returns (messages, next_cursor); next_cursor is None
+        on the first page of the conversation.
+        """
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        query = (
+            "SELECT id, role, content, model, created_at FROM messages"
+            " WHERE user_email = ? AND conversation_id = ?"
+        )
+        params = [user_email, conversation_id]
+        if before is not None:
+            query += " AND id < ?"
+            params.append(before)
+        # Fetch one extra row to know whether an older page exists
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit + 1)
+        rows = self.connect().execute(query, params).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        messages = [dict(row) for row in reversed(rows)]
+        next_cursor = messages[0]["id"] if has_more else None
+        return messages, next_cursor
+
+    def conversations(self, user_email, limit=20):
+        rows = self.connect().execute(
+            "SELECT conversation_id, title, updated_at FROM conversations WHERE user_email = ?"
+            " ORDER BY updated_at DESC LIMIT ?",
+            (user_email, limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+
+store = HistoryStore(HISTORY_DB_PATH)
+atexit.register(store.flush)
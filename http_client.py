@@ -0,0 +1,149 @@
+# FunnX.Ai/http_client.py
+# Shared, connection-pooled HTTP sessions for the backend (OpenRouter calls)
+# and the frontend (Streamlit -> Flask backend calls).
+#
+# A bare requests.post() opens a new TCP+TLS connection every time. A Session
+# keeps connections alive in a urllib3 pool, so repeat calls to the same host
+# skip the handshake. Sessions are created lazily once per process (gunicorn
+# forks workers, and pooled sockets must not be shared across a fork).
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.poolmanager import pool_classes_by_scheme
+from urllib3.util.retry import Retry
+
+# --- Configuration (override via environment / .env) ---
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))          # keep-alive connections kept per host
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))       # retries on connect errors and 502/503/504
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.5"))  # sleeps 0.5s, 1s, 2s, ...
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+
+# Gateway/unavailable statuses only. 429 is left to the callers, which honour its
+# Retry-After (provider rate limits, the Auto router, batch_cli resumes).
+RETRY_STATUSES = (502, 503, 504)
+# Statuses are only retried for idempotent requests: re-sending a chat completion POST
+# could bill the same generation twice, on top of the router's own fallback and hedging.
+# Connect errors are retried for every method, since nothing was sent.
+RETRY_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+
+class PoolCounters:
+    """Thread-safe request/connect counters for one session."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connects = 0
+
+    def add(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                # A request that didn't need a new socket reused a pooled keep-alive connection
+                "hits": max(self.requests - self.connects, 0),
+                "misses": self.connects,
+            }
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled connections report every new socket (TCP/TLS handshake)."""
+
+    def __init__(self, counters, **kwargs):
+        self.counters = counters
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        counters = self.counters
+
+        def counting_pool(pool_cls):
+            class CountingConnection(pool_cls.ConnectionCls):
+                def connect(self):
+                    counters.add("connects")
+                    super().connect()
+            return type(f"Counting{pool_cls.__name__}", (pool_cls,), {"ConnectionCls": CountingConnection})
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting_pool(pool_cls) for scheme, pool_cls in pool_classes_by_scheme.items()
+        }
+
+
+class PooledSession(requests.Session):
+    """A Session that applies the default (connect, read) timeout when none is given."""
+
+    def __init__(self, timeout, counters):
+        super().__init__()
+        self.default_timeout = timeout
+        self.counters = counters
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.default_timeout)
+        self.counters.add("requests")
+        return super().request(method, url, **kwargs)
+
+
+def build_session(pool_size=None, max_retries=None, timeout=None, retry_statuses=RETRY_STATUSES,
+                  retry_methods=RETRY_METHODS):
+    retry = Retry(
+        total=HTTP_MAX_RETRIES if max_retries is None else max_retries,
+        connect=HTTP_MAX_RETRIES if max_retries is None else max_retries,
+        # Never retry after the request was sent and the read failed: for a chat
+        # completion that would bill (and wait for) the same prompt twice.
+        read=False,
+        status_forcelist=retry_statuses,
+        allowed_methods=frozenset(retry_methods),
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        # Retry-After from OpenRouter can be a minute; sleeping that long would pin a worker.
+        respect_retry_after_header=False,
+        # Hand the last 429/5xx back to the caller so raise_for_status() reports it as before
+        raise_on_status=False,
+    )
+    size = pool_size or HTTP_POOL_SIZE
+    counters = PoolCounters()
+    adapter = CountingAdapter(counters, pool_connections=size, pool_maxsize=size, max_retries=retry)
+    session = PooledSession(timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), counters)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def get_session(name="default", **options):
+    """
+    Returns this process's shared session for `name` (e.g. "openrouter", "backend"),
+    creating it on first use. `options` are passed to build_session() on creation only.
+    """
+    global _sessions_pid
+    pid = os.getpid()
+    with _sessions_lock:
+        if _sessions_pid != pid:
+            # First call in this process, or we were forked: start with fresh pools
+            _sessions.clear()
+            _sessions_pid = pid
+        session = _sessions.get(name)
+        if session is None:
+            session = _sessions[name] = build_session(**options)
+        return session
+
+
+def pool_stats():
+    """
+    Connection reuse counters per session for this process.
+    misses = new connections opened, hits = requests served on an already-open connection.
+    """
+    with _sessions_lock:
+        sessions = dict(_sessions) if _sessions_pid == os.getpid() else {}
+    return {
+        "pid": os.getpid(),
+        "sessions": {name: session.counters.snapshot() for name, session in sessions.items()},
+    }
@@ -0,0 +1,390 @@
+# FunnX.Ai/loadtest.py
+# Load test of the backend against mock providers, reported as JSON.
+#
+#   python loadtest.py -o bench.json
+#   python loadtest.py --scenarios single,burst --compare bench.json
+#
+# Starts two mock_llm.py servers (stand-ins for Gemini and OpenRouter), writes a
+# MODELS_CONFIG that points both providers at them, and starts the backend the way
+# the Procfile does (gunicorn --config gunicorn.conf.py, sync mode), with rate limits
+# and caches off and its state files in a temporary directory. Then it runs each
+# scenario:
+#   single    closed loop: --concurrency clients sending /chat to one model back to back
+#   stream    the same over /chat/stream, also timing the first answer line
+#   try_both  closed loop over /chat/multi with both models
+#   burst     open loop: --burst-size /chat requests at once, --bursts times, --burst-interval apart
+#
+# For each scenario the report has RPS, latency p50/p95/p99 (ms), the error rate,
+# errors by HTTP status (or "stream_error" for an error inside a 200 NDJSON response,
+# "connection" when no response came back) and the calls the mocks received. The git
+# commit, backend and mock settings are recorded too, and --compare prints the change
+# against an earlier report, so runs on different commits can be compared.
+#
+# No real provider is called: both API keys are set to dummy values for the backend.
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GEMINI_MODEL = "Gemini"
+OPENROUTER_MODEL = "DeepSeek (via OpenRouter)"
+SCENARIOS = ("single", "stream", "try_both", "burst")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until(check, timeout, what):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.1)
+    raise SystemExit(f"Timed out waiting for {what}.")
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=HERE,
+                                    capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+# --- Processes under test ---
+
+class Stack:
+    """The two mock providers and the backend under gunicorn, on free local ports."""
+
+    def __init__(self, args):
+        self.args = args
+        self.processes = []
+        self.tmp = tempfile.TemporaryDirectory(prefix="funnx-loadtest-")
+        self.mocks = {}
+        self.url = None
+
+    def start_mock(self, name, latency):
+        port = free_port()
+        command = [sys.executable, os.path.join(HERE, "mock_llm.py"), "--port", str(port),
+                   "--latency", latency, "--error-429", str(self.args.error_429),
+                   "--error-5xx", str(self.args.error_5xx)]
+        self.processes.append(subprocess.Popen(command, stderr=subprocess.DEVNULL))
+        self.mocks[name] = f"http://127.0.0.1:{port}"
+        wait_until(lambda: requests.get(f"{self.mocks[name]}/stats", timeout=1).ok, 10, f"the {name} mock")
+
+    def start(self):
+        self.start_mock("gemini", self.args.gemini_latency)
+        self.start_mock("openrouter", self.args.openrouter_latency)
+        config_path = os.path.join(self.tmp.name, "models.json")
+        with open(config_path, "w") as f:
+            json.dump({"providers": {
+                "gemini": {"type": "gemini", "label": "Gemini", "api_key_env": "GOOGLE_API_KEY",
+                           "base_url": self.mocks["gemini"]},
+                "openrouter": {"type": "openai_compatible", "label": "OpenRouter", "api_key_env": "OPENROUTER_API_KEY",
+                               "base_url": f"{self.mocks['openrouter']}/api/v1"},
+            }}, f)
+
+        port = free_port()
+        env = {
+            **os.environ,
+            "GOOGLE_API_KEY": "mock",
+            "OPENROUTER_API_KEY": "mock",
+            "MODELS_CONFIG": config_path,
+            "SERVER_MODE": "sync",
+            "WEB_CONCURRENCY": str(self.args.workers),
+            "GUNICORN_THREADS": str(self.args.threads),
+            "RESPONSE_CACHE": "off",
+            "SEMANTIC_CACHE": "off",
+            "USER_RATE_LIMIT_PER_MINUTE": "0",
+            "RATE_LIMIT_PATH": os.path.join(self.tmp.name, "rate_limits.sqlite3"),
+            "HISTORY_DB_PATH": os.path.join(self.tmp.name, "history.sqlite3"),
+            "SINGLE_FLIGHT_PATH": os.path.join(self.tmp.name, "single_flight.sqlite3"),
+            "USAGE_DB_PATH": os.path.join(self.tmp.name, "usage.sqlite3"),
+            "SESSION_SECRET_PATH": os.path.join(self.tmp.name, "session_secret.key"),
+            "LOG_LEVEL": "WARNING",
+            **self.args.env,
+        }
+        command = [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}"]
+        log = open(os.path.join(self.tmp.name, "backend.log"), "w")
+        self.processes.append(subprocess.Popen(command, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT))
+        self.url = f"http://127.0.0.1:{port}"
+        # Several 200s in a row, so most workers have finished warming up
+        streak = [0]
+
+        def backend_ready():
+            streak[0] = streak[0] + 1 if requests.get(f"{self.url}/ready", timeout=2).status_code == 200 else 0
+            return streak[0] >= self.args.workers * 2
+
+        wait_until(backend_ready, 60, f"the backend (log: {log.name})")
+
+    def mock_stats(self):
+        return {name: requests.get(f"{url}/stats", timeout=5).json()["requests"] for name, url in self.mocks.items()}
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.tmp.cleanup()
+
+
+# --- Requests ---
+
+class Client:
+    """Sends scenario requests; one keep-alive session per client thread."""
+
+    def __init__(self, url):
+        self.url = url
+        self.local = threading.local()
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    @property
+    def session(self):
+        if getattr(self.local, "session", None) is None:
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def message(self):
+        # A different prompt every time, so nothing is served from a cache
+        with self.lock:
+            self.counter += 1
+            return f"load test prompt {self.counter}"
+
+    def chat(self, model):
+        """Returns (seconds, error or None, seconds to first answer line or None)."""
+        started = time.perf_counter()
+        try:
+            response = self.session.post(f"{self.url}/chat", json={"message": self.message(), "model": model}, timeout=120)
+        except requests.exceptions.RequestException:
+            return time.perf_counter() - started, "connection", None
+        return time.perf_counter() - started, None if response.status_code == 200 else str(response.status_code), None
+
+    def ndjson(self, endpoint, body):
+        started = time.perf_counter()
+        first = None
+        error = None
+        try:
+            with self.session.post(f"{self.url}/{endpoint}", json=body, stream=True, timeout=120) as response:
+                if response.status_code != 200:
+                    return time.perf_counter() - started, str(response.status_code), None
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    if "error" in result:
+                        error = "stream_error"
+                    elif first is None and ("delta" in result or "response" in result):
+                        first = time.perf_counter() - started
+        except requests.exceptions.RequestException:
+            return time.perf_counter() - started, "connection", None
+        return time.perf_counter() - started, error, first
+
+    def stream(self, model):
+        return self.ndjson("chat/stream", {"message": self.message(), "model": model})
+
+    def try_both(self):
+        return self.ndjson("chat/multi", {"message": self.message(), "models": [GEMINI_MODEL, OPENROUTER_MODEL]})
+
+
+def closed_loop(call, requests_total, concurrency):
+    """`concurrency` clients each send their next request as soon as the last one is answered."""
+    results = []
+    remaining = iter(range(requests_total))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            results.append(call())
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    return results, time.perf_counter() - started
+
+
+def bursts(call, size, count, interval):
+    """`count` bursts of `size` simultaneous requests, started `interval` seconds apart."""
+    results = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=size * count) as pool:
+        futures = []
+        for burst in range(count):
+            delay = started + burst * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures += [pool.submit(call) for _ in range(size)]
+        results = [future.result() for future in futures]
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    latencies = sorted(seconds * 1000 for seconds, error, first in results if error is None)
+    firsts = sorted(first * 1000 for seconds, error, first in results if error is None and first is not None)
+    errors = {}
+    for _, error, _ in results:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    summary = {
+        "requests": len(results),
+        "ok": len(latencies),
+        "elapsed_s": round(elapsed, 2),
+        "rps": round(len(results) / elapsed, 2) if elapsed else None,
+        "error_rate": round(sum(errors.values()) / len(results), 4) if results else 0.0,
+        "errors": errors,
+        "latency_ms": {f"p{p}": round(percentile(latencies, p), 1) if latencies else None for p in (50, 95, 99)},
+    }
+    if firsts:
+        summary["first_line_ms"] = {f"p{p}": round(percentile(firsts, p), 1) for p in (50, 95, 99)}
+    return summary
+
+
+def upstream_calls(before, after):
+    calls = {}
+    for mock, counts in after.items():
+        for key, count in counts.items():
+            delta = count - before.get(mock, {}).get(key, 0)
+            if delta:
+                calls[f"{mock} {key.split()[-1]}"] = delta
+    return calls
+
+
+def run_scenario(name, client, args):
+    if name == "single":
+        results, elapsed = closed_loop(lambda: client.chat(args.model), args.requests, args.concurrency)
+        settings = {"model": args.model, "concurrency": args.concurrency}
+    elif name == "stream":
+        results, elapsed = closed_loop(lambda: client.stream(args.model), args.requests, args.concurrency)
+        settings = {"model": args.model, "concurrency": args.concurrency}
+    elif name == "try_both":
+        results, elapsed = closed_loop(client.try_both, args.requests, args.concurrency)
+        settings = {"models": [GEMINI_MODEL, OPENROUTER_MODEL], "concurrency": args.concurrency}
+    else:
+        results, elapsed = bursts(lambda: client.chat(args.model), args.burst_size, args.bursts, args.burst_interval)
+        settings = {"model": args.model, "burst_size": args.burst_size, "bursts": args.bursts,
+                    "burst_interval_s": args.burst_interval}
+    return {**settings, **summarize(results, elapsed)}
+
+
+def compare(baseline, report):
+    """Lines describing how each scenario's RPS and latency percentiles moved since `baseline`."""
+    lines = [f"Compared with {baseline.get('commit')} ({baseline.get('started_at')}):"]
+    for name, new in report["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is None:
+            continue
+        changes = []
+        pairs = [("rps", old.get("rps"), new.get("rps"))]
+        pairs += [(p, old["latency_ms"].get(p), new["latency_ms"].get(p)) for p in ("p50", "p95", "p99")]
+        pairs += [("error_rate", old.get("error_rate"), new.get("error_rate"))]
+        for label, before, after in pairs:
+            if before is None or after is None:
+                continue
+            change = f" ({(after - before) / before:+.1%})" if before else ""
+            changes.append(f"{label} {before} -> {after}{change}")
+        lines.append(f"  {name}: " + ", ".join(changes))
+    return lines
+
+
+def env_arg(value):
+    name, sep, setting = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE")
+    return name, setting
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the backend against mock LLM providers.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--model", default=GEMINI_MODEL, help="model for single, stream and burst")
+    parser.add_argument("--requests", type=int, default=200, help="requests per closed-loop scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--burst-size", type=int, default=50)
+    parser.add_argument("--bursts", type=int, default=3)
+    parser.add_argument("--burst-interval", type=float, default=5.0, help="seconds between bursts")
+    parser.add_argument("--workers", type=int, default=2, help="backend WEB_CONCURRENCY")
+    parser.add_argument("--threads", type=int, default=8, help="backend GUNICORN_THREADS")
+    parser.add_argument("--gemini-latency", default="0.5,0.3", help="mock Gemini MEDIAN,SIGMA seconds")
+    parser.add_argument("--openrouter-latency", default="1.5,0.5", help="mock OpenRouter MEDIAN,SIGMA seconds")
+    parser.add_argument("--error-429", type=float, default=0.0, help="share of mock calls answered with 429")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="share of mock calls answered with 503")
+    parser.add_argument("--env", type=env_arg, action="append", default=[],
+                        help="extra backend environment variable, NAME=VALUE (repeatable)")
+    parser.add_argument("-o", "--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", help="earlier JSON report to compare against")
+    args = parser.parse_args(argv)
+    args.env = dict(args.env)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = {
+        "commit": git_commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "backend": {"workers": args.workers, "threads": args.threads, "env": args.env},
+        "mock": {"gemini_latency": args.gemini_latency, "openrouter_latency": args.openrouter_latency,
+                 "error_429": args.error_429, "error_5xx": args.error_5xx},
+        "scenarios": {},
+    }
+    stack = Stack(args)
+    try:
+        stack.start()
+        client = Client(stack.url)
+        # Open the keep-alive connections and provider sessions before timing anything
+        closed_loop(lambda: client.chat(args.model), args.workers * args.threads, args.workers * args.threads)
+        for name in scenarios:
+            print(f"Running {name}...", file=sys.stderr)
+            before = stack.mock_stats()
+            result = run_scenario(name, client, args)
+            result["upstream_calls"] = upstream_calls(before, stack.mock_stats())
+            report["scenarios"][name] = result
+    finally:
+        stack.stop()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            print("\n".join(compare(json.load(f), report)), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
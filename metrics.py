@@ -0,0 +1,235 @@
+# FunnX.Ai/metrics.py
+# Request and upstream-call metrics, served in the Prometheus text format on /metrics.
+#
+# Recorded in providers.py (per-provider latency, time to first token, payload
+# sizes, errors by class) and by the request hooks in api.py / asgi.py. Response
+# cache and connection pool counters are read from response_cache.py,
+# semantic_cache.py and http_client.py when /metrics is scraped.
+#
+# Like /pool_stats and /cache_stats, values are per worker process: each gunicorn
+# worker answers a scrape with its own counts (the pid is in funnx_worker_info).
+import os
+import bisect
+import threading
+import response_cache
+import semantic_cache
+import structured_logging
+from http_client import pool_stats
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {total:g}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+# --- Metrics recorded by the backend ---
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "funnx_http_request_duration_seconds",
+    "Time until the response started, by endpoint (streamed bodies: see funnx_upstream_*).",
+    ("endpoint", "method", "status"),
+)
+UPSTREAM_SECONDS = Histogram(
+    "funnx_upstream_latency_seconds",
+    "Provider call duration, until the full answer was received.",
+    ("provider", "model", "mode"),
+)
+UPSTREAM_TTFT_SECONDS = Histogram(
+    "funnx_upstream_ttft_seconds",
+    "Time to the first streamed chunk of an answer.",
+    ("provider", "model"),
+    buckets=TTFT_BUCKETS,
+)
+UPSTREAM_REQUEST_BYTES = Histogram(
+    "funnx_upstream_request_bytes",
+    "UTF-8 size of the messages sent to the provider.",
+    ("provider",),
+    buckets=SIZE_BUCKETS,
+)
+UPSTREAM_RESPONSE_BYTES = Histogram(
+    "funnx_upstream_response_bytes",
+    "UTF-8 size of the answer received from the provider.",
+    ("provider",),
+    buckets=SIZE_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    "funnx_upstream_errors_total",
+    "Failed provider calls by error class (http_<status>, timeout, connection, config, stream_error, empty, other).",
+    ("provider", "model", "error"),
+)
+
+REGISTRY = [
+    HTTP_REQUEST_SECONDS,
+    UPSTREAM_SECONDS,
+    UPSTREAM_TTFT_SECONDS,
+    UPSTREAM_REQUEST_BYTES,
+    UPSTREAM_RESPONSE_BYTES,
+    UPSTREAM_ERRORS,
+]
+
+
+# --- Counters owned by other modules, read at scrape time ---
+
+def gauge_lines(name, help_text, kind, samples):
+    """samples: list of (labels as [(name, value)], value)."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{format_labels((), (), labels)} {value:g}" for labels, value in samples]
+    return lines
+
+
+def cache_lines():
+    stats = response_cache.stats()
+    if not stats["enabled"]:
+        return []
+    return (
+        gauge_lines("funnx_cache_lookups_total", "Response cache lookups by result.", "counter", [
+            ([("result", "memory_hit")], stats["memory_hits"]),
+            ([("result", "shared_hit")], stats["shared_hits"]),
+            ([("result", "miss")], stats["misses"]),
+        ])
+        + gauge_lines("funnx_cache_stores_total", "Answers written to the response cache.", "counter",
+                      [([], stats["stores"])])
+        + gauge_lines("funnx_cache_errors_total", "Response cache storage errors.", "counter",
+                      [([], stats["errors"])])
+        + gauge_lines("funnx_cache_memory_bytes", "Size of the in-memory response cache tier.", "gauge",
+                      [([], stats["memory_bytes"])])
+        + gauge_lines("funnx_cache_memory_evictions_total", "Entries evicted from the in-memory tier.", "counter",
+                      [([], stats["memory_evictions"])])
+    )
+
+
+def semantic_cache_lines():
+    stats = semantic_cache.stats()
+    if not stats["enabled"]:
+        return []
+    return (
+        gauge_lines("funnx_semantic_cache_lookups_total", "Semantic cache lookups by result.", "counter", [
+            ([("result", "hit")], stats["hits"]),
+            ([("result", "miss")], stats["misses"]),
+        ])
+        + gauge_lines("funnx_semantic_cache_entries", "Prompts in the semantic cache index.", "gauge",
+                      [([], stats["entries"])])
+        + gauge_lines("funnx_semantic_cache_evictions_total", "Entries replaced in the semantic cache index.", "counter",
+                      [([], stats["evictions"])])
+    )
+
+
+def single_flight_lines():
+    # Imported here: single_flight imports providers, whose imports (rate_limiter.py,
+    # usage.py) create their counters from this module at import time
+    import single_flight
+    stats = single_flight.stats()
+    if stats["mode"] == "off":
+        return []
+    return (
+        gauge_lines("funnx_single_flight_requests_total",
+                    "First-turn cache misses by role: leader (called upstream), follower or relay (shared an answer).",
+                    "counter", [([("role", role)], stats[role]) for role in ("leader", "follower", "relay")])
+        + gauge_lines("funnx_single_flight_dedup_ratio", "Share of first-turn misses that shared another request's answer.",
+                      "gauge", [([], stats["dedup_ratio"])])
+        + gauge_lines("funnx_single_flight_in_flight", "Upstream calls currently being shared.", "gauge",
+                      [([], stats["in_flight"])])
+    )
+
+
+def logging_lines():
+    stats = structured_logging.stats()
+    return (
+        gauge_lines("funnx_log_records_total",
+                    "Log records written, dropped (queue full) or sampled out (LOG_SAMPLE_RATES).", "counter",
+                    [([("outcome", outcome)], stats[outcome]) for outcome in ("written", "dropped", "sampled_out")])
+        + gauge_lines("funnx_log_queue_depth", "Log records waiting for the writer thread.", "gauge",
+                      [([], stats["queued"])])
+    )
+
+
+def pool_lines():
+    sessions = pool_stats()["sessions"]
+    return (
+        gauge_lines("funnx_http_pool_requests_total", "Outbound requests per pooled session.", "counter",
+                    [([("session", name)], s["requests"]) for name, s in sorted(sessions.items())])
+        + gauge_lines("funnx_http_pool_connects_total", "New connections opened (pool misses) per session.", "counter",
+                      [([("session", name)], s["misses"]) for name, s in sorted(sessions.items())])
+    )
+
+
+def render():
+    """The full /metrics page for this worker."""
+    lines = gauge_lines("funnx_worker_info", "Worker process that answered this scrape.", "gauge",
+                        [([("pid", os.getpid())], 1)])
+    for metric in REGISTRY:
+        lines += metric.render()
+    lines += cache_lines()
+    lines += semantic_cache_lines()
+    lines += single_flight_lines()
+    lines += logging_lines()
+    lines += pool_lines()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,209 @@
+# FunnX.Ai/mock_llm.py
+# Local stand-in for the Gemini and OpenRouter chat APIs, so the backend can be
+# load-tested without spending API quota (see loadtest.py).
+#
+#   python mock_llm.py --port 8790 --latency 0.8,0.4 --error-429 0.02 --error-5xx 0.01
+#
+# One server speaks both APIs:
+#   POST .../chat/completions                          OpenAI/OpenRouter format; "stream": true sends SSE
+#   GET  .../models                                    (opened by WARM_UP_CONNECTIONS=1)
+#   POST /v1beta/models/{model}:generateContent        Gemini REST format
+#   POST /v1beta/models/{model}:streamGenerateContent  Gemini REST format, a streamed JSON array
+#   GET  /stats                                        requests answered so far, by API and status
+# Point a provider at it with "base_url" in a MODELS_CONFIG file, e.g.
+#   {"providers": {"gemini": {"type": "gemini", "api_key_env": "GOOGLE_API_KEY",
+#                             "base_url": "http://127.0.0.1:8790"}}}
+#
+# Each answer takes a latency drawn from a log-normal distribution (--latency MEDIAN,SIGMA
+# in seconds). A streamed answer sends its first chunk after --ttft-share of that latency
+# and spreads --chunks chunks over the rest. --error-429 and --error-5xx are the shares of
+# requests answered, after --error-delay seconds, with 429 (and a Retry-After) or 503.
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORDS = "the mock model streams this answer in small chunks so the backend can be timed".split()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finish(self, api, status):
+        with self.lock:
+            self.in_flight -= 1
+            key = f"{api} {status}"
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": dict(self.counts), "in_flight": self.in_flight, "max_in_flight": self.max_in_flight}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = None
+    stats = Stats()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/stats":
+            self.send_json(200, self.stats.snapshot())
+        elif path.endswith("/models"):
+            self.send_json(200, {"data": [{"id": "mock"}]})
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"No mock route for {path}"}})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if path.endswith("/chat/completions"):
+            api, stream = "openai", bool(body.get("stream"))
+            prompt = body["messages"][-1]["content"]
+        elif path.endswith(":generateContent") or path.endswith(":streamGenerateContent"):
+            api, stream = "gemini", path.endswith(":streamGenerateContent")
+            prompt = body["contents"][-1]["parts"][0]["text"]
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"No mock route for {path}"}})
+            return
+
+        self.stats.start()
+        status = 200
+        try:
+            status = self.answer(api, stream, prompt)
+        finally:
+            self.stats.finish(api, status)
+
+    def answer(self, api, stream, prompt):
+        settings = self.settings
+        roll = random.random()
+        if roll < settings.error_429 + settings.error_5xx:
+            status = 429 if roll < settings.error_429 else 503
+            time.sleep(settings.error_delay)
+            message = "Resource has been exhausted (mock)" if status == 429 else "The model is overloaded (mock)"
+            error = {"code": status, "message": message}
+            if api == "gemini":
+                error["status"] = "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"
+            self.send_json(status, {"error": error}, {"Retry-After": "1"} if status == 429 else None)
+            return status
+
+        latency = settings.median * math.exp(settings.sigma * random.gauss(0, 1))
+        chunks = [f"Mock answer to '{prompt[:40]}':"] + [
+            " " + WORDS[i % len(WORDS)] for i in range(max(settings.chunks - 1, 0))
+        ]
+        if not stream:
+            time.sleep(latency)
+            text = "".join(chunks)
+            if api == "gemini":
+                self.send_json(200, gemini_response(text))
+            else:
+                self.send_json(200, {"choices": [{"message": {"role": "assistant", "content": text}}]})
+            return 200
+
+        time.sleep(latency * settings.ttft_share)
+        gap = latency * (1 - settings.ttft_share) / max(len(chunks) - 1, 1)
+        if api == "gemini":
+            # The REST transport reads a JSON array, one response object per element
+            self.start_chunked("application/json")
+            for i, chunk in enumerate(chunks):
+                if i:
+                    time.sleep(gap)
+                self.write_chunk(((",\r\n" if i else "[") + json.dumps(gemini_response(chunk))).encode("utf-8"))
+            self.write_chunk(b"]")
+        else:
+            self.start_chunked("text/event-stream")
+            for i, chunk in enumerate(chunks):
+                if i:
+                    time.sleep(gap)
+                line = {"choices": [{"delta": {"content": chunk}}]}
+                self.write_chunk(f"data: {json.dumps(line)}\n\n".encode("utf-8"))
+            self.write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        return 200
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of connections shouldn't be refused by a short listen backlog
+    request_queue_size = 1024
+
+
+def gemini_response(text):
+    # finishReason 1 is STOP (the SDK asks for integer enums)
+    return {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": 1}]}
+
+
+def latency_arg(value):
+    median, _, sigma = value.partition(",")
+    return float(median), float(sigma or 0)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Gemini/OpenRouter API server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--latency", type=latency_arg, default=(0.5, 0.3),
+                        help="MEDIAN,SIGMA of the log-normal answer latency in seconds (default 0.5,0.3)")
+    parser.add_argument("--ttft-share", type=float, default=0.3, help="share of the latency before the first streamed chunk")
+    parser.add_argument("--chunks", type=int, default=8, help="chunks per streamed answer")
+    parser.add_argument("--error-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--error-delay", type=float, default=0.05, help="seconds before an error is returned")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+    args.median, args.sigma = args.latency
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    MockHandler.settings = args
+    server = MockServer((args.host, args.port), MockHandler)
+    print(f"Mock LLM API on http://{args.host}:{args.port} (latency median {args.median}s, sigma {args.sigma})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,780 @@
+# FunnX.Ai/providers.py
+# Provider client registry.
+#
+# Models shown in the app are configuration entries in MODELS, each pointing at a
+# provider in PROVIDERS. Provider clients (and Gemini model objects) are created
+# once per worker process and reused by every request. Adding a model is a new
+# MODELS entry; adding an OpenAI-compatible provider is a new PROVIDERS entry.
+# Both can also be supplied without code changes via a JSON file named by the
+# MODELS_CONFIG environment variable:
+#   {"providers": {"groq": {"type": "openai_compatible", ...}},
+#    "models": {"Llama 3 (via Groq)": {"provider": "groq", "model_id": "...", "label": "Llama 3"}}}
+#
+# Provider SDKs are imported on first use, not at import time: google.generativeai
+# alone takes ~0.5 s to import, which used to delay every worker's first /ping.
+# warm_up() does the imports (see boot.py), and /ready reports which providers are done.
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+import requests
+from http_client import get_session, HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+import metrics
+import rate_limiter
+import usage
+from tokens import count_tokens
+
+try:
+    import httpx
+except ImportError:  # Only needed for the async serving mode (asgi.py)
+    httpx = None
+
+# Exception classes from both HTTP stacks: requests (sync, api.py) and httpx (async, asgi.py)
+HTTP_STATUS_ERRORS = (requests.exceptions.HTTPError,) + ((httpx.HTTPStatusError,) if httpx else ())
+CONNECTION_ERRORS = (requests.exceptions.ConnectionError,) + ((httpx.ConnectError,) if httpx else ())
+TIMEOUT_ERRORS = (requests.exceptions.Timeout,) + ((httpx.TimeoutException,) if httpx else ())
+
+log = logging.getLogger(__name__)
+# Share of upstream calls whose full request/response is logged when LOG_LEVEL=DEBUG
+DEBUG_LOG_SAMPLE_RATE = float(os.getenv("DEBUG_LOG_SAMPLE_RATE", "1.0"))
+
+
+def debug_sampled():
+    """True if this call's payloads should be dumped. Costs one level check when DEBUG is off."""
+    return log.isEnabledFor(logging.DEBUG) and random.random() < DEBUG_LOG_SAMPLE_RATE
+
+PROVIDERS = {
+    "gemini": {
+        "type": "gemini",
+        "label": "Gemini",
+        "api_key_env": "GOOGLE_API_KEY",
+        # Optional "base_url" sends calls to a Gemini-compatible endpoint over REST
+        # instead of Google's gRPC API (e.g. mock_llm.py for load tests). Sync serving
+        # mode only: the SDK has no async REST client.
+    },
+    # Optional "rate_limit": {"per_minute": 60, "burst": 10} caps calls to a provider
+    # across all workers (see rate_limiter.py); without one, calls are not limited.
+    "openrouter": {
+        "type": "openai_compatible",
+        "label": "OpenRouter",
+        "api_key_env": "OPENROUTER_API_KEY",
+        "base_url": "https://openrouter.ai/api/v1",
+        "headers": {"HTTP-Referer": "https://funnx.ai", "X-Title": "FunnX.Ai"},
+    },
+}
+
+MODELS = {
+    # Optional per-model keys:
+    #   "cache_ttl"      seconds, overrides RESPONSE_CACHE_TTL (see response_cache.py)
+    #   "context_tokens" history+prompt token budget, overrides CONTEXT_TOKEN_BUDGET (see context_builder.py)
+    #   "token_scale"    ratio of the model's token counts to ours (see tokens.py)
+    #   "input_price", "output_price"  USD per million prompt/answer tokens, for usage accounting (see usage.py)
+    "Gemini": {"provider": "gemini", "model_id": "gemini-1.5-flash", "label": "Gemini",
+               "input_price": 0.075, "output_price": 0.30},
+    "DeepSeek (via OpenRouter)": {"provider": "openrouter", "model_id": "deepseek/deepseek-r1", "label": "DeepSeek",
+                                  "input_price": 0.55, "output_price": 2.19},
+}
+
+
+class ChatError(Exception):
+    """A provider failure with the message to show the user and the HTTP status to return."""
+
+    def __init__(self, message, status=500, kind=None, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        # Error class for metrics when there is no underlying exception to classify (see error_kind())
+        self.kind = kind
+        # Seconds, sent as a Retry-After header with 429 responses
+        self.retry_after = retry_after
+
+
+def retry_after_seconds(value):
+    """Parses a provider's Retry-After header (seconds form only)."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class FallbackText(str):
+    """Placeholder answer returned when a provider sent nothing usable. Never cached."""
+
+
+# --- Providers ---
+# Every provider takes `messages` as a list of {"role": "user"|"assistant", "content": str}
+# and implements complete() -> str, stream() -> iterator of str, and warm_up(), plus
+# the coroutine versions acomplete() and astream() used by the async serving mode.
+
+class GeminiProvider:
+    def __init__(self, name, label, api_key_env, base_url=None, **options):
+        self.name = name
+        self.label = label
+        self.api_key_env = api_key_env
+        self.api_key = os.getenv(api_key_env)
+        self.base_url = base_url
+        self._models = {}
+        self._lock = threading.Lock()
+        self._sdk_lock = threading.Lock()
+        self._genai = None
+        if not self.api_key:
+            log.warning("API key not found in .env file; API calls may fail", extra={"provider": label, "api_key_env": api_key_env})
+
+    @property
+    def genai(self):
+        """google.generativeai, imported and configured on first use."""
+        if self._genai is None:
+            with self._sdk_lock:
+                if self._genai is None:
+                    import google.generativeai as genai
+                    endpoint = {}
+                    if self.base_url:
+                        endpoint = {"transport": "rest", "client_options": {"api_endpoint": self.base_url}}
+                    if self.api_key:
+                        try:
+                            genai.configure(api_key=self.api_key, **endpoint)
+                            log.info("API configured", extra={"provider": self.label})
+                        except Exception as e:
+                            log.error("failed to configure API", extra={"provider": self.label, "api_key_env": self.api_key_env, "error": str(e)})
+                    self._genai = genai
+        return self._genai
+
+    def check_ready(self):
+        if not self.api_key:
+            log.error("API key missing", extra={"provider": self.label, "api_key_env": self.api_key_env})
+            raise ChatError(f"{self.label} API Key is missing. Please set {self.api_key_env} in your .env file.", kind="config")
+
+    def check_async(self):
+        self.check_ready()
+        if self.base_url:
+            raise ChatError(f"{self.label} with a base_url only works in the sync serving mode (SERVER_MODE=sync).", kind="config")
+
+    def get_model(self, model_id):
+        """Returns the cached GenerativeModel for `model_id`, creating it on first use."""
+        model = self._models.get(model_id)
+        if model is None:
+            genai = self.genai
+            with self._lock:
+                model = self._models.get(model_id)
+                if model is None:
+                    model = self._models[model_id] = genai.GenerativeModel(model_id)
+        return model
+
+    @staticmethod
+    def to_contents(messages):
+        # Gemini calls the assistant role "model" and expects roles to alternate, so
+        # consecutive same-role messages (e.g. a turn whose answer failed) are merged.
+        contents = []
+        for m in messages:
+            role = "model" if m["role"] == "assistant" else "user"
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"].append(m["content"])
+            else:
+                contents.append({"role": role, "parts": [m["content"]]})
+        return contents
+
+    def describe_error(self, e):
+        error_msg = f"{self.label} API error: {str(e)}"
+        log.error("upstream call failed", extra={"provider": self.label, "error": str(e)})
+        if "404 models/" in str(e):
+            error_msg += ". Model not found or not available in your region. Check Google Cloud Console."
+        elif "authentication" in str(e).lower() or "api key" in str(e).lower() or "permission" in str(e).lower():
+            error_msg += f". Please check your {self.api_key_env} for validity and permissions."
+        return error_msg
+
+    def chat_error(self, e):
+        # google.api_core's ResourceExhausted (quota) has code 429; pass it on instead of a 500
+        if getattr(e, "code", None) == 429:
+            return ChatError(self.describe_error(e), status=429)
+        return ChatError(self.describe_error(e))
+
+    @staticmethod
+    def extract_text(model, gemini_raw_response):
+        if gemini_raw_response and gemini_raw_response.candidates and gemini_raw_response.candidates[0].content.parts:
+            return gemini_raw_response.candidates[0].content.parts[0].text
+        log.warning("empty or malformed response", extra={"model": model["label"], "response": gemini_raw_response})
+        return FallbackText(f"{model['label']} returned an empty or unparseable response. Try again.")
+
+    @staticmethod
+    def chunk_text(chunk):
+        # Chunks without text parts (e.g. safety-only chunks) raise on .text
+        if chunk.candidates and chunk.candidates[0].content.parts:
+            return chunk.text
+        return None
+
+    def complete(self, model, messages):
+        self.check_ready()
+        try:
+            gemini_raw_response = self.get_model(model["model_id"]).generate_content(self.to_contents(messages))
+        except Exception as e:
+            raise self.chat_error(e)
+        return self.extract_text(model, gemini_raw_response)
+
+    def stream(self, model, messages):
+        self.check_ready()
+        try:
+            for chunk in self.get_model(model["model_id"]).generate_content(self.to_contents(messages), stream=True):
+                text = self.chunk_text(chunk)
+                if text:
+                    yield text
+        except Exception as e:
+            raise self.chat_error(e)
+
+    async def acomplete(self, model, messages):
+        self.check_async()
+        try:
+            gemini_raw_response = await self.get_model(model["model_id"]).generate_content_async(self.to_contents(messages))
+        except Exception as e:
+            raise self.chat_error(e)
+        return self.extract_text(model, gemini_raw_response)
+
+    async def astream(self, model, messages):
+        self.check_async()
+        try:
+            response = await self.get_model(model["model_id"]).generate_content_async(self.to_contents(messages), stream=True)
+            async for chunk in response:
+                text = self.chunk_text(chunk)
+                if text:
+                    yield text
+        except Exception as e:
+            raise self.chat_error(e)
+
+    def warm_up(self, model, connect=False):
+        self.get_model(model["model_id"])
+
+
+class OpenAICompatibleProvider:
+    """Any provider exposing an OpenAI-style /chat/completions API (OpenRouter, Groq, ...)."""
+
+    def __init__(self, name, label, api_key_env, base_url, headers=None, **options):
+        self.name = name
+        self.label = label
+        self.api_key_env = api_key_env
+        self.api_key = os.getenv(api_key_env)
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        self.base_url = base_url
+        self.extra_headers = headers or {}
+        self._async_client = None
+        if not self.api_key:
+            log.warning("API key not found in .env file; API calls may fail", extra={"provider": label, "api_key_env": api_key_env})
+        else:
+            log.info("API key loaded", extra={"provider": label})
+
+    @property
+    def session(self):
+        # One pooled keep-alive session per provider per process (see http_client.py)
+        return get_session(self.name)
+
+    @property
+    def async_client(self):
+        # Created on first use inside the worker's event loop; pooled like the sync session
+        if self._async_client is None:
+            if httpx is None:
+                raise ChatError("The async serving mode needs httpx. Install it with `pip install httpx`.")
+            limits = httpx.Limits(max_connections=HTTP_POOL_SIZE * 10, max_keepalive_connections=HTTP_POOL_SIZE)
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                # httpx only retries failed connects; 429/5xx are reported to the user as-is
+                transport=httpx.AsyncHTTPTransport(retries=HTTP_MAX_RETRIES, limits=limits),
+            )
+        return self._async_client
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.api_key}", **self.extra_headers}
+
+    def redacted_headers(self):
+        return {**self.headers(), "Authorization": "Bearer ***"}
+
+    def check_ready(self):
+        if not self.api_key:
+            log.error("API key missing", extra={"provider": self.label, "api_key_env": self.api_key_env})
+            raise ChatError(f"{self.label} API Key is missing. Please set {self.api_key_env} in your .env file.", kind="config")
+
+    def describe_error(self, e, model):
+        if isinstance(e, HTTP_STATUS_ERRORS):
+            try:
+                error_body_str = json.dumps(e.response.json(), indent=2)
+            except json.JSONDecodeError:
+                error_body_str = e.response.text
+            error_msg = f"{self.label} API HTTP error (Status: {e.response.status_code}): {error_body_str}"
+            log.error("upstream call failed", extra={"provider": self.label, "status": e.response.status_code, "error": error_body_str})
+            if e.response.status_code == 401:
+                error_msg += f". This usually means your {self.api_key_env} is incorrect or invalid."
+            elif e.response.status_code == 404:
+                error_msg += f". Model not found or incorrect model ID ('{model['model_id']}'?) on {self.label}. Check {self.label}'s model list."
+            elif e.response.status_code == 429:
+                error_msg += f". Rate limit exceeded on {self.label}. Try again after some time."
+        elif isinstance(e, CONNECTION_ERRORS):
+            error_msg = f"{self.label} API Connection Error: Backend could not connect to {self.label}. Check internet."
+            log.error("upstream connection failed", extra={"provider": self.label, "error": str(e)})
+        elif isinstance(e, TIMEOUT_ERRORS):
+            error_msg = f"{self.label} API request timed out after {HTTP_READ_TIMEOUT:g} seconds. Server might be slow."
+            log.error("upstream call timed out", extra={"provider": self.label, "timeout_s": HTTP_READ_TIMEOUT})
+        else:
+            error_msg = f"Unexpected {model['label']} API error: {str(e)}"
+            log.error("upstream call failed", extra={"model": model["label"], "error": str(e)})
+        return error_msg
+
+    def chat_error(self, e, model):
+        if isinstance(e, HTTP_STATUS_ERRORS) and e.response.status_code == 429:
+            return ChatError(self.describe_error(e, model), status=429,
+                             retry_after=retry_after_seconds(e.response.headers.get("Retry-After")))
+        return ChatError(self.describe_error(e, model))
+
+    def complete(self, model, messages):
+        self.check_ready()
+        payload = {"model": model["model_id"], "messages": messages}
+        sampled = debug_sampled()
+        try:
+            if sampled:
+                # Serialized (and truncated/redacted) on the logging thread, not here
+                log.debug("upstream request", extra={"provider": self.label, "url": self.url,
+                                                      "headers": self.redacted_headers(), "payload": payload})
+
+            response_from_router = self.session.post(self.url, headers=self.headers(), json=payload)
+            response_from_router.raise_for_status()
+
+            data = response_from_router.json()
+            if sampled:
+                log.debug("upstream response", extra={"model": model["label"], "response": data})
+        except Exception as e:
+            raise self.chat_error(e, model)
+        return self.extract_text(model, data)
+
+    @staticmethod
+    def extract_text(model, data):
+        if data and 'choices' in data and len(data['choices']) > 0 and \
+           'message' in data['choices'][0] and 'content' in data['choices'][0]['message']:
+            return data['choices'][0]['message']['content']
+        log.warning("empty or malformed response", extra={"model": model["label"], "response": data})
+        return FallbackText(f"{model['label']} returned an empty or unparseable response. Please try again or select a different model.")
+
+    def parse_sse_line(self, line):
+        """
+        Returns (done, delta) for one line of the SSE stream. Blank lines separate
+        events and lines starting with ':' are keep-alive comments; both give (False, None).
+        """
+        if not line or not line.startswith("data:"):
+            return False, None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return True, None
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            return False, None
+        if "error" in event:
+            raise ChatError(f"{self.label} API error: {event['error'].get('message', event['error'])}", kind="stream_error")
+        choices = event.get("choices") or []
+        if choices:
+            return False, choices[0].get("delta", {}).get("content")
+        return False, None
+
+    def stream(self, model, messages):
+        """Yields text chunks from the provider's SSE stream (stream: true)."""
+        self.check_ready()
+        payload = {"model": model["model_id"], "messages": messages, "stream": True}
+        try:
+            with self.session.post(self.url, headers=self.headers(), json=payload, stream=True) as response_from_router:
+                response_from_router.raise_for_status()
+                for line in response_from_router.iter_lines(decode_unicode=True):
+                    done, delta = self.parse_sse_line(line)
+                    if done:
+                        break
+                    if delta:
+                        yield delta
+        except ChatError:
+            raise
+        except Exception as e:
+            raise self.chat_error(e, model)
+
+    async def acomplete(self, model, messages):
+        self.check_ready()
+        payload = {"model": model["model_id"], "messages": messages}
+        try:
+            response_from_router = await self.async_client.post(self.url, headers=self.headers(), json=payload)
+            response_from_router.raise_for_status()
+            data = response_from_router.json()
+        except ChatError:
+            raise
+        except Exception as e:
+            raise self.chat_error(e, model)
+        return self.extract_text(model, data)
+
+    async def astream(self, model, messages):
+        self.check_ready()
+        payload = {"model": model["model_id"], "messages": messages, "stream": True}
+        try:
+            async with self.async_client.stream("POST", self.url, headers=self.headers(), json=payload) as response_from_router:
+                if response_from_router.is_error:
+                    # Load the body so describe_error() can include the provider's message
+                    await response_from_router.aread()
+                    response_from_router.raise_for_status()
+                async for line in response_from_router.aiter_lines():
+                    done, delta = self.parse_sse_line(line)
+                    if done:
+                        break
+                    if delta:
+                        yield delta
+        except ChatError:
+            raise
+        except Exception as e:
+            raise self.chat_error(e, model)
+
+    def warm_up(self, model, connect=False):
+        session = self.session
+        if connect:
+            # Open (and pool) the TLS connection now instead of on the first user request
+            try:
+                session.get(f"{self.base_url.rstrip('/')}/models", timeout=5)
+            except requests.exceptions.RequestException as e:
+                log.warning("warm-up connection failed", extra={"provider": self.label, "error": str(e)})
+
+
+PROVIDER_TYPES = {
+    "gemini": GeminiProvider,
+    "openai_compatible": OpenAICompatibleProvider,
+}
+
+
+def load_config():
+    """Built-in PROVIDERS/MODELS, extended or overridden by the MODELS_CONFIG JSON file."""
+    providers = {name: dict(config) for name, config in PROVIDERS.items()}
+    models = {name: dict(config) for name, config in MODELS.items()}
+    path = os.getenv("MODELS_CONFIG")
+    if path:
+        with open(path) as f:
+            extra = json.load(f)
+        providers.update(extra.get("providers", {}))
+        models.update(extra.get("models", {}))
+    for name, config in providers.items():
+        config.setdefault("label", name)
+    for name, model in models.items():
+        model.setdefault("label", name)
+    return providers, models
+
+
+PROVIDER_CONFIG, MODEL_CONFIG = load_config()
+
+# --- Registry: one client per provider per worker ---
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_provider(name):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                config = dict(PROVIDER_CONFIG[name])
+                provider_cls = PROVIDER_TYPES[config.pop("type")]
+                client = _clients[name] = provider_cls(name, **config)
+    return client
+
+
+def model_names():
+    return list(MODEL_CONFIG)
+
+
+def is_ready(model_name):
+    """True if the model's provider has its API key (without logging, unlike check_ready())."""
+    return bool(get_provider(MODEL_CONFIG[model_name]["provider"]).api_key)
+
+
+def cache_ttl(model_name):
+    """Per-model response cache TTL in seconds, or None for the default."""
+    return MODEL_CONFIG.get(model_name, {}).get("cache_ttl")
+
+
+def resolve(model_name):
+    """Returns (provider client, model config) for a display name. Raises ChatError(400) if unknown."""
+    model = MODEL_CONFIG.get(model_name)
+    if model is None:
+        raise ChatError("Invalid model selected", status=400)
+    return get_provider(model["provider"]), model
+
+
+# --- Model health: rolling latency and error rate, used by "Auto" routing (router.py) ---
+HEALTH_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))                      # recent calls kept per model
+HEALTH_WINDOW_SECONDS = float(os.getenv("ROUTER_WINDOW_SECONDS", "300"))   # older calls are forgotten
+
+
+class ModelHealth:
+    """
+    The last HEALTH_WINDOW calls to each model, per worker process. Latency samples are
+    per mode: "complete" is the full answer, "stream" the time to the first chunk.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, model, mode, seconds, ok):
+        key = (model["provider"], model["model_id"])
+        with self.lock:
+            window = self.samples.get(key)
+            if window is None:
+                window = self.samples[key] = deque(maxlen=HEALTH_WINDOW)
+            window.append((time.monotonic(), mode, seconds, ok))
+
+    def stats(self, model, mode):
+        """{"calls", "error_rate", "p50", "p95"} over the window; latencies are None without samples."""
+        cutoff = time.monotonic() - HEALTH_WINDOW_SECONDS
+        with self.lock:
+            window = [s for s in self.samples.get((model["provider"], model["model_id"]), ()) if s[0] >= cutoff]
+        errors = sum(1 for s in window if not s[3])
+        latencies = sorted(s[2] for s in window if s[3] and s[1] == mode)
+        return {
+            "calls": len(window),
+            "error_rate": errors / len(window) if window else 0.0,
+            "latency_samples": len(latencies),
+            "p50": latencies[len(latencies) // 2] if latencies else None,
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+        }
+
+
+health = ModelHealth()
+
+
+# --- Instrumentation (see metrics.py) ---
+
+def error_kind(e):
+    """Metrics label for a failed call: http_<status>, timeout, connection, or ChatError.kind."""
+    if e.kind:
+        return e.kind
+    # Providers raise ChatError while handling the original exception
+    cause = e.__cause__ or e.__context__
+    if isinstance(cause, HTTP_STATUS_ERRORS):
+        return f"http_{cause.response.status_code}"
+    if isinstance(cause, TIMEOUT_ERRORS):
+        return "timeout"
+    if isinstance(cause, CONNECTION_ERRORS):
+        return "connection"
+    # google.api_core errors carry the HTTP status as .code
+    if isinstance(getattr(cause, "code", None), int):
+        return f"http_{cause.code}"
+    return "other"
+
+
+def utf8_size(text):
+    return len(text.encode("utf-8"))
+
+
+def record_request(provider, messages):
+    metrics.UPSTREAM_REQUEST_BYTES.observe(sum(utf8_size(m["content"]) for m in messages), provider=provider.name)
+
+
+def record_error(provider, model, e, mode="complete"):
+    metrics.UPSTREAM_ERRORS.inc(provider=provider.name, model=model["model_id"], error=error_kind(e))
+    health.record(model, mode, None, ok=False)
+
+
+def record_answer(provider, model, mode, started, text, size=None):
+    elapsed = time.perf_counter() - started
+    metrics.UPSTREAM_SECONDS.observe(elapsed, provider=provider.name, model=model["model_id"], mode=mode)
+    metrics.UPSTREAM_RESPONSE_BYTES.observe(utf8_size(text) if size is None else size, provider=provider.name)
+    if isinstance(text, FallbackText):
+        metrics.UPSTREAM_ERRORS.inc(provider=provider.name, model=model["model_id"], error="empty")
+    if mode == "complete":
+        # Streams report their time to first chunk instead (record_first_chunk)
+        health.record(model, mode, elapsed, ok=not isinstance(text, FallbackText))
+
+
+def record_usage(model, started, messages, answer=None):
+    """Charges one upstream call to the current request's user (usage.py); no answer means it failed."""
+    seconds = time.perf_counter() - started
+    if answer is None:
+        usage.record(model["model_id"], 0, 0, 0.0, seconds, ok=False)
+        return
+    scale = model.get("token_scale", 1.0)
+    prompt_tokens = round(sum(count_tokens(m["content"]) for m in messages) * scale)
+    completion_tokens = round(count_tokens(answer) * scale)
+    cost = (prompt_tokens * model.get("input_price", 0) + completion_tokens * model.get("output_price", 0)) / 1e6
+    usage.record(model["model_id"], prompt_tokens, completion_tokens, cost, seconds)
+
+
+def record_first_chunk(provider, model, started):
+    elapsed = time.perf_counter() - started
+    metrics.UPSTREAM_TTFT_SECONDS.observe(elapsed, provider=provider.name, model=model["model_id"])
+    health.record(model, "stream", elapsed, ok=True)
+
+
+def timed_stream(provider, model, chunks, messages):
+    """Passes chunks through, recording time to first token, total latency, size and usage."""
+    started = time.perf_counter()
+    size = None
+    parts = []
+    try:
+        for chunk in chunks:
+            if size is None:
+                record_first_chunk(provider, model, started)
+                size = 0
+            size += utf8_size(chunk)
+            parts.append(chunk)
+            yield chunk
+    except ChatError as e:
+        record_error(provider, model, e, mode="stream")
+        record_usage(model, started, messages)
+        raise
+    except GeneratorExit:
+        # Abandoned by the client: what was streamed so far was still generated
+        record_usage(model, started, messages, "".join(parts))
+        raise
+    if size is None:
+        # Finished without a single chunk: as unusable as an empty answer
+        health.record(model, "stream", None, ok=False)
+    record_answer(provider, model, "stream", started, "", size or 0)
+    record_usage(model, started, messages, "".join(parts))
+
+
+async def atimed_stream(provider, model, chunks, messages):
+    """Async version of timed_stream()."""
+    started = time.perf_counter()
+    size = None
+    parts = []
+    try:
+        async for chunk in chunks:
+            if size is None:
+                record_first_chunk(provider, model, started)
+                size = 0
+            size += utf8_size(chunk)
+            parts.append(chunk)
+            yield chunk
+    except ChatError as e:
+        record_error(provider, model, e, mode="stream")
+        record_usage(model, started, messages)
+        raise
+    except GeneratorExit:
+        record_usage(model, started, messages, "".join(parts))
+        raise
+    if size is None:
+        # Finished without a single chunk: as unusable as an empty answer
+        health.record(model, "stream", None, ok=False)
+    record_answer(provider, model, "stream", started, "", size or 0)
+    record_usage(model, started, messages, "".join(parts))
+
+
+def check_ready(provider, model):
+    try:
+        provider.check_ready()
+    except ChatError as e:
+        record_error(provider, model, e, mode="stream")
+        raise
+
+
+# --- Admission control (see rate_limiter.py) ---
+
+def admit(provider):
+    """Takes a token from the provider's bucket. Returns seconds to wait; raises ChatError(429) if rejected."""
+    admitted, wait = rate_limiter.check_provider(provider.name, PROVIDER_CONFIG[provider.name].get("rate_limit"))
+    if not admitted:
+        raise ChatError(
+            f"{provider.label} is receiving too many requests right now. "
+            f"Please try again in {rate_limiter.retry_after_header(wait)} seconds.",
+            status=429, kind="rate_limited", retry_after=wait,
+        )
+    return wait
+
+
+async def aadmit(provider):
+    # The bucket store is SQLite; keep it off the event loop
+    wait = await asyncio.to_thread(admit, provider)
+    if wait:
+        await asyncio.sleep(wait)
+
+
+def ask_model(model_name, messages):
+    """Returns the full answer text. Raises ChatError on failure."""
+    provider, model = resolve(model_name)
+    time.sleep(admit(provider))
+    record_request(provider, messages)
+    started = time.perf_counter()
+    try:
+        text = provider.complete(model, messages)
+    except ChatError as e:
+        record_error(provider, model, e)
+        record_usage(model, started, messages)
+        raise
+    record_answer(provider, model, "complete", started, text)
+    record_usage(model, started, messages, text)
+    return text
+
+
+def stream_model(model_name, messages):
+    """
+    Returns an iterator of answer chunks. Configuration errors (unknown model,
+    missing key) raise ChatError immediately; upstream errors raise while iterating.
+    """
+    provider, model = resolve(model_name)
+    check_ready(provider, model)
+    time.sleep(admit(provider))
+    record_request(provider, messages)
+    return timed_stream(provider, model, provider.stream(model, messages), messages)
+
+
+async def aask_model(model_name, messages):
+    """Coroutine version of ask_model() for the async serving mode."""
+    provider, model = resolve(model_name)
+    await aadmit(provider)
+    record_request(provider, messages)
+    started = time.perf_counter()
+    try:
+        text = await provider.acomplete(model, messages)
+    except ChatError as e:
+        record_error(provider, model, e)
+        record_usage(model, started, messages)
+        raise
+    record_answer(provider, model, "complete", started, text)
+    record_usage(model, started, messages, text)
+    return text
+
+
+async def astream_model(model_name, messages):
+    """
+    Async version of stream_model() for the async serving mode. Awaiting it does the
+    admission checks (and any rate-limit wait) and returns an async iterator of chunks.
+    """
+    provider, model = resolve(model_name)
+    check_ready(provider, model)
+    await aadmit(provider)
+    record_request(provider, messages)
+    return atimed_stream(provider, model, provider.astream(model, messages), messages)
+
+
+# Provider name -> seconds its warm-up took, once all of its models warmed without error
+warmed = {}
+
+
+def warm_up(connect=False):
+    """Creates every configured provider client and model object, importing SDKs. Called at worker boot."""
+    for provider_name in PROVIDER_CONFIG:
+        started = time.perf_counter()
+        ok = True
+        for model_name, model in MODEL_CONFIG.items():
+            if model["provider"] != provider_name:
+                continue
+            try:
+                get_provider(provider_name).warm_up(model, connect=connect)
+            except Exception as e:
+                ok = False
+                log.warning("warm-up failed", extra={"model": model_name, "error": str(e)})
+        if ok:
+            warmed[provider_name] = time.perf_counter() - started
+    log.info("providers warmed up", extra={"providers": list(warmed)})
+
+
+def provider_status():
+    """Per provider: whether its API key is set and whether warm_up() has finished for it."""
+    return {
+        name: {
+            "configured": bool(get_provider(name).api_key),
+            "warmed": name in warmed,
+            "warm_up_seconds": round(warmed[name], 3) if name in warmed else None,
+        }
+        for name in PROVIDER_CONFIG
+    }
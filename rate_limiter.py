@@ -0,0 +1,186 @@
+# FunnX.Ai/rate_limiter.py
+# Token-bucket rate limits per provider and per user, shared by all gunicorn workers.
+#
+# Each bucket holds up to `burst` tokens and refills at `per_minute` / 60 per second;
+# a request takes one token. Bucket state lives in a small SQLite file
+# (RATE_LIMIT_PATH), updated in one IMMEDIATE transaction per decision, so every
+# worker on the host draws from the same buckets. If the file can't be opened at
+# startup, each worker keeps its own buckets in memory instead.
+#
+# When the bucket is empty a request may reserve a future token and wait for it
+# (the balance goes negative; -balance is the queue). The queue is bounded:
+# a request is rejected at once, with a Retry-After, if RATE_LIMIT_MAX_QUEUE
+# requests are already waiting or its token would arrive later than
+# RATE_LIMIT_MAX_WAIT seconds from now.
+#
+# Limits:
+#   providers: PROVIDERS[...]["rate_limit"] = {"per_minute": 60, "burst": 10} in providers.py
+#              (or MODELS_CONFIG); providers without one are not limited
+#   users:     USER_RATE_LIMIT_PER_MINUTE / USER_RATE_LIMIT_BURST (0 per minute disables)
+import os
+import logging
+import math
+import time
+import sqlite3
+import threading
+import metrics
+
+log = logging.getLogger(__name__)
+
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "rate_limits.sqlite3")
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+RATE_LIMIT_MAX_QUEUE = int(os.getenv("RATE_LIMIT_MAX_QUEUE", "20"))
+USER_RATE_LIMIT_PER_MINUTE = float(os.getenv("USER_RATE_LIMIT_PER_MINUTE", "30"))
+USER_RATE_LIMIT_BURST = int(os.getenv("USER_RATE_LIMIT_BURST", "10"))
+
+# Idle buckets are full again long before this, so their rows can be dropped
+STALE_BUCKET_SECONDS = 3600
+
+DECISIONS = metrics.Counter(
+    "funnx_rate_limit_decisions_total",
+    "Rate limiter decisions (admitted, queued, rejected, error) by scope and provider.",
+    ("scope", "name", "result"),
+)
+WAIT_SECONDS = metrics.Histogram(
+    "funnx_rate_limit_wait_seconds",
+    "Time queued requests waited for a token.",
+    ("scope", "name"),
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+metrics.REGISTRY += [DECISIONS, WAIT_SECONDS]
+
+
+def take(row, now, per_second, burst):
+    """
+    One decision for a bucket last seen as `row` (tokens, updated_at), or None for a new one.
+    Returns (admitted, wait, tokens to store).
+    """
+    if row is None:
+        tokens = float(burst)
+    else:
+        tokens = min(float(burst), row[0] + max(now - row[1], 0) * per_second)
+
+    wait = 0.0 if tokens >= 1 else (1 - tokens) / per_second
+    queued = max(0, math.ceil(-tokens))
+    if wait > RATE_LIMIT_MAX_WAIT or queued >= RATE_LIMIT_MAX_QUEUE:
+        # Rejections don't take a token; only the refill is saved
+        return False, wait, tokens
+    return True, wait, tokens - 1
+
+
+class TokenBuckets:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        self.connect().execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def connect(self):
+        # One connection per thread, reopened after a fork (gunicorn workers)
+        conn = getattr(self.local, "conn", None)
+        if conn is None or getattr(self.local, "pid", None) != os.getpid():
+            # Autocommit mode, so each decision can run in an explicit BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Bucket state is worth nothing after a crash; skip the fsync
+            conn.execute("PRAGMA synchronous=OFF")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def reserve(self, key, per_second, burst):
+        """
+        Takes one token from bucket `key`. Returns (True, wait): the caller may proceed after
+        sleeping `wait` seconds; or (False, retry_after) if the wait queue is full or too long.
+        """
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            admitted, wait, tokens = take(row, now, per_second, burst)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+            self.writes += 1
+            if self.writes % 1000 == 0:
+                conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - STALE_BUCKET_SECONDS,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return admitted, wait
+
+
+class MemoryBuckets:
+    """The same buckets in a dict, for one worker; used when RATE_LIMIT_PATH can't be opened."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.writes = 0
+
+    def reserve(self, key, per_second, burst):
+        now = time.time()
+        with self.lock:
+            admitted, wait, tokens = take(self.rows.get(key), now, per_second, burst)
+            self.rows[key] = (tokens, now)
+            self.writes += 1
+            if self.writes % 1000 == 0:
+                self.rows = {k: row for k, row in self.rows.items() if row[1] >= now - STALE_BUCKET_SECONDS}
+        return admitted, wait
+
+
+def create():
+    try:
+        return TokenBuckets(RATE_LIMIT_PATH)
+    except (sqlite3.Error, OSError) as e:
+        log.warning("cannot open the rate limit store; limiting within each worker only",
+                    extra={"path": RATE_LIMIT_PATH, "error": str(e)})
+        return MemoryBuckets()
+
+
+buckets = create()
+
+
+def check(scope, name, key, per_minute, burst):
+    """
+    Returns (True, wait) or (False, retry_after) for one request; see TokenBuckets.reserve().
+    If the bucket store fails, the request is let through rather than failed.
+    """
+    try:
+        admitted, wait = buckets.reserve(f"{scope}:{key}", per_minute / 60.0, burst)
+    except sqlite3.Error as e:
+        log.warning("rate limiter unavailable, admitting request", extra={"error": str(e)})
+        DECISIONS.inc(scope=scope, name=name, result="error")
+        return True, 0.0
+    if not admitted:
+        DECISIONS.inc(scope=scope, name=name, result="rejected")
+    elif wait > 0:
+        DECISIONS.inc(scope=scope, name=name, result="queued")
+        WAIT_SECONDS.observe(wait, scope=scope, name=name)
+    else:
+        DECISIONS.inc(scope=scope, name=name, result="admitted")
+    return admitted, wait
+
+
+def check_provider(name, limit):
+    """`limit` is the provider's "rate_limit" config, or None for no limit."""
+    if not limit:
+        return True, 0.0
+    return check("provider", name, name, limit["per_minute"], limit.get("burst", 1))
+
+
+def check_user(user_key):
+    if USER_RATE_LIMIT_PER_MINUTE <= 0 or not user_key:
+        return True, 0.0
+    # Users share one label; the bucket key still separates them
+    return check("user", "user", user_key, USER_RATE_LIMIT_PER_MINUTE, USER_RATE_LIMIT_BURST)
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,457 @@
+# FunnX.Ai/research.py
+# Research Mode: answer a question in three stages instead of one call.
+#
+#   plan        the chosen model splits the question into up to RESEARCH_MAX_SUB_QUESTIONS
+#               self-contained sub-questions (a simple question stays whole)
+#   research    the sub-questions are answered concurrently, spread over the ready models
+#               (fastest first, as ranked for "Auto"), within one stage deadline
+#   synthesize  the chosen model writes the final answer from the question and the notes,
+#               streamed, with the conversation's context
+#
+# Each stage gets at most RESEARCH_STAGE_TIMEOUT seconds; sub-questions still unanswered at
+# the deadline are dropped (cancelled in the async mode, left to finish unread in the sync
+# mode). The whole run is capped at RESEARCH_TIME_BUDGET seconds and RESEARCH_TOKEN_BUDGET
+# tokens, the research prompts and answers counted with tokens.py (the conversation's
+# context is sent with the plan and synthesis prompts but not counted: context_builder.py
+# already keeps it within CONTEXT_TOKEN_BUDGET). Sub-questions are only sent while
+# RESEARCH_ANSWER_TOKENS are still left for the final answer, and a final answer that runs
+# past either budget is cut off there. A run that skipped research or was cut off reports
+# "budget_reached", and its answer isn't cached.
+#
+# run()/arun() yield progress events (dicts) between the answer's text chunks (str):
+#   {"stage": "plan", "sub_questions": [...], "elapsed_ms": 812}        (+ "error" if planning failed)
+#   {"stage": "research", "index": 0, "sub_question": "...", "model": "<name>", "answer": "...", "elapsed_ms": 2301}
+#                                                                        ("error" instead of "answer" on failure)
+#   {"stage": "synthesize", "notes": 3, "elapsed_ms": 2950}
+#   {"model": "<name>"}    the model writing the answer, when "Auto" was requested
+#   "<text>" ...           the final answer's chunks
+#   {"stage": "done", "tokens": 5321, "token_budget": 12000, "elapsed_ms": 9120, "budget_reached": false}
+# /chat/stream sends the events as NDJSON lines, and the answer chunks as {"delta"} lines.
+import os
+import re
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+import providers
+from providers import ChatError, FallbackText
+import router
+import metrics
+from structured_logging import in_context
+from tokens import count_tokens, MESSAGE_OVERHEAD_TOKENS
+
+RESEARCH_MAX_SUB_QUESTIONS = int(os.getenv("RESEARCH_MAX_SUB_QUESTIONS", "4"))
+RESEARCH_STAGE_TIMEOUT = float(os.getenv("RESEARCH_STAGE_TIMEOUT", "30"))
+RESEARCH_TIME_BUDGET = float(os.getenv("RESEARCH_TIME_BUDGET", "90"))
+RESEARCH_TOKEN_BUDGET = int(os.getenv("RESEARCH_TOKEN_BUDGET", "12000"))
+# Kept back for the final answer when deciding how many sub-questions to send
+RESEARCH_ANSWER_TOKENS = int(os.getenv("RESEARCH_ANSWER_TOKENS", "1500"))
+RESEARCH_MAX_WORKERS = int(os.getenv("RESEARCH_MAX_WORKERS", "8"))
+
+SUB_ANSWER_WORDS = 150
+# Tokens a sub-answer of SUB_ANSWER_WORDS is expected to take
+SUB_ANSWER_TOKENS = 220
+
+PLAN_PROMPT = (
+    "Break the question below into at most {limit} self-contained sub-questions that together cover "
+    "what is needed to answer it well. Write one sub-question per line, without numbering or commentary. "
+    "If the question is simple, write it unchanged on a single line.\n\n"
+    "Question: {question}"
+)
+SUB_QUESTION_PROMPT = (
+    "You are researching one part of a larger question.\n"
+    "Main question: {question}\n"
+    "Sub-question: {sub_question}\n\n"
+    "Answer the sub-question with the key facts, in at most {words} words."
+)
+SYNTHESIS_PROMPT = (
+    "Answer the question below in depth. Use the research notes where they help, reconcile notes "
+    "that disagree, and say when something is uncertain.\n\n"
+    "Question: {question}\n\n"
+    "Research notes:\n{notes}\n\n"
+    "Answer:"
+)
+
+RESEARCH_STAGE_SECONDS = metrics.Histogram(
+    "funnx_research_stage_seconds",
+    "Research Mode stage durations (plan, research, synthesize).",
+    ("stage",),
+)
+RESEARCH_SUB_QUESTIONS = metrics.Counter(
+    "funnx_research_sub_questions_total",
+    "Research Mode sub-questions by model and outcome (ok, error, timeout, skipped for the token budget).",
+    ("model", "outcome"),
+)
+RESEARCH_RUNS = metrics.Counter(
+    "funnx_research_runs_total",
+    "Research Mode answers by outcome (complete, budget_reached).",
+    ("outcome",),
+)
+metrics.REGISTRY.extend([RESEARCH_STAGE_SECONDS, RESEARCH_SUB_QUESTIONS, RESEARCH_RUNS])
+
+# Sync mode asks the planner and the sub-questions on these threads (shared by all requests in the worker)
+research_executor = ThreadPoolExecutor(max_workers=RESEARCH_MAX_WORKERS, thread_name_prefix="research")
+
+LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\d+[.)]|Q\d*[:.])\s*")
+
+
+class Budget:
+    """Time and tokens spent by one Research Mode answer."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.tokens = 0
+        self.reached = False
+
+    def spend(self, text):
+        self.tokens += count_tokens(text)
+
+    def spend_messages(self, messages):
+        self.tokens += sum(count_tokens(message["content"]) for message in messages)
+
+    def spend_chunk(self, text):
+        # A chunk is part of one message: no per-message overhead
+        self.tokens += count_tokens(text) - MESSAGE_OVERHEAD_TOKENS
+
+    def tokens_left(self):
+        return RESEARCH_TOKEN_BUDGET - self.tokens
+
+    def seconds_left(self):
+        return max(self.started + RESEARCH_TIME_BUDGET - time.monotonic(), 0)
+
+    def stage_timeout(self):
+        return min(RESEARCH_STAGE_TIMEOUT, self.seconds_left())
+
+    def elapsed_ms(self):
+        return round((time.monotonic() - self.started) * 1000)
+
+    def exhausted(self):
+        # `reached` also records sub-questions and notes left out for the budget
+        exhausted = self.tokens_left() <= 0 or self.seconds_left() <= 0
+        self.reached = self.reached or exhausted
+        return exhausted
+
+
+def check_model(model_name):
+    """Raises ChatError before anything is streamed if `model_name` can't answer."""
+    if model_name == router.AUTO_MODEL:
+        router.rank("stream")
+    else:
+        provider, _ = providers.resolve(model_name)
+        provider.check_ready()
+
+
+def research_models(model_name):
+    """Models for the sub-questions: every ready model, fastest first; just `model_name` if none are."""
+    try:
+        return router.rank("complete")
+    except ChatError:
+        return [model_name]
+
+
+# --- Stages, shared by the sync and async pipelines ---
+
+def plan_messages(context, question):
+    return context + [{"role": "user", "content": PLAN_PROMPT.format(limit=RESEARCH_MAX_SUB_QUESTIONS, question=question)}]
+
+
+def parse_sub_questions(text, question):
+    sub_questions = []
+    for line in str(text).splitlines():
+        line = LIST_MARKER.sub("", line).strip()
+        if line and line not in sub_questions:
+            sub_questions.append(line)
+    return sub_questions[:RESEARCH_MAX_SUB_QUESTIONS] or [question]
+
+
+def planned(budget, question, prompt, text, error, started):
+    """Spends the plan's tokens (not the context's). Returns (sub-questions, plan event)."""
+    budget.spend_messages(prompt[-1:])
+    RESEARCH_STAGE_SECONDS.observe(time.monotonic() - started, stage="plan")
+    if error is not None or isinstance(text, FallbackText):
+        # Without a plan, the synthesis answers the question directly
+        event = {"stage": "plan", "sub_questions": [question], "elapsed_ms": budget.elapsed_ms(),
+                 "error": error or "The planner gave no usable answer."}
+        return [question], event
+    budget.spend(text)
+    sub_questions = parse_sub_questions(text, question)
+    return sub_questions, {"stage": "plan", "sub_questions": sub_questions, "elapsed_ms": budget.elapsed_ms()}
+
+
+def sub_question_messages(question, sub_question):
+    prompt = SUB_QUESTION_PROMPT.format(question=question, sub_question=sub_question, words=SUB_ANSWER_WORDS)
+    return [{"role": "user", "content": prompt}]
+
+
+def synthesis_overhead(question):
+    """Tokens of the synthesis prompt without its notes."""
+    return count_tokens(SYNTHESIS_PROMPT + question)
+
+
+def assignments(budget, question, sub_questions, models):
+    """
+    Returns (chosen, skipped): (index, sub-question, model) for the sub-questions to send,
+    round-robin over `models`, and research events for the ones left out. Each one costs its
+    prompt, its answer, and the answer again in the synthesis prompt; sub-questions are
+    skipped once they would eat into the RESEARCH_ANSWER_TOKENS kept for the final answer.
+    """
+    if len(sub_questions) < 2:
+        # A question that wasn't split is answered directly by the synthesis
+        return [], []
+    available = budget.tokens_left() - RESEARCH_ANSWER_TOKENS - synthesis_overhead(question)
+    chosen, skipped = [], []
+    for index, sub_question in enumerate(sub_questions):
+        model_name = models[index % len(models)]
+        cost = count_tokens(sub_question_messages(question, sub_question)[0]["content"]) + 2 * SUB_ANSWER_TOKENS
+        if cost > available:
+            budget.reached = True
+            RESEARCH_SUB_QUESTIONS.inc(model=model_name, outcome="skipped")
+            skipped.append({"stage": "research", "index": index, "sub_question": sub_question, "model": model_name,
+                            "error": "Skipped to stay within the token budget."})
+            continue
+        available -= cost
+        chosen.append((index, sub_question, model_name))
+    return chosen, skipped
+
+
+def answered(budget, notes, question, index, sub_question, model_name, text, error, seconds):
+    """Spends a sub-question's tokens and keeps its answer as a note. Returns its research event."""
+    event = {"stage": "research", "index": index, "sub_question": sub_question, "model": model_name,
+             "elapsed_ms": round(seconds * 1000)}
+    budget.spend_messages(sub_question_messages(question, sub_question))
+    if error is None and isinstance(text, FallbackText):
+        error = "No usable answer."
+    if error is not None:
+        RESEARCH_SUB_QUESTIONS.inc(model=model_name, outcome="error")
+        event["error"] = error
+        return event
+    RESEARCH_SUB_QUESTIONS.inc(model=model_name, outcome="ok")
+    budget.spend(text)
+    notes.append((index, sub_question, text))
+    event["answer"] = text
+    return event
+
+
+def timed_out(pending):
+    """Research events for sub-questions still unanswered at the stage deadline."""
+    events = []
+    for index, sub_question, model_name in sorted(pending):
+        RESEARCH_SUB_QUESTIONS.inc(model=model_name, outcome="timeout")
+        events.append({"stage": "research", "index": index, "sub_question": sub_question, "model": model_name,
+                       "error": "Timed out."})
+    return events
+
+
+def synthesis_messages(budget, context, question, notes):
+    """The synthesis request, with as many notes (in plan order) as fit the token budget."""
+    room = budget.tokens_left() - RESEARCH_ANSWER_TOKENS - synthesis_overhead(question)
+    kept = []
+    for index, sub_question, text in sorted(notes):
+        note = f"- {sub_question}\n{text.strip()}"
+        size = count_tokens(note)
+        if size > room:
+            budget.reached = True
+            continue
+        room -= size
+        kept.append(note)
+    prompt = SYNTHESIS_PROMPT.format(question=question, notes="\n\n".join(kept) or "(none)")
+    synthesis = context + [{"role": "user", "content": prompt}]
+    budget.spend_messages(synthesis[-1:])
+    return synthesis, len(kept)
+
+
+def done_event(budget):
+    RESEARCH_RUNS.inc(outcome="budget_reached" if budget.reached else "complete")
+    return {"stage": "done", "tokens": budget.tokens, "token_budget": RESEARCH_TOKEN_BUDGET,
+            "elapsed_ms": budget.elapsed_ms(), "budget_reached": budget.reached}
+
+
+# --- Sync (api.py) ---
+
+def ask_sub_question(question, sub_question, model_name):
+    """Returns (text, error message, seconds); never raises ChatError."""
+    started = time.monotonic()
+    try:
+        text = providers.ask_model(model_name, sub_question_messages(question, sub_question))
+        return text, None, time.monotonic() - started
+    except ChatError as e:
+        return None, e.message, time.monotonic() - started
+
+
+def run(model_name, messages):
+    """The pipeline for the last message in `messages`: progress events (dicts) and answer chunks (str)."""
+    budget = Budget()
+    question, context = messages[-1]["content"], messages[:-1]
+
+    started = time.monotonic()
+    prompt = plan_messages(context, question)
+    text = error = None
+    try:
+        text, _ = research_executor.submit(in_context(router.ask_model), model_name, prompt).result(timeout=budget.stage_timeout())
+    except FutureTimeout:
+        error = "Timed out."
+    except ChatError as e:
+        error = e.message
+    sub_questions, event = planned(budget, question, prompt, text, error, started)
+    yield event
+
+    started = time.monotonic()
+    notes = []
+    chosen, skipped = assignments(budget, question, sub_questions, research_models(model_name))
+    futures = {
+        research_executor.submit(in_context(ask_sub_question), question, sub_question, name): (index, sub_question, name)
+        for index, sub_question, name in chosen
+    }
+    yield from skipped
+    try:
+        for future in as_completed(futures, timeout=budget.stage_timeout()):
+            index, sub_question, name = futures.pop(future)
+            yield answered(budget, notes, question, index, sub_question, name, *future.result())
+    except FutureTimeout:
+        yield from timed_out(futures.values())
+    finally:
+        for future in futures:
+            # Calls already waiting on a provider finish in the background, unread
+            future.cancel()
+    if chosen:
+        RESEARCH_STAGE_SECONDS.observe(time.monotonic() - started, stage="research")
+
+    started = time.monotonic()
+    synthesis, note_count = synthesis_messages(budget, context, question, notes)
+    yield {"stage": "synthesize", "notes": note_count, "elapsed_ms": budget.elapsed_ms()}
+    answered_by, chunks = router.stream_model(model_name, synthesis)
+    if answered_by != model_name:
+        yield {"model": answered_by}
+    try:
+        for chunk in chunks:
+            budget.spend_chunk(chunk)
+            yield chunk
+            if budget.exhausted():
+                break
+    finally:
+        chunks.close()
+    RESEARCH_STAGE_SECONDS.observe(time.monotonic() - started, stage="synthesize")
+    yield done_event(budget)
+
+
+class TruncatedText(FallbackText):
+    """An answer cut short by the research budget: returned like any answer, but never cached."""
+
+
+def answer_text(parts, budget_reached):
+    text = "".join(parts)
+    if not text.strip():
+        return FallbackText("Research Mode could not put an answer together. Please try again.")
+    return TruncatedText(text) if budget_reached else text
+
+
+def ask_model(model_name, messages):
+    """Research Mode version of router.ask_model(). Returns (answer, name of the model that wrote it)."""
+    check_model(model_name)
+    parts, answered_by, budget_reached = [], model_name, False
+    for item in run(model_name, messages):
+        if isinstance(item, str):
+            parts.append(item)
+        elif "stage" not in item:
+            answered_by = item["model"]
+        elif item["stage"] == "done":
+            budget_reached = item["budget_reached"]
+    return answer_text(parts, budget_reached), answered_by
+
+
+def stream_model(model_name, messages):
+    """Research Mode version of router.stream_model(). Returns (model_name, iterator of events and chunks)."""
+    check_model(model_name)
+    return model_name, run(model_name, messages)
+
+
+# --- Async (asgi.py) ---
+
+async def aask_sub_question(question, sub_question, model_name):
+    started = time.monotonic()
+    try:
+        text = await providers.aask_model(model_name, sub_question_messages(question, sub_question))
+        return text, None, time.monotonic() - started
+    except ChatError as e:
+        return None, e.message, time.monotonic() - started
+
+
+async def arun(model_name, messages):
+    """Async version of run(); sub-questions still running at the deadline are cancelled."""
+    budget = Budget()
+    question, context = messages[-1]["content"], messages[:-1]
+
+    started = time.monotonic()
+    prompt = plan_messages(context, question)
+    text = error = None
+    try:
+        text, _ = await asyncio.wait_for(router.aask_model(model_name, prompt), budget.stage_timeout())
+    except asyncio.TimeoutError:
+        error = "Timed out."
+    except ChatError as e:
+        error = e.message
+    sub_questions, event = planned(budget, question, prompt, text, error, started)
+    yield event
+
+    started = time.monotonic()
+    notes = []
+    chosen, skipped = assignments(budget, question, sub_questions, research_models(model_name))
+    tasks = {
+        asyncio.ensure_future(aask_sub_question(question, sub_question, name)): (index, sub_question, name)
+        for index, sub_question, name in chosen
+    }
+    try:
+        for event in skipped:
+            yield event
+        deadline = time.monotonic() + budget.stage_timeout()
+        while tasks:
+            done, _ = await asyncio.wait(tasks, timeout=max(deadline - time.monotonic(), 0),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                for event in timed_out(tasks.values()):
+                    yield event
+                break
+            for task in done:
+                index, sub_question, name = tasks.pop(task)
+                yield answered(budget, notes, question, index, sub_question, name, *task.result())
+    finally:
+        for task in tasks:
+            task.cancel()
+    if chosen:
+        RESEARCH_STAGE_SECONDS.observe(time.monotonic() - started, stage="research")
+
+    started = time.monotonic()
+    synthesis, note_count = synthesis_messages(budget, context, question, notes)
+    yield {"stage": "synthesize", "notes": note_count, "elapsed_ms": budget.elapsed_ms()}
+    answered_by, chunks = await router.astream_model(model_name, synthesis)
+    if answered_by != model_name:
+        yield {"model": answered_by}
+    try:
+        async for chunk in chunks:
+            budget.spend_chunk(chunk)
+            yield chunk
+            if budget.exhausted():
+                break
+    finally:
+        await chunks.aclose()
+    RESEARCH_STAGE_SECONDS.observe(time.monotonic() - started, stage="synthesize")
+    yield done_event(budget)
+
+
+async def aask_model(model_name, messages):
+    """Async version of ask_model()."""
+    check_model(model_name)
+    parts, answered_by, budget_reached = [], model_name, False
+    async for item in arun(model_name, messages):
+        if isinstance(item, str):
+            parts.append(item)
+        elif "stage" not in item:
+            answered_by = item["model"]
+        elif item["stage"] == "done":
+            budget_reached = item["budget_reached"]
+    return answer_text(parts, budget_reached), answered_by
+
+
+async def astream_model(model_name, messages):
+    """Async version of stream_model()."""
+    check_model(model_name)
+    return model_name, arun(model_name, messages)
@@ -0,0 +1,210 @@
+# FunnX.Ai/response_cache.py
+# Opt-in cache of model answers for identical prompts.
+#
+# Two tiers:
+#   memory  - per-worker LRU, bounded by total size in bytes (RESPONSE_CACHE_MAX_BYTES)
+#   sqlite  - optional file shared by all gunicorn workers on the host (RESPONSE_CACHE_PATH)
+# A memory miss falls through to SQLite; a SQLite hit is copied into memory.
+# Entries expire after a per-model TTL (MODELS[...]["cache_ttl"] in providers.py,
+# default RESPONSE_CACHE_TTL seconds).
+#
+# Enable with RESPONSE_CACHE=memory or RESPONSE_CACHE=sqlite (default: off).
+import os
+import logging
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "off").lower()
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+RESPONSE_CACHE_MAX_ROWS = int(os.getenv("RESPONSE_CACHE_MAX_ROWS", "100000"))
+
+ENABLED = RESPONSE_CACHE in ("memory", "sqlite")
+
+
+def normalize_message(message):
+    """Case- and whitespace-insensitive form of a prompt, so trivial variations share an entry."""
+    return " ".join(message.split()).casefold()
+
+
+def make_key(model_name, message, research_mode=False, params=None):
+    raw = json.dumps(
+        [model_name, normalize_message(message), bool(research_mode), params or {}],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryLRU:
+    """Thread-safe LRU of key -> (expires_at, text), evicting least recently used entries past max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    @staticmethod
+    def entry_size(key, text):
+        return len(key) + len(text.encode("utf-8"))
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, text = entry
+            if expires_at <= now:
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return text
+
+    def put(self, key, text, expires_at):
+        size = self.entry_size(key, text)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires_at, text)
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        expires_at, text = self.entries.pop(key)
+        self.size -= self.entry_size(key, text)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteStore:
+    """Response cache table in a SQLite file shared across worker processes."""
+
+    def __init__(self, path, max_rows):
+        self.path = path
+        self.max_rows = max_rows
+        self.local = threading.local()
+        self.writes = 0
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, text TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires_at)")
+
+    def connect(self):
+        # One connection per thread (and per process: a forked worker gets a new thread-local)
+        conn = getattr(self.local, "conn", None)
+        if conn is None or getattr(self.local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            # WAL lets readers in other workers proceed while one worker writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key, now):
+        row = self.connect().execute(
+            "SELECT text, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        return row
+
+    def put(self, key, text, expires_at, now):
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, text, expires_at) VALUES (?, ?, ?)",
+                (key, text, expires_at),
+            )
+            self.writes += 1
+            # Prune occasionally rather than on every write
+            if self.writes % 100 == 0:
+                conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    " SELECT key FROM responses ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,),
+                )
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.memory = MemoryLRU(RESPONSE_CACHE_MAX_BYTES)
+        self.shared = SQLiteStore(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ROWS) if backend == "sqlite" else None
+        self.lock = threading.Lock()
+        self.counts = {"memory_hits": 0, "shared_hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+    def count(self, field):
+        with self.lock:
+            self.counts[field] += 1
+
+    def get(self, key):
+        now = time.time()
+        text = self.memory.get(key, now)
+        if text is not None:
+            self.count("memory_hits")
+            return text
+        if self.shared is not None:
+            try:
+                row = self.shared.get(key, now)
+            except sqlite3.Error as e:
+                log.warning("response cache read failed", extra={"error": str(e)})
+                self.count("errors")
+                row = None
+            if row is not None:
+                text, expires_at = row
+                self.memory.put(key, text, expires_at)
+                self.count("shared_hits")
+                return text
+        self.count("misses")
+        return None
+
+    def put(self, key, text, ttl=None):
+        now = time.time()
+        expires_at = now + (RESPONSE_CACHE_TTL if ttl is None else ttl)
+        if expires_at <= now:
+            return
+        self.memory.put(key, text, expires_at)
+        if self.shared is not None:
+            try:
+                self.shared.put(key, text, expires_at, now)
+            except sqlite3.Error as e:
+                log.warning("response cache write failed", extra={"error": str(e)})
+                self.count("errors")
+        self.count("stores")
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        lookups = counts["memory_hits"] + counts["shared_hits"] + counts["misses"]
+        hits = counts["memory_hits"] + counts["shared_hits"]
+        return {
+            "enabled": True,
+            "backend": "sqlite" if self.shared is not None else "memory",
+            **counts,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory.size,
+            "memory_evictions": self.memory.evictions,
+        }
+
+
+cache = ResponseCache(RESPONSE_CACHE) if ENABLED else None
+
+
+def stats():
+    return cache.stats() if cache is not None else {"enabled": False}
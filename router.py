@@ -0,0 +1,258 @@
+# FunnX.Ai/router.py
+# The "Auto" model: latency-aware routing with hedged requests.
+#
+# For each request, the configured models whose providers are ready are ranked by
+# their recent health (providers.health: median latency, inflated by the error
+# rate; models with no recent calls are tried first). The best one is asked. If it
+# fails, or hasn't answered within its hedge deadline (p95 latency x
+# ROUTER_HEDGE_FACTOR, or time to first chunk for streams), the runner-up is asked
+# too, and the first usable answer wins.
+#
+# The losing call is cancelled where possible: async tasks (asgi.py) and not-yet-
+# started threads are cancelled, and a losing stream is closed as soon as it has
+# opened. A sync non-streaming call that is already waiting on the provider can't
+# be interrupted; it finishes in the background and its answer is discarded.
+#
+# Every other model name is passed straight through to providers.py.
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import providers
+from structured_logging import in_context
+from providers import ChatError, FallbackText
+import metrics
+
+AUTO_MODEL = "Auto"
+ROUTER_HEDGE_FACTOR = float(os.getenv("ROUTER_HEDGE_FACTOR", "1.0"))
+ROUTER_MIN_HEDGE_DELAY = float(os.getenv("ROUTER_MIN_HEDGE_DELAY", "1.0"))
+# Hedge deadline until a model has ROUTER_MIN_SAMPLES successful calls in the window
+ROUTER_DEFAULT_HEDGE_DELAY = float(os.getenv("ROUTER_DEFAULT_HEDGE_DELAY", "10"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+ROUTER_MAX_WORKERS = int(os.getenv("ROUTER_MAX_WORKERS", "8"))
+
+ROUTED = metrics.Counter(
+    "funnx_router_requests_total",
+    "Auto-routed requests by the model that answered and how "
+    "(primary, hedged_primary, hedged_backup, failover, failed).",
+    ("model", "outcome"),
+)
+metrics.REGISTRY.append(ROUTED)
+
+# Sync mode runs the primary and the hedge on these threads (shared by all requests in the worker)
+hedge_executor = ThreadPoolExecutor(max_workers=ROUTER_MAX_WORKERS, thread_name_prefix="router")
+
+
+def candidates():
+    """Models Auto may use: ready providers, unless the model sets "auto": false."""
+    return [
+        name for name, model in providers.MODEL_CONFIG.items()
+        if model.get("auto", True) and providers.is_ready(name)
+    ]
+
+
+def score(name, mode):
+    stats = providers.health.stats(providers.MODEL_CONFIG[name], mode)
+    if stats["p50"] is None:
+        # Unknown (or recently all-failing) models get a chance: errors still count against them
+        return stats["error_rate"] * ROUTER_DEFAULT_HEDGE_DELAY
+    return stats["p50"] / max(1.0 - stats["error_rate"], 0.05)
+
+
+def rank(mode):
+    names = candidates()
+    if not names:
+        raise ChatError("No models are available for Auto mode. Check the API keys in your .env file.", status=503)
+    return sorted(names, key=lambda name: score(name, mode))
+
+
+def hedge_delay(name, mode):
+    stats = providers.health.stats(providers.MODEL_CONFIG[name], mode)
+    if stats["latency_samples"] < ROUTER_MIN_SAMPLES:
+        return ROUTER_DEFAULT_HEDGE_DELAY
+    return max(ROUTER_MIN_HEDGE_DELAY, stats["p95"] * ROUTER_HEDGE_FACTOR)
+
+
+def outcome(winner, names, hedged, primary_failed):
+    if winner == names[0]:
+        return "hedged_primary" if hedged else "primary"
+    return "failover" if primary_failed else "hedged_backup"
+
+
+# --- Sync (api.py) ---
+
+def run_hedged(names, call, delay, usable, discard=None):
+    """
+    Runs call(names[0]); starts call(names[1]) if the first fails or takes longer than
+    `delay` seconds. Returns (result, name) for the first result where usable(result).
+    discard(result) is applied to a losing call's result whenever it completes.
+    """
+    pending = {hedge_executor.submit(in_context(call), names[0]): names[0]}
+    backups = list(names[1:2])
+    hedged = primary_failed = False
+    unusable = first_error = None
+    while pending:
+        done, _ = wait(pending, timeout=delay if backups else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = pending.pop(future)
+            try:
+                result = future.result()
+            except ChatError as e:
+                first_error = first_error or e
+                primary_failed = primary_failed or name == names[0]
+                continue
+            if not usable(result):
+                unusable = unusable or (result, name)
+                primary_failed = primary_failed or name == names[0]
+                continue
+            for loser in pending:
+                if not loser.cancel() and discard is not None:
+                    loser.add_done_callback(lambda f: f.exception() is None and discard(f.result()))
+            ROUTED.inc(model=name, outcome=outcome(name, names, hedged, primary_failed))
+            return result, name
+        if backups:
+            # Primary failed or is past its deadline: bring in the runner-up
+            hedged = not done
+            name = backups.pop(0)
+            pending[hedge_executor.submit(in_context(call), name)] = name
+    ROUTED.inc(model=names[0], outcome="failed")
+    if unusable is not None:
+        return unusable
+    raise first_error
+
+
+def ask_model(model_name, messages):
+    """providers.ask_model(), with "Auto" routed. Returns (answer, name of the model that answered)."""
+    if model_name != AUTO_MODEL:
+        return providers.ask_model(model_name, messages), model_name
+    names = rank("complete")
+    return run_hedged(
+        names,
+        lambda name: providers.ask_model(name, messages),
+        hedge_delay(names[0], "complete"),
+        usable=lambda text: not isinstance(text, FallbackText),
+    )
+
+
+def stream_model(model_name, messages):
+    """
+    providers.stream_model(), with "Auto" routed. Returns (name of the answering model,
+    iterator of chunks). For "Auto" this waits until one model has sent its first chunk.
+    """
+    if model_name != AUTO_MODEL:
+        return model_name, providers.stream_model(model_name, messages)
+    names = rank("stream")
+
+    def open_stream(name):
+        chunks = providers.stream_model(name, messages)
+        return chunks, next(chunks, None)
+
+    (chunks, first), name = run_hedged(
+        names, open_stream, hedge_delay(names[0], "stream"),
+        usable=lambda opened: opened[1] is not None,
+        discard=lambda opened: opened[0].close(),
+    )
+
+    def chained():
+        # A generator, so closing it closes the provider's stream too
+        try:
+            if first is None:
+                return
+            yield first
+            yield from chunks
+        finally:
+            chunks.close()
+
+    return name, chained()
+
+
+# --- Async (asgi.py) ---
+
+async def arun_hedged(names, mode, call, delay, usable, discard=None):
+    """Async version of run_hedged(); losing tasks are cancelled. `discard` is a coroutine function."""
+    started = time.perf_counter()
+    pending = {asyncio.ensure_future(call(names[0])): names[0]}
+    backups = list(names[1:2])
+    hedged = primary_failed = False
+    unusable = first_error = None
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=delay if backups else None, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = pending.pop(task)
+                try:
+                    result = task.result()
+                except ChatError as e:
+                    first_error = first_error or e
+                    primary_failed = primary_failed or name == names[0]
+                    continue
+                if not usable(result):
+                    unusable = unusable or (result, name)
+                    primary_failed = primary_failed or name == names[0]
+                    continue
+                ROUTED.inc(model=name, outcome=outcome(name, names, hedged, primary_failed))
+                return result, name
+            if backups:
+                hedged = not done
+                name = backups.pop(0)
+                pending[asyncio.ensure_future(call(name))] = name
+    finally:
+        for task, name in pending.items():
+            if not task.done():
+                task.cancel()
+                if name == names[0]:
+                    # A cancelled call never reports its latency; record the time it had
+                    # already taken as a lower bound so a slow primary stops being ranked first.
+                    providers.health.record(providers.MODEL_CONFIG[name], mode, time.perf_counter() - started, ok=True)
+            elif discard is not None and not task.cancelled() and task.exception() is None:
+                # Finished in the same wait() as the winner
+                await discard(task.result())
+    ROUTED.inc(model=names[0], outcome="failed")
+    if unusable is not None:
+        return unusable
+    raise first_error
+
+
+async def aask_model(model_name, messages):
+    """Async version of ask_model()."""
+    if model_name != AUTO_MODEL:
+        return await providers.aask_model(model_name, messages), model_name
+    names = rank("complete")
+    return await arun_hedged(
+        names, "complete",
+        lambda name: providers.aask_model(name, messages),
+        hedge_delay(names[0], "complete"),
+        usable=lambda text: not isinstance(text, FallbackText),
+    )
+
+
+async def astream_model(model_name, messages):
+    """Async version of stream_model(); returns (name, async iterator of chunks)."""
+    if model_name != AUTO_MODEL:
+        return model_name, await providers.astream_model(model_name, messages)
+    names = rank("stream")
+
+    async def open_stream(name):
+        chunks = await providers.astream_model(name, messages)
+        return chunks, await anext(chunks, None)
+
+    async def close_stream(opened):
+        await opened[0].aclose()
+
+    (chunks, first), name = await arun_hedged(
+        names, "stream", open_stream, hedge_delay(names[0], "stream"),
+        usable=lambda opened: opened[1] is not None,
+        discard=close_stream,
+    )
+
+    async def chained():
+        try:
+            if first is None:
+                return
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    return name, chained()
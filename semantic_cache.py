@@ -0,0 +1,315 @@
+# FunnX.Ai/semantic_cache.py
+# Opt-in cache that also answers prompts worded differently from a cached one
+# ("what is python" / "explain Python").
+#
+# Prompts are embedded with a hashing vectorizer: lower-cased content words and
+# word pairs, with common question/filler words dropped, hashed into SEMANTIC_CACHE_DIM
+# signed buckets and L2-normalised. No model download, and about 20 us per prompt.
+# It matches rewordings that share content words, not synonyms. The question word
+# is kept as the prompt's intent instead (see intent()): "when was X created" and
+# "where was X created" share every content word but never match each other.
+#
+# The index is one NumPy matrix per worker (SEMANTIC_CACHE_MAX_ENTRIES columns), so
+# a lookup is a single vector-matrix product: cosine similarity against every entry
+# at once. The matrix is stored feature-major and a prompt only has a dozen or so
+# non-zero buckets, so the product reads just those rows (~5 MB at 100k entries
+# rather than the whole ~100 MB). Only entries for the same model, research mode and
+# intent, not yet expired, are eligible, and the best one is served if its similarity is at
+# least SEMANTIC_CACHE_THRESHOLD. When full, expired entries are replaced first,
+# then the least recently used.
+#
+# The index is saved to SEMANTIC_CACHE_PATH at most every SEMANTIC_CACHE_SAVE_INTERVAL
+# seconds and at exit, and loaded at startup. With several workers each keeps its own
+# index and the file holds whichever saved last.
+#
+# Enable with SEMANTIC_CACHE=on (needs numpy). Benchmark: python semantic_cache.py --bench 100000
+import os
+import logging
+import re
+import sys
+import json
+import time
+import zlib
+import atexit
+import threading
+from response_cache import RESPONSE_CACHE_TTL
+
+log = logging.getLogger(__name__)
+
+np = None  # numpy, imported by load_numpy() only when the cache is used (~40 ms at startup otherwise)
+
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "off").lower() in ("1", "on", "true")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "20000"))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "256"))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.npz")
+SEMANTIC_CACHE_SAVE_INTERVAL = float(os.getenv("SEMANTIC_CACHE_SAVE_INTERVAL", "300"))
+
+# Words that change the wording of a question more than its subject. Negations
+# and comparison words are kept on purpose: "is X safe" and "is X not safe" must differ.
+# Question words are dropped here but not lost: intent() puts them in the group key.
+STOPWORDS = frozenset("""
+a an the is are was were be been am do does did can could would should will shall may might
+what whats s which who whom whose how why when where please kindly me my i you your we us our
+tell explain describe define give show let know about of for to in on at by with from into
+this that these those it its it's there here some any just really very simply briefly quick quickly
+hi hello hey thanks thank
+""".split())
+WORD_RE = re.compile(r"[a-z0-9][a-z0-9+#.\-]*")
+# What kind of answer a question asks for. "what" is left out with prompts that have
+# no question word, so "what is X" still matches "explain X".
+INTENTS = {
+    "who": "who", "whom": "who", "whose": "who", "which": "which",
+    "when": "when", "where": "where", "why": "why", "how": "how",
+}
+
+
+def features(text):
+    words = [w.rstrip(".-") for w in WORD_RE.findall(text.casefold())]
+    words = [w for w in words if w and w not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def intent(text):
+    """The first question word of `text` ("how much" for how much/many), or "" if there is none."""
+    words = WORD_RE.findall(text.casefold())
+    for i, word in enumerate(words):
+        if word in INTENTS:
+            if word == "how" and i + 1 < len(words) and words[i + 1] in ("much", "many"):
+                return "how much"
+            return INTENTS[word]
+    return ""
+
+
+def embed(text, dim=SEMANTIC_CACHE_DIM):
+    """Signed hashing vectorizer, L2-normalised. An empty vector for prompts of only stopwords."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in features(text):
+        h = zlib.crc32(feature.encode("utf-8"))
+        # The top bit picks the sign, so colliding features tend to cancel instead of adding up
+        vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticIndex:
+    def __init__(self, max_entries, dim, threshold):
+        self.max_entries = max_entries
+        self.dim = dim
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        # vectors[:, slot] is the embedding of the prompt in `slot`
+        self.vectors = np.zeros((dim, max_entries), dtype=np.float32)
+        self.groups = np.full(max_entries, -1, dtype=np.int32)   # -1: empty slot
+        self.expires = np.zeros(max_entries, dtype=np.float64)
+        self.last_used = np.zeros(max_entries, dtype=np.float64)
+        self.answers = [None] * max_entries
+        self.prompts = [None] * max_entries
+        self.group_ids = {}
+        self.size = 0          # slots [0, size) have been used at least once
+        self.counts = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self.last_save = time.time()
+        self.saving = False
+
+    def group_id(self, model_name, research_mode, message):
+        key = f"{model_name}\x00{bool(research_mode)}\x00{intent(message)}"
+        with self.lock:
+            if key not in self.group_ids:
+                self.group_ids[key] = len(self.group_ids)
+            return self.group_ids[key]
+
+    def get(self, model_name, message, research_mode):
+        """Returns (answer, similarity) of the best eligible entry at or above the threshold, else None."""
+        query = embed(message, self.dim)
+        group = self.group_id(model_name, research_mode, message)
+        now = time.time()
+        features = np.flatnonzero(query)
+        with self.lock:
+            n = self.size
+            if len(features) == 0 or n == 0:
+                self.counts["misses"] += 1
+                return None
+            similarity = query[features] @ self.vectors[features, :n]
+            # Usually a handful of candidates; only they are checked for group and expiry
+            candidates = np.flatnonzero(similarity >= self.threshold)
+            candidates = candidates[(self.groups[candidates] == group) & (self.expires[candidates] > now)]
+            if len(candidates) == 0:
+                self.counts["misses"] += 1
+                return None
+            best = int(candidates[np.argmax(similarity[candidates])])
+            self.last_used[best] = now
+            self.counts["hits"] += 1
+            return self.answers[best], float(similarity[best])
+
+    def put(self, model_name, message, research_mode, text, ttl=None):
+        query = embed(message, self.dim)
+        if not query.any():
+            return
+        group = self.group_id(model_name, research_mode, message)
+        now = time.time()
+        expires_at = now + (RESPONSE_CACHE_TTL if ttl is None else ttl)
+        if expires_at <= now:
+            return
+        with self.lock:
+            if self.size < self.max_entries:
+                slot = self.size
+                self.size += 1
+            else:
+                # Expired entries go first, then the least recently used
+                slot = int(np.argmin(np.where(self.expires <= now, -1.0, self.last_used)))
+                self.counts["evictions"] += 1
+            self.vectors[:, slot] = query
+            self.groups[slot] = group
+            self.expires[slot] = expires_at
+            self.last_used[slot] = now
+            self.answers[slot] = text
+            self.prompts[slot] = message
+            self.counts["stores"] += 1
+            due = not self.saving and now - self.last_save >= SEMANTIC_CACHE_SAVE_INTERVAL
+            if due:
+                self.saving = True
+        if due:
+            threading.Thread(target=self.save, args=(SEMANTIC_CACHE_PATH,), name="semantic-cache-save", daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+            entries = self.size
+        lookups = counts["hits"] + counts["misses"]
+        return {
+            "enabled": True,
+            **counts,
+            "hit_ratio": round(counts["hits"] / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "index_bytes": self.vectors.nbytes,
+            "threshold": self.threshold,
+        }
+
+    # --- Persistence ---
+
+    def save(self, path):
+        try:
+            with self.lock:
+                n = self.size
+                vectors = self.vectors[:, :n].copy()
+                groups = self.groups[:n].copy()
+                expires = self.expires[:n].copy()
+                last_used = self.last_used[:n].copy()
+                texts = json.dumps({"answers": self.answers[:n], "prompts": self.prompts[:n], "groups": self.group_ids})
+            # Write then rename, so a worker starting up never reads a half-written file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, vectors=vectors, groups=groups, expires=expires, last_used=last_used,
+                         texts=np.frombuffer(texts.encode("utf-8"), dtype=np.uint8))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("semantic cache save failed", extra={"path": path, "error": str(e)})
+        finally:
+            with self.lock:
+                self.last_save = time.time()
+                self.saving = False
+
+    def load(self, path):
+        try:
+            with np.load(path) as data:
+                vectors, groups = data["vectors"], data["groups"]
+                expires, last_used = data["expires"], data["last_used"]
+                texts = json.loads(data["texts"].tobytes().decode("utf-8"))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("ignoring unreadable semantic cache file", extra={"path": path, "error": str(e)})
+            return
+        if vectors.shape[0] != self.dim:
+            log.warning("semantic cache file has a different SEMANTIC_CACHE_DIM; starting empty",
+                        extra={"path": path, "dim": int(vectors.shape[0])})
+            return
+        # Keep the newest unexpired entries that fit
+        live = np.nonzero(expires > time.time())[0]
+        live = live[np.argsort(last_used[live])[::-1][:self.max_entries]]
+        n = len(live)
+        with self.lock:
+            self.vectors[:, :n] = vectors[:, live]
+            self.groups[:n] = groups[live]
+            self.expires[:n] = expires[live]
+            self.last_used[:n] = last_used[live]
+            self.answers[:n] = [texts["answers"][i] for i in live]
+            self.prompts[:n] = [texts["prompts"][i] for i in live]
+            self.group_ids = texts["groups"]
+            self.size = n
+        log.info("semantic cache loaded", extra={"path": path, "entries": n})
+
+
+def load_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # Optional: pip install numpy
+            return False
+        np = numpy
+    return True
+
+
+def create():
+    if not SEMANTIC_CACHE:
+        return None
+    if not load_numpy():
+        log.warning("SEMANTIC_CACHE is on but numpy is not installed; semantic cache disabled")
+        return None
+    index = SemanticIndex(SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_THRESHOLD)
+    index.load(SEMANTIC_CACHE_PATH)
+    atexit.register(index.save, SEMANTIC_CACHE_PATH)
+    return index
+
+
+cache = create()
+
+
+def stats():
+    return cache.stats() if cache is not None else {"enabled": False}
+
+
+def benchmark(entries):
+    """Fills an index with `entries` synthetic prompts and reports put/lookup latency."""
+    vocabulary = [f"topic{i}" for i in range(5000)] + ["python", "list", "sort", "error", "api", "cache"]
+    rng = np.random.default_rng(0)
+    index = SemanticIndex(entries, SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_THRESHOLD)
+    prompts = [" ".join(vocabulary[j] for j in row) for row in rng.integers(0, len(vocabulary), (entries, 6)).tolist()]
+
+    started = time.perf_counter()
+    for i, prompt in enumerate(prompts):
+        index.put("Gemini", prompt, False, f"answer {i}", ttl=3600)
+    put_seconds = time.perf_counter() - started
+
+    # Half the lookups reword a cached prompt, half are new prompts
+    reworded = [f"please explain {prompts[i]}" for i in rng.integers(0, entries, 500)]
+    unseen = [" ".join(vocabulary[j] for j in row) for row in rng.integers(0, len(vocabulary), (500, 6)).tolist()]
+    latencies, hits = [], 0
+    for query in reworded + unseen:
+        started = time.perf_counter()
+        result = index.get("Gemini", query, False)
+        latencies.append(time.perf_counter() - started)
+        hits += result is not None and query in reworded
+    latencies = np.array(latencies) * 1000
+    return {
+        "entries": entries,
+        "dim": SEMANTIC_CACHE_DIM,
+        "index_mb": round(index.vectors.nbytes / 2**20, 1),
+        "put_us": round(put_seconds / entries * 1e6, 1),
+        "lookup_ms_p50": round(float(np.percentile(latencies, 50)), 3),
+        "lookup_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+        "lookup_ms_p99": round(float(np.percentile(latencies, 99)), 3),
+        "hit_ratio_reworded": round(hits / len(reworded), 3),
+        "false_hits_unseen": index.counts["hits"] - hits,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--bench":
+        if not load_numpy():
+            sys.exit("The benchmark needs numpy: pip install numpy")
+        print(json.dumps(benchmark(int(sys.argv[2])), indent=2))
+    else:
+        print("usage: python semantic_cache.py --bench ENTRIES")
@@ -0,0 +1,611 @@
+# FunnX.Ai/single_flight.py
+# Request coalescing: concurrent identical first-turn prompts share one upstream call.
+#
+# Requests are keyed like the response cache (model, normalised message, research mode).
+# The first request for a key is the leader and calls the provider; requests with the
+# same key that arrive while it is in flight follow it and receive the same answer,
+# chunk by chunk for streams, or the same error. Streaming and non-streaming requests
+# share flights. Only the leader writes the answer to the response cache.
+#
+# SINGLE_FLIGHT=local coalesces within a worker process. SINGLE_FLIGHT=shared also
+# coalesces across all gunicorn workers on the host: a leader claims the key in a small
+# SQLite lock store (SINGLE_FLIGHT_PATH) and appends its new text there (at most every
+# PUBLISH_INTERVAL seconds, and when done). In another worker, the first request for a
+# claimed key relays it by polling for text it hasn't seen yet, and that worker's later
+# requests follow the relay. A claim expires SINGLE_FLIGHT_LEASE seconds after the
+# leader's last write, so a crashed worker's flights don't block the key for long.
+# SINGLE_FLIGHT=off disables coalescing.
+#
+# The default is "shared" when gunicorn runs more than one worker (WEB_CONCURRENCY > 1):
+# a sync worker with the default single thread never has two requests in flight, so
+# coalescing within it would never find a match. Otherwise it is "local".
+#
+# If a leader's client disconnects mid-stream, its followers get a 503 asking them to retry.
+# Research Mode progress events (dicts among the chunks) reach followers in the same worker
+# only; relays in other workers receive the answer text.
+import os
+import logging
+import time
+import uuid
+import asyncio
+import sqlite3
+import weakref
+import threading
+# providers.py imports metrics.py, which imports this module: refer to its names at call time
+import providers
+
+log = logging.getLogger(__name__)
+
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "shared" if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 else "local").lower()
+SINGLE_FLIGHT_PATH = os.getenv("SINGLE_FLIGHT_PATH", "single_flight.sqlite3")
+SINGLE_FLIGHT_LEASE = float(os.getenv("SINGLE_FLIGHT_LEASE", "120"))
+
+PUBLISH_INTERVAL = 0.1   # seconds between a leader's progress writes to the shared store
+POLL_INTERVAL = 0.05     # seconds between a relay's reads of the shared store
+# A finished row is served to late arrivals for this long before the key can be claimed again
+FINISHED_LINGER = 2.0
+
+RUNNING, DONE, FAILED = 0, 1, 2
+
+
+def interrupted():
+    return providers.ChatError("The answer this request was sharing was interrupted. Please try again.", status=503, kind="interrupted")
+
+
+def copy_error(e):
+    # Each follower raises its own instance; one exception object raised in many threads shares a traceback
+    return providers.ChatError(e.message, status=e.status, kind=e.kind, retry_after=e.retry_after)
+
+
+class Flight:
+    """One in-flight answer and its followers in this process. Chunks, the answering model and the outcome."""
+
+    def __init__(self, key):
+        self.key = key
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.model = None
+        self.done = False
+        self.error = None
+        self.fallback = False
+        self.version = 0
+        self.async_waiters = []   # (loop, asyncio.Event) of coroutines waiting for the next change
+        # Shared store bookkeeping (leader only)
+        self.shared = False
+        self.last_write = 0.0
+        self.written = 0   # chunks already appended to the store
+        self.relay_task = None
+
+    def update(self, chunk=None, model=None, done=False, error=None, fallback=False):
+        with self.cond:
+            if self.done:
+                return
+            if chunk:
+                self.chunks.append(chunk)
+            if model is not None:
+                self.model = model
+            if done:
+                self.done, self.error, self.fallback = True, error, fallback
+            self.version += 1
+            self.cond.notify_all()
+            waiters, self.async_waiters = self.async_waiters, []
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def snapshot(self):
+        with self.cond:
+            return list(self.chunks), self.model, self.done, self.error, self.fallback
+
+    def unwritten(self):
+        """Like snapshot(), but only the chunks not yet appended to the store."""
+        with self.cond:
+            return self.chunks[self.written:], self.model, self.done, self.error, self.fallback
+
+    # --- Followers, sync ---
+
+    def wait(self, seen_version, deadline):
+        with self.cond:
+            while self.version == seen_version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise providers.ChatError("Timed out waiting for a shared answer.", status=504, kind="timeout")
+                self.cond.wait(remaining)
+            return self.version
+
+    def wait_started(self):
+        """Blocks until the answering model is known. Returns it, or raises the leader's error."""
+        deadline = time.monotonic() + SINGLE_FLIGHT_LEASE
+        version = -1
+        while True:
+            with self.cond:
+                model, done, error, version_now = self.model, self.done, self.error, self.version
+            if error is not None:
+                raise copy_error(error)
+            if model is not None or done:
+                return model
+            version = self.wait(version_now, deadline)
+
+    def follow(self):
+        """Yields the answer's chunks as the leader publishes them; raises the leader's error."""
+        deadline = time.monotonic() + SINGLE_FLIGHT_LEASE
+        sent = 0
+        while True:
+            with self.cond:
+                chunks, done, error, version = self.chunks[sent:], self.done, self.error, self.version
+            sent += len(chunks)
+            yield from chunks
+            if done:
+                if error is not None:
+                    raise copy_error(error)
+                return
+            self.wait(version, deadline)
+
+    def result(self):
+        """(answer, answered_by) once the leader is done."""
+        model = self.wait_started()
+        text = "".join(chunk for chunk in self.follow() if isinstance(chunk, str))
+        return (providers.FallbackText(text) if self.fallback else text), self.model or model
+
+    # --- Followers, async ---
+
+    async def await_change(self, seen_version, deadline):
+        with self.cond:
+            if self.version != seen_version:
+                return
+            event = asyncio.Event()
+            self.async_waiters.append((asyncio.get_running_loop(), event))
+        try:
+            await asyncio.wait_for(event.wait(), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            raise providers.ChatError("Timed out waiting for a shared answer.", status=504, kind="timeout")
+
+    async def await_started(self):
+        deadline = time.monotonic() + SINGLE_FLIGHT_LEASE
+        while True:
+            with self.cond:
+                model, done, error, version = self.model, self.done, self.error, self.version
+            if error is not None:
+                raise copy_error(error)
+            if model is not None or done:
+                return model
+            await self.await_change(version, deadline)
+
+    async def afollow(self):
+        deadline = time.monotonic() + SINGLE_FLIGHT_LEASE
+        sent = 0
+        while True:
+            with self.cond:
+                chunks, done, error, version = self.chunks[sent:], self.done, self.error, self.version
+            sent += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if done:
+                if error is not None:
+                    raise copy_error(error)
+                return
+            await self.await_change(version, deadline)
+
+    async def aresult(self):
+        model = await self.await_started()
+        text = "".join([chunk async for chunk in self.afollow() if isinstance(chunk, str)])
+        return (providers.FallbackText(text) if self.fallback else text), self.model or model
+
+
+class FlightStore:
+    """
+    Claims and progress of flights, shared by all workers on the host (SINGLE_FLIGHT=shared).
+    A flight's text is kept as the pieces each write appended (flight_chunks), so neither
+    writing nor relaying a long answer copies what was already there.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.claims = 0
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+                # Flights only live for the length of an answer: older layouts are dropped, not migrated
+                conn.execute("DROP TABLE IF EXISTS flights")
+                conn.execute("DROP TABLE IF EXISTS flight_chunks")
+                conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS flights ("
+                " key TEXT PRIMARY KEY, owner TEXT NOT NULL, state INTEGER NOT NULL, chunks INTEGER NOT NULL DEFAULT 0,"
+                " model TEXT, fallback INTEGER NOT NULL DEFAULT 0, error TEXT, status INTEGER, kind TEXT,"
+                " retry_after REAL, updated_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS flight_chunks ("
+                " key TEXT NOT NULL, seq INTEGER NOT NULL, text TEXT NOT NULL, PRIMARY KEY (key, seq))"
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def connect(self):
+        # One connection per thread, reopened after a fork (gunicorn workers)
+        conn = getattr(self.local, "conn", None)
+        if conn is None or getattr(self.local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Flights are worth nothing after a crash; skip the fsync
+            conn.execute("PRAGMA synchronous=OFF")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def claim(self, key, owner):
+        """True if `owner` now leads `key`; False if another worker's flight (running or just finished) has it."""
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state, updated_at, expires_at FROM flights WHERE key = ?", (key,)).fetchone()
+            claimed = (
+                row is None
+                or (row[0] == RUNNING and row[2] < now)
+                or (row[0] != RUNNING and row[1] < now - FINISHED_LINGER)
+            )
+            if claimed:
+                conn.execute(
+                    "INSERT OR REPLACE INTO flights (key, owner, state, updated_at, expires_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (key, owner, RUNNING, now, now + SINGLE_FLIGHT_LEASE),
+                )
+                conn.execute("DELETE FROM flight_chunks WHERE key = ?", (key,))
+            self.claims += 1
+            if self.claims % 500 == 0:
+                conn.execute("DELETE FROM flights WHERE expires_at < ? OR (state != ? AND updated_at < ?)",
+                             (now, RUNNING, now - 60))
+                conn.execute("DELETE FROM flight_chunks WHERE key NOT IN (SELECT key FROM flights)")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def write(self, key, owner, text, state, model, fallback, error):
+        """Appends `text` (the answer's new part, may be empty) and updates the flight's state."""
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # The chunk and the state that covers it land together: a relay that sees a
+            # finished flight has already been able to read all of its text
+            cursor = conn.execute(
+                "UPDATE flights SET state = ?, chunks = chunks + ?, model = ?, fallback = ?, error = ?, status = ?,"
+                " kind = ?, retry_after = ?, updated_at = ?, expires_at = ? WHERE key = ? AND owner = ?",
+                (state, 1 if text else 0, model, int(fallback),
+                 error.message if error else None, error.status if error else None,
+                 error.kind if error else None, error.retry_after if error else None,
+                 now, now + SINGLE_FLIGHT_LEASE, key, owner),
+            )
+            # Nothing to append if the claim has passed to another worker
+            if cursor.rowcount and text:
+                conn.execute(
+                    "INSERT INTO flight_chunks (key, seq, text)"
+                    " SELECT key, chunks, ? FROM flights WHERE key = ?", (text, key),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def read(self, key, after=0):
+        """The flight's row, with "text": the text appended after the first `after` chunks."""
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT owner, state, chunks, model, fallback, error, status, kind, retry_after, expires_at"
+            " FROM flights WHERE key = ?", (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        names = ("owner", "state", "chunks", "model", "fallback", "error", "status", "kind", "retry_after", "expires_at")
+        row = dict(zip(names, row))
+        texts = conn.execute(
+            "SELECT text FROM flight_chunks WHERE key = ? AND seq > ? AND seq <= ? ORDER BY seq",
+            (key, after, row["chunks"]),
+        ).fetchall()
+        row["text"] = "".join(text for (text,) in texts)
+        return row
+
+
+class SingleFlight:
+    def __init__(self, store=None):
+        self.store = store
+        self.owner = uuid.uuid4().hex
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.counts = {"leader": 0, "follower": 0, "relay": 0, "errors": 0}
+
+    def count(self, field):
+        with self.lock:
+            self.counts[field] += 1
+
+    def join(self, key):
+        """
+        Returns (flight, role). role is "leader" (call the provider and publish), "follower"
+        (read the flight), or "relay" (another worker leads: run relay()/arelay(), then read the flight).
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.counts["follower"] += 1
+                return flight, "follower"
+            flight = self.flights[key] = Flight(key)
+        if self.store is not None:
+            try:
+                if not self.store.claim(key, self.owner):
+                    self.count("relay")
+                    return flight, "relay"
+                flight.shared = True
+            except sqlite3.Error as e:
+                # Without the store, coalesce within this worker only
+                log.warning("single-flight store unavailable, leading locally", extra={"error": str(e)})
+                self.count("errors")
+        self.count("leader")
+        return flight, "leader"
+
+    def write_due(self, flight):
+        return flight.shared and (flight.done or time.monotonic() - flight.last_write >= PUBLISH_INTERVAL)
+
+    def write(self, flight):
+        chunks, model, done, error, fallback = flight.unwritten()
+        flight.last_write = time.monotonic()
+        state = RUNNING if not done else FAILED if error is not None else DONE
+        try:
+            text = "".join(chunk for chunk in chunks if isinstance(chunk, str))
+            self.store.write(flight.key, self.owner, text, state, model, fallback, error)
+            flight.written += len(chunks)
+        except sqlite3.Error as e:
+            # Relays in other workers time out via the lease
+            log.warning("single-flight store write failed", extra={"error": str(e)})
+            self.count("errors")
+
+    def publish(self, flight, chunk=None, model=None):
+        flight.update(chunk=chunk, model=model)
+        if self.write_due(flight):
+            self.write(flight)
+
+    def finish(self, flight, error=None, fallback=False):
+        if flight.done:
+            return
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        flight.update(done=True, error=error, fallback=fallback)
+        if flight.shared:
+            self.write(flight)
+
+    async def apublish(self, flight, chunk=None, model=None):
+        flight.update(chunk=chunk, model=model)
+        if self.write_due(flight):
+            await asyncio.to_thread(self.write, flight)
+
+    async def afinish(self, flight, error=None, fallback=False):
+        if flight.done:
+            return
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        flight.update(done=True, error=error, fallback=fallback)
+        if flight.shared:
+            await asyncio.to_thread(self.write, flight)
+
+    def relay_step(self, flight, sent):
+        """
+        Copies the shared row's progress into the local flight. `sent` is (owner, chunks read)
+        so far, or None on the first call. Returns (new `sent`, finished).
+        """
+        owner, after = sent or (None, 0)
+        try:
+            row = self.store.read(flight.key, after)
+        except sqlite3.Error as e:
+            log.warning("single-flight store read failed", extra={"error": str(e)})
+            row = None
+        if (row is None or (row["state"] == RUNNING and row["expires_at"] < time.time())
+                or owner not in (None, row["owner"])):
+            # The leading worker went away (and maybe another has claimed the key since)
+            self.finish(flight, error=interrupted())
+            return sent, True
+        sent = (row["owner"], row["chunks"])
+        if row["text"] or (row["model"] and flight.model is None):
+            flight.update(chunk=row["text"], model=row["model"])
+        if row["state"] == DONE:
+            self.finish(flight, fallback=bool(row["fallback"]))
+            return sent, True
+        if row["state"] == FAILED:
+            error = providers.ChatError(row["error"], status=row["status"] or 500, kind=row["kind"], retry_after=row["retry_after"])
+            self.finish(flight, error=error)
+            return sent, True
+        return sent, False
+
+    def relay(self, flight):
+        """Follows another worker's flight through the store until it finishes (runs on its own thread)."""
+        sent, finished = None, False
+        while not finished:
+            sent, finished = self.relay_step(flight, sent)
+            if not finished:
+                time.sleep(POLL_INTERVAL)
+
+    async def arelay(self, flight):
+        sent, finished = None, False
+        while not finished:
+            sent, finished = await asyncio.to_thread(self.relay_step, flight, sent)
+            if not finished:
+                await asyncio.sleep(POLL_INTERVAL)
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+            in_flight = len(self.flights)
+        joined = counts["leader"] + counts["follower"] + counts["relay"]
+        return {
+            "mode": SINGLE_FLIGHT,
+            **counts,
+            "in_flight": in_flight,
+            # Share of requests that didn't make their own upstream call
+            "dedup_ratio": round((counts["follower"] + counts["relay"]) / joined, 4) if joined else 0.0,
+        }
+
+
+def create():
+    if SINGLE_FLIGHT == "shared":
+        try:
+            return SingleFlight(FlightStore(SINGLE_FLIGHT_PATH))
+        except sqlite3.Error as e:
+            log.warning("cannot open the single-flight store; coalescing within each worker only",
+                        extra={"path": SINGLE_FLIGHT_PATH, "error": str(e)})
+            return SingleFlight()
+    if SINGLE_FLIGHT == "local":
+        return SingleFlight()
+    return None
+
+
+group = create()
+
+
+def stats():
+    return group.stats() if group is not None else {"mode": "off"}
+
+
+# --- Entry points for api.py (sync) ---
+
+def ask(key, call):
+    """
+    Runs call() -> (answer, answered_by) once for all concurrent requests with `key` and
+    returns its result to each of them. Only the leader's call runs, so that is where to cache.
+    """
+    if group is None:
+        return call()
+    flight, role = group.join(key)
+    if role == "relay":
+        threading.Thread(target=group.relay, args=(flight,), name="single-flight-relay", daemon=True).start()
+    if role != "leader":
+        return flight.result()
+    try:
+        text, answered_by = call()
+    except providers.ChatError as e:
+        group.finish(flight, error=e)
+        raise
+    except BaseException:
+        group.finish(flight, error=interrupted())
+        raise
+    group.publish(flight, chunk=text, model=answered_by)
+    group.finish(flight, fallback=isinstance(text, providers.FallbackText))
+    return text, answered_by
+
+
+def stream(key, call):
+    """
+    Streaming version of ask(): call() -> (answered_by, chunks). Returns (answered_by, chunks);
+    followers receive the leader's chunks as they arrive.
+    """
+    if group is None:
+        return call()
+    flight, role = group.join(key)
+    if role == "relay":
+        threading.Thread(target=group.relay, args=(flight,), name="single-flight-relay", daemon=True).start()
+    if role != "leader":
+        return flight.wait_started(), flight.follow()
+    try:
+        answered_by, chunks = call()
+    except providers.ChatError as e:
+        group.finish(flight, error=e)
+        raise
+    except BaseException:
+        group.finish(flight, error=interrupted())
+        raise
+    group.publish(flight, model=answered_by)
+
+    def publishing():
+        try:
+            for chunk in chunks:
+                group.publish(flight, chunk=chunk)
+                yield chunk
+        except providers.ChatError as e:
+            group.finish(flight, error=e)
+            raise
+        except BaseException:
+            # Includes GeneratorExit when the leader's client disconnects
+            group.finish(flight, error=interrupted())
+            raise
+        group.finish(flight)
+
+    published = publishing()
+    # A stream that is dropped before it is started never runs its except clauses
+    weakref.finalize(published, group.finish, flight, interrupted())
+    return answered_by, published
+
+
+# --- Entry points for asgi.py (async) ---
+
+async def ajoin(key):
+    if group.store is None:
+        return group.join(key)
+    return await asyncio.to_thread(group.join, key)
+
+
+async def aask(key, call):
+    """Async version of ask(); call is a coroutine function."""
+    if group is None:
+        return await call()
+    flight, role = await ajoin(key)
+    if role == "relay":
+        flight.relay_task = asyncio.create_task(group.arelay(flight))
+    if role != "leader":
+        return await flight.aresult()
+    try:
+        text, answered_by = await call()
+    except providers.ChatError as e:
+        await group.afinish(flight, error=e)
+        raise
+    except BaseException:
+        # Includes cancellation when the client disconnects
+        await asyncio.shield(group.afinish(flight, error=interrupted()))
+        raise
+    await group.apublish(flight, chunk=text, model=answered_by)
+    await group.afinish(flight, fallback=isinstance(text, providers.FallbackText))
+    return text, answered_by
+
+
+async def astream(key, call):
+    """Async version of stream(); call is a coroutine function returning (answered_by, async chunks)."""
+    if group is None:
+        return await call()
+    flight, role = await ajoin(key)
+    if role == "relay":
+        flight.relay_task = asyncio.create_task(group.arelay(flight))
+    if role != "leader":
+        return await flight.await_started(), flight.afollow()
+    try:
+        answered_by, chunks = await call()
+    except providers.ChatError as e:
+        await group.afinish(flight, error=e)
+        raise
+    except BaseException:
+        await asyncio.shield(group.afinish(flight, error=interrupted()))
+        raise
+    await group.apublish(flight, model=answered_by)
+
+    async def publishing():
+        try:
+            async for chunk in chunks:
+                await group.apublish(flight, chunk=chunk)
+                yield chunk
+        except providers.ChatError as e:
+            await group.afinish(flight, error=e)
+            raise
+        except BaseException:
+            group.finish(flight, error=interrupted())
+            raise
+        await group.afinish(flight)
+
+    published = publishing()
+    weakref.finalize(published, group.finish, flight, interrupted())
+    return answered_by, published
@@ -0,0 +1,367 @@
+# FunnX.Ai/structured_logging.py
+# Structured (JSON lines) logging for the backend and the Streamlit app.
+#
+# Records are handed to a bounded in-memory queue on the calling thread and
+# formatted/written by one background listener thread per process, so a request
+# never waits on stdout (a slow log pipe on Render stalls every print()).
+# Each line is one JSON object:
+#   {"ts": "...", "level": "INFO", "logger": "api", "msg": "chat request",
+#    "request_id": "3f2c...", "pid": 12, "model": "Gemini", ...}
+# Anything passed as extra={...} becomes a field. Fields are truncated to
+# LOG_FIELD_MAX_CHARS, and secrets (API keys, bearer tokens, passwords) are
+# redacted by key name and by value pattern before anything is written.
+#
+# Request IDs: api.py/asgi.py take X-Request-ID from the request (app.py sends
+# one per backend call) or make one up, and echo it in the response. It lives in
+# a contextvar, so every record logged while serving the request carries it;
+# work handed to thread pools keeps it when submitted through in_context().
+#
+#   python structured_logging.py --bench 20000   per-request cost vs. the old print() lines
+import io
+import os
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import argparse
+import threading
+import subprocess
+import contextvars
+import logging.handlers
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+# Records waiting for the writer thread; when it is full new records are dropped (and counted)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_FIELD_MAX_CHARS = int(os.getenv("LOG_FIELD_MAX_CHARS", "2000"))
+# Share of records kept per level, e.g. "DEBUG=0.05,INFO=0.5"; unlisted levels keep everything
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+MAX_LIST_ITEMS = 50
+MAX_DEPTH = 6
+REDACTED = "[REDACTED]"
+# Field names whose values are never written (matched on the last _/- separated part)
+SECRET_KEY_RE = re.compile(r"(^|[_-])(authorization|cookie|password|passwd|secret|api[_-]?key|access[_-]?token|token)$", re.I)
+SECRET_VALUE_RES = (
+    (re.compile(r"(Bearer\s+)[A-Za-z0-9._~+/=-]+"), r"\1" + REDACTED),
+    (re.compile(r"\bsk-[A-Za-z0-9_-]{16,}"), REDACTED),       # OpenAI / OpenRouter keys
+    (re.compile(r"\bgsk_[A-Za-z0-9]{20,}"), REDACTED),        # Groq keys
+    (re.compile(r"\bAIza[0-9A-Za-z_-]{30,}"), REDACTED),      # Google API keys (also in ?key= URLs)
+)
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+# LogRecord attributes that aren't extra={...} fields
+RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def parse_sample_rates(value):
+    rates = {}
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        level, _, rate = part.partition("=")
+        try:
+            rates[logging.getLevelName(level.strip().upper())] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            print(f"WARNING: ignoring LOG_SAMPLE_RATES entry '{part}' (expected LEVEL=RATE).")
+    return {level: rate for level, rate in rates.items() if isinstance(level, int)}
+
+
+# --- Request IDs ---
+
+def new_request_id():
+    return os.urandom(8).hex()
+
+
+def set_request_id(value=None):
+    """Makes `value` (or a new ID) the current request's ID and returns it."""
+    value = (value or "").strip()[:64] or new_request_id()
+    request_id.set(value)
+    return value
+
+
+def in_context(fn):
+    """Wraps `fn` to run in a copy of the caller's context (request ID included); for executor.submit()."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+# --- Field clean-up: redaction and truncation ---
+
+def redact_text(text):
+    for pattern, replacement in SECRET_VALUE_RES:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def clean(value, depth=0):
+    """A JSON-friendly copy of `value` with secrets redacted and long strings/lists cut down."""
+    if isinstance(value, str):
+        value = redact_text(value)
+        if len(value) > LOG_FIELD_MAX_CHARS:
+            value = f"{value[:LOG_FIELD_MAX_CHARS]}...[+{len(value) - LOG_FIELD_MAX_CHARS} chars]"
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if depth >= MAX_DEPTH:
+        return clean(repr(value))
+    if isinstance(value, dict):
+        return {
+            str(key): REDACTED if SECRET_KEY_RE.search(str(key)) else clean(item, depth + 1)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [clean(item, depth + 1) for item in list(value)[:MAX_LIST_ITEMS]]
+        if len(value) > MAX_LIST_ITEMS:
+            items.append(f"...[+{len(value) - MAX_LIST_ITEMS} items]")
+        return items
+    return clean(str(value), depth)
+
+
+# --- Formatters ---
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": clean(record.getMessage()),
+        }
+        if getattr(record, "request_id", None):
+            line["request_id"] = record.request_id
+        line["pid"] = record.process
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS and key not in line:
+                line[key] = REDACTED if SECRET_KEY_RE.search(key) else clean(value)
+        if record.exc_info or record.exc_text:
+            line["exc"] = clean(record.exc_text or self.formatException(record.exc_info))
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The old human-readable format, plus the request ID and any extra fields."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = redact_text(super().format(record))
+        fields = {
+            key: REDACTED if SECRET_KEY_RE.search(key) else clean(value)
+            for key, value in vars(record).items() if key not in RECORD_ATTRS
+        }
+        if getattr(record, "request_id", None):
+            fields = {"request_id": record.request_id, **fields}
+        if fields:
+            text += " " + " ".join(f"{key}={json.dumps(value, ensure_ascii=False, default=str)}" for key, value in fields.items())
+        return text
+
+
+# --- Filters and the queue handler ---
+
+class Counts:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def add(self, outcome):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def snapshot(self):
+        with self.lock:
+            return {"written": self.written, "dropped": self.dropped, "sampled_out": self.sampled_out}
+
+
+counts = Counts()
+
+
+class ContextFilter(logging.Filter):
+    """Stamps the request ID and drops the unsampled share of each level; runs on the calling thread."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is not None and random.random() >= rate:
+            counts.add("sampled_out")
+            return False
+        record.request_id = request_id.get()
+        return True
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Formatting happens on the listener thread; only the traceback is rendered
+        # here, since the frames it points at may change once the caller moves on.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            counts.add("dropped")
+
+
+class CountingStreamHandler(logging.StreamHandler):
+    def emit(self, record):
+        super().emit(record)
+        counts.add("written")
+
+
+class Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room: stop() must not fail when a burst has filled the queue
+        self.queue.put(self._sentinel)
+
+
+class Pipeline:
+    """The per-process queue, handler and listener thread; restarted in forked children."""
+
+    def __init__(self, stream, queue_size=LOG_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.queue = queue.Queue(queue_size)
+        self.writer = CountingStreamHandler(stream)
+        self.writer.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else TextFormatter())
+        self.handler = BackgroundHandler(self.queue)
+        self.handler.addFilter(ContextFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+        self.listener = None
+        self.start()
+
+    def start(self):
+        self.listener = Listener(self.queue, self.writer, respect_handler_level=False)
+        self.listener.start()
+
+    def restart_after_fork(self):
+        # The parent's listener thread doesn't exist in the child; records queued
+        # before the fork were (or will be) written by the parent.
+        self.queue = queue.Queue(self.queue_size)
+        self.handler.queue = self.queue
+        self.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()   # writes what is still queued
+            self.listener = None
+
+
+_pipeline = None
+_setup_lock = threading.Lock()
+
+
+def install(pipeline, level=LOG_LEVEL):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(pipeline.handler)
+    root.setLevel(level)
+
+
+def setup(stream=None):
+    """Routes the root logger through the background JSON handler. Safe to call more than once."""
+    global _pipeline
+    with _setup_lock:
+        if _pipeline is not None:
+            return _pipeline
+        _pipeline = Pipeline(stream or sys.stdout)
+        install(_pipeline)
+        atexit.register(_pipeline.stop)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_pipeline.restart_after_fork)
+        return _pipeline
+
+
+def stats():
+    """Records written, dropped (queue full) and sampled out in this process."""
+    return {**counts.snapshot(), "queued": _pipeline.queue.qsize() if _pipeline else 0}
+
+
+# --- Benchmark: per-request cost on the request thread ---
+
+CHAT_PAYLOAD = {
+    "model": "deepseek/deepseek-chat",
+    "messages": [{"role": "user", "content": "Explain how a hash map handles collisions, with an example. " * 4}] * 6,
+    "max_tokens": 1024,
+}
+
+
+def bench_old(requests_count, dump):
+    # What api.py and providers.py did per chat request before this module
+    payload_log = logging.getLogger("bench.old")
+    for i in range(requests_count):
+        print(f"Processing chat request: Message='{CHAT_PAYLOAD['messages'][-1]['content']}', Model='DeepSeek'")
+        if dump:
+            payload_log.debug("Request Payload: %s", json.dumps(CHAT_PAYLOAD, indent=2))
+
+
+def bench_new(requests_count, dump):
+    log = logging.getLogger("bench.new")
+    for i in range(requests_count):
+        set_request_id()
+        log.info("chat request", extra={"model": "DeepSeek", "message_chars": len(CHAT_PAYLOAD["messages"][-1]["content"])})
+        if dump:
+            log.debug("upstream request", extra={"payload": CHAT_PAYLOAD})
+
+
+def open_sinks():
+    """/dev/null (cheapest possible write) and a line-buffered pipe to another process,
+    like a container's unbuffered stdout read by the platform's log collector."""
+    reader = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    pipe = io.TextIOWrapper(reader.stdin, encoding="utf-8", line_buffering=True)
+    return (("/dev/null", open(os.devnull, "w")), ("pipe", pipe)), reader
+
+
+def run_bench(requests_count):
+    sinks, reader = open_sinks()
+    print(f"{requests_count} simulated chat requests; microseconds per request")
+    print(f"{'':52}{'request thread':>16}{'incl. writing':>16}")
+    for sink_name, sink in sinks:
+        for dump, label in ((False, "request line"), (True, "request line + payload dump")):
+            level = "DEBUG" if dump else "INFO"
+            # Old: print() plus the basicConfig stream handler, formatting and writing on the caller
+            real_stdout, sys.stdout = sys.stdout, sink
+            logging.basicConfig(level=level, stream=sink, force=True)
+            started = time.perf_counter()
+            bench_old(requests_count, dump)
+            old = time.perf_counter() - started
+            sys.stdout = real_stdout
+
+            # New: enqueue on the caller, format and write on the listener thread. The queue
+            # holds the whole burst, so nothing is dropped and every record gets written.
+            pipeline = Pipeline(sink, queue_size=requests_count * 2 + 1)
+            install(pipeline, level)
+            started = time.perf_counter()
+            bench_new(requests_count, dump)
+            caller = time.perf_counter() - started
+            pipeline.stop()
+            total = time.perf_counter() - started
+            logging.getLogger().removeHandler(pipeline.handler)
+
+            for how, caller_s, total_s in (("print", old, old), ("queued JSON", caller, total)):
+                name = f"{sink_name}: {label} ({how})"
+                print(f"{name:52}{caller_s / requests_count * 1e6:16.1f}{total_s / requests_count * 1e6:16.1f}")
+    sinks[1][1].close()
+    reader.wait()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the structured logging pipeline.")
+    parser.add_argument("--bench", type=int, default=20000, metavar="N", help="simulated requests (default 20000)")
+    args = parser.parse_args(argv)
+    return run_bench(args.bench)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
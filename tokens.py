@@ -0,0 +1,40 @@
+# FunnX.Ai/tokens.py
+# Token counting for context budgets (see context_builder.py).
+#
+# Uses tiktoken's cl100k_base encoding when tiktoken is installed, otherwise an
+# estimate of ~4 characters per token. Neither is Gemini's or DeepSeek's exact
+# tokenizer, so models can correct for the difference with "token_scale" in
+# providers.MODELS.
+import logging
+try:
+    import tiktoken
+except ImportError:  # Optional: pip install tiktoken for closer counts
+    tiktoken = None
+
+log = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+# Role markers and separators each message adds around its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+
+
+def get_encoding():
+    global _encoding, tiktoken
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # The encoding file is downloaded on first use; without network, fall back for good
+            log.warning("tiktoken unavailable; estimating tokens from length", extra={"error": str(e)})
+            tiktoken = None
+    return _encoding
+
+
+def count_tokens(text):
+    """Tokens for one message's content, including per-message overhead."""
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=())) + MESSAGE_OVERHEAD_TOKENS
+    return -(-len(text) // CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS
@@ -0,0 +1,344 @@
+# FunnX.Ai/usage.py
+# Per-user usage accounting and quotas: tokens, latency and cost of every upstream call.
+#
+# providers.py reports each call it makes (record()) for the user whose request it
+# serves. That includes Auto's hedged calls, Research Mode's sub-questions and
+# conversation summaries, since they run in the request's context (see
+# structured_logging.in_context). The user is set per request by set_user(), from the
+# same key the per-user rate limit uses: user_email, or the client address.
+#
+# Calls are added to in-memory counters, one per (time bucket, user, model), and
+# a background thread flushes them every USAGE_FLUSH_INTERVAL seconds into SQLite
+# (USAGE_DB_PATH). Rows are pre-aggregated per USAGE_BUCKET_SECONDS bucket, so a
+# report over a week reads a few thousand rows, whatever the traffic.
+#
+# Quotas (USAGE_QUOTA_TOKENS / USAGE_QUOTA_COST per user over USAGE_QUOTA_WINDOW
+# hours) are checked in O(1) without touching the database. Each flush also
+# re-reads every user's totals for the window, across all workers, into a
+# snapshot. check_quota() adds this worker's unflushed counts to the snapshot.
+# Other workers' usage is seen up to one flush interval late, so a user can go a
+# little over a quota before being stopped.
+#
+# Token counts are tokens.py's estimates, scaled by the model's "token_scale". Cost
+# uses the model's "input_price"/"output_price" (USD per million tokens) in
+# providers.MODELS; models without prices count tokens but cost 0. Failed calls
+# count as requests and errors, with no tokens.
+import os
+import hmac
+import logging
+import time
+import atexit
+import sqlite3
+import threading
+import contextvars
+import metrics
+
+log = logging.getLogger(__name__)
+
+USAGE_TRACKING = os.getenv("USAGE_TRACKING", "on").lower() not in ("off", "0", "false", "no")
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "usage.sqlite3")
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_RETENTION_DAYS = float(os.getenv("USAGE_RETENTION_DAYS", "30"))
+# Per-user limits over the quota window; 0 disables a limit
+USAGE_QUOTA_TOKENS = int(os.getenv("USAGE_QUOTA_TOKENS", "0"))
+USAGE_QUOTA_COST = float(os.getenv("USAGE_QUOTA_COST", "0"))
+USAGE_QUOTA_WINDOW = float(os.getenv("USAGE_QUOTA_WINDOW", "24"))  # hours
+# Bearer token for GET /admin/usage; the endpoint answers 404 while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+USAGE_BUCKET_SECONDS = 300
+# Report windows: name -> seconds
+WINDOWS = {"1h": 3600, "24h": 86400, "7d": 7 * 86400, "30d": 30 * 86400}
+NO_USER = "(none)"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    bucket INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    model TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    latency_ms INTEGER NOT NULL,
+    PRIMARY KEY (bucket, user, model)
+);
+CREATE INDEX IF NOT EXISTS usage_by_user ON usage (user, bucket);
+"""
+# Counter columns, in the order of a pending row's values
+COLUMNS = ("requests", "errors", "prompt_tokens", "completion_tokens", "cost", "latency_ms")
+
+TOKENS = metrics.Counter(
+    "funnx_usage_tokens_total", "Estimated upstream tokens by model and kind (prompt, completion).", ("model", "kind"),
+)
+COST = metrics.Counter("funnx_usage_cost_usd_total", "Estimated upstream cost in USD by model.", ("model",))
+QUOTA_REJECTIONS = metrics.Counter(
+    "funnx_usage_quota_rejections_total", "Requests rejected because the user's quota was used up.", ("limit",),
+)
+metrics.REGISTRY += [TOKENS, COST, QUOTA_REJECTIONS]
+
+user = contextvars.ContextVar("usage_user", default=None)
+
+
+def set_user(key):
+    """Charges upstream calls made while serving this request to `key`."""
+    user.set(key)
+
+
+def bucket_of(timestamp):
+    return int(timestamp // USAGE_BUCKET_SECONDS * USAGE_BUCKET_SECONDS)
+
+
+def quotas_enabled():
+    return USAGE_QUOTA_TOKENS > 0 or USAGE_QUOTA_COST > 0
+
+
+class UsageLedger:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (bucket, user, model) -> [requests, errors, prompt_tokens, completion_tokens, cost, latency_ms]
+        self.pending = {}
+        # user -> [tokens, cost] recorded here but not yet in `snapshot` (pending or being flushed)
+        self.unflushed = {}
+        self.flushing = {}
+        # user -> (tokens, cost, oldest bucket) in the quota window, all workers, as of the last flush
+        self.snapshot = {}
+        self.flushes = 0
+        self.pruned_at = 0.0
+        self.flusher = None
+        self.flusher_pid = None
+        self.flusher_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.connect().executescript(SCHEMA)
+
+    def connect(self):
+        # One connection per thread, reopened after a fork (gunicorn workers)
+        conn = getattr(self.local, "conn", None)
+        if conn is None or getattr(self.local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    # --- Recording (request path, in memory) ---
+
+    def record(self, user_key, model, prompt_tokens, completion_tokens, cost, seconds, ok=True):
+        key = (bucket_of(time.time()), user_key or NO_USER, model)
+        tokens = prompt_tokens + completion_tokens
+        self.ensure_flusher()
+        with self.lock:
+            row = self.pending.get(key)
+            if row is None:
+                row = self.pending[key] = [0, 0, 0, 0, 0.0, 0]
+            row[0] += 1
+            row[1] += not ok
+            row[2] += prompt_tokens
+            row[3] += completion_tokens
+            row[4] += cost
+            row[5] += round(seconds * 1000)
+            totals = self.unflushed.get(key[1])
+            if totals is None:
+                totals = self.unflushed[key[1]] = [0, 0.0]
+            totals[0] += tokens
+            totals[1] += cost
+
+    def check_quota(self, user_key):
+        """Returns (allowed, retry_after seconds). Reads only in-memory counters."""
+        if not quotas_enabled() or not user_key:
+            return True, 0.0
+        with self.lock:
+            tokens, cost, oldest = self.snapshot.get(user_key, (0, 0.0, None))
+            for totals in (self.flushing.get(user_key), self.unflushed.get(user_key)):
+                if totals:
+                    tokens += totals[0]
+                    cost += totals[1]
+        if USAGE_QUOTA_TOKENS > 0 and tokens >= USAGE_QUOTA_TOKENS:
+            limit = "tokens"
+        elif USAGE_QUOTA_COST > 0 and cost >= USAGE_QUOTA_COST:
+            limit = "cost"
+        else:
+            return True, 0.0
+        QUOTA_REJECTIONS.inc(limit=limit)
+        # When the oldest usage in the window expires (it may take longer to get back under)
+        window = USAGE_QUOTA_WINDOW * 3600
+        oldest = oldest if oldest is not None else bucket_of(time.time())
+        return False, max(oldest + USAGE_BUCKET_SECONDS + window - time.time(), 1.0)
+
+    # --- Flushing (background thread) ---
+
+    def ensure_flusher(self):
+        if self.flusher_pid == os.getpid() and self.flusher.is_alive():
+            return
+        with self.flusher_lock:
+            if self.flusher_pid != os.getpid() or not self.flusher.is_alive():
+                # After a fork the parent's thread doesn't exist here; its counts are its own to flush
+                if self.flusher_pid != os.getpid():
+                    with self.lock:
+                        self.pending, self.unflushed, self.flushing = {}, {}, {}
+                self.flusher = threading.Thread(target=self.flush_loop, name="usage-flusher", daemon=True)
+                self.flusher_pid = os.getpid()
+                self.flusher.start()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(USAGE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                # Keep the flusher running; the next interval tries again
+                log.exception("failed to flush usage counters")
+
+    def flush(self):
+        """Writes the pending counters and refreshes the quota snapshot."""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                # Merged rather than replaced: a failed flush leaves the previous batch in `flushing`
+                for user_key, (tokens, cost) in self.unflushed.items():
+                    totals = self.flushing.setdefault(user_key, [0, 0.0])
+                    totals[0] += tokens
+                    totals[1] += cost
+                self.unflushed = {}
+            now = time.time()
+            with self.connect() as conn:
+                if batch:
+                    conn.executemany(
+                        "INSERT INTO usage (bucket, user, model, " + ", ".join(COLUMNS) + ")"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                        " ON CONFLICT (bucket, user, model) DO UPDATE SET "
+                        + ", ".join(f"{column} = {column} + excluded.{column}" for column in COLUMNS),
+                        [key + tuple(values) for key, values in batch.items()],
+                    )
+                if now - self.pruned_at > 3600:
+                    conn.execute("DELETE FROM usage WHERE bucket < ?", (bucket_of(now - USAGE_RETENTION_DAYS * 86400),))
+                    self.pruned_at = now
+                snapshot = self.read_snapshot(conn, now) if quotas_enabled() else {}
+            with self.lock:
+                self.snapshot = snapshot
+                self.flushing = {}
+                self.flushes += 1
+
+    def read_snapshot(self, conn, now):
+        rows = conn.execute(
+            "SELECT user, SUM(prompt_tokens + completion_tokens) AS tokens, SUM(cost) AS cost, MIN(bucket) AS oldest"
+            " FROM usage WHERE bucket >= ? GROUP BY user",
+            (bucket_of(now - USAGE_QUOTA_WINDOW * 3600),),
+        ).fetchall()
+        return {row["user"]: (row["tokens"], row["cost"], row["oldest"]) for row in rows}
+
+    def stop(self):
+        if self.flusher_pid == os.getpid():
+            try:
+                self.flush()
+            except sqlite3.Error:
+                log.exception("failed to flush usage counters")
+
+    # --- Reports ---
+
+    def top(self, group_by, since, limit):
+        rows = self.connect().execute(
+            f"SELECT {group_by} AS name, SUM(requests) AS requests, SUM(errors) AS errors,"
+            " SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens,"
+            " SUM(cost) AS cost, SUM(latency_ms) AS latency_ms"
+            f" FROM usage WHERE bucket >= ? GROUP BY {group_by}"
+            " ORDER BY cost DESC, prompt_tokens + completion_tokens DESC LIMIT ?",
+            (since, limit),
+        ).fetchall()
+        return [summarize(row) for row in rows]
+
+    def totals(self, since):
+        row = self.connect().execute(
+            "SELECT 'all' AS name, COALESCE(SUM(requests), 0) AS requests, COALESCE(SUM(errors), 0) AS errors,"
+            " COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens, COALESCE(SUM(completion_tokens), 0) AS completion_tokens,"
+            " COALESCE(SUM(cost), 0) AS cost, COALESCE(SUM(latency_ms), 0) AS latency_ms"
+            " FROM usage WHERE bucket >= ?",
+            (since,),
+        ).fetchone()
+        summary = summarize(row)
+        del summary["name"]
+        return summary
+
+    def report(self, windows, limit):
+        """Top users and models by cost (then tokens) for each window, e.g. ("1h", "24h")."""
+        # This worker's counts are written first; other workers' are at most one flush interval behind
+        self.flush()
+        now = time.time()
+        report = {}
+        for window in windows:
+            since = bucket_of(now - WINDOWS[window])
+            report[window] = {
+                "since": since,
+                "totals": self.totals(since),
+                "top_users": self.top("user", since, limit),
+                "top_models": self.top("model", since, limit),
+            }
+        return report
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending_rows": len(self.pending),
+                "flushes": self.flushes,
+                "quota_users": len(self.snapshot),
+            }
+
+
+def summarize(row):
+    summary = dict(row)
+    summary["cost"] = round(summary["cost"], 6)
+    summary["avg_latency_ms"] = round(summary.pop("latency_ms") / summary["requests"]) if summary["requests"] else None
+    return summary
+
+
+ledger = None
+if USAGE_TRACKING:
+    try:
+        ledger = UsageLedger(USAGE_DB_PATH)
+        atexit.register(ledger.stop)
+    except sqlite3.Error as e:
+        log.warning("cannot open the usage database; usage accounting and quotas are disabled",
+                    extra={"path": USAGE_DB_PATH, "error": str(e)})
+
+
+def record(model, prompt_tokens, completion_tokens, cost, seconds, ok=True):
+    """Adds one upstream call to the current request's user (see set_user())."""
+    TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    TOKENS.inc(completion_tokens, model=model, kind="completion")
+    COST.inc(cost, model=model)
+    if ledger is not None:
+        ledger.record(user.get(), model, prompt_tokens, completion_tokens, cost, seconds, ok)
+
+
+def check_quota(user_key):
+    """(allowed, retry_after) for a new request from `user_key`."""
+    if ledger is None:
+        return True, 0.0
+    return ledger.check_quota(user_key)
+
+
+def parse_windows(value):
+    """Comma-separated report windows ("1h,24h"); raises ValueError naming the valid ones."""
+    windows = [w.strip() for w in (value or "1h,24h,7d").split(",") if w.strip()]
+    unknown = [w for w in windows if w not in WINDOWS]
+    if unknown or not windows:
+        raise ValueError(f"Unknown window {', '.join(unknown) or '(none)'}; use {', '.join(WINDOWS)}.")
+    return windows
+
+
+def is_admin(authorization):
+    """True if the Authorization header carries ADMIN_TOKEN."""
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}")
+
+
+def report(windows, limit=10):
+    return ledger.report(windows, max(1, min(limit, 100)))
+
+
+def stats():
+    return {"enabled": ledger is not None, **(ledger.stats() if ledger is not None else {})}